@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import func
+
+from logger import logger as log
+from models.reddit_models import SubmittedPost
+
+
+# Groups subreddits into the multireddit chunks that ingestion pulls listings for, so that each chunk's expected
+# new posts between two pulls fit in one listing page: busy subreddits get small chunks (or one to themselves), quiet
+# ones are packed up to max_chunk_subs.  Post rates come from the last look_back of RedditPost and are recomputed
+# every replan_secs.  Shared by all threads of the process.
+class ChunkPlanner:
+
+    def __init__(self, interval_secs: int = 120, page_size: int = 100, max_chunk_subs: int = 150,
+                 look_back: timedelta = timedelta(hours=24), replan_secs: int = 3600):
+        self.interval_secs = interval_secs
+        self.page_size = page_size
+        self.max_chunk_subs = max_chunk_subs
+        self.look_back = look_back
+        self.replan_secs = replan_secs
+        self.rates: Dict[str, float] = {}  # subreddit_name: posts per second
+        self.planned_at: Optional[float] = None
+        self.lock = threading.Lock()
+
+    def post_rates(self, s) -> Dict[str, float]:
+        with self.lock:
+            if self.planned_at is None or time.monotonic() - self.planned_at > self.replan_secs:
+                rows = s.query(SubmittedPost.subreddit_name, func.count(SubmittedPost.id)) \
+                    .filter(SubmittedPost.time_utc > datetime.utcnow() - self.look_back) \
+                    .group_by(SubmittedPost.subreddit_name).all()
+                look_back_secs = self.look_back.total_seconds()
+                self.rates = {subreddit_name.lower(): count / look_back_secs for subreddit_name, count in rows}
+                self.planned_at = time.monotonic()
+                log.info(f"chunk planner: post rates for {len(self.rates)} subreddits")
+            return self.rates
+
+    def chunks(self, s, sub_names: Iterable[str], interval_secs: Optional[int] = None) -> List[List[str]]:
+        # -> sub_names split into chunks, busiest first.  interval_secs: time between two pulls of a chunk
+        rates = self.post_rates(s)
+        interval_secs = interval_secs or self.interval_secs
+        expected = {subreddit_name: rates.get(subreddit_name.lower(), 0) * interval_secs
+                    for subreddit_name in sub_names}
+
+        # first fit decreasing: a subreddit goes in the first chunk it fits in, else starts a new one
+        chunks: List[List[str]] = []
+        volumes: List[float] = []
+        for subreddit_name in sorted(expected, key=lambda name: (-expected[name], name)):
+            volume = expected[subreddit_name]
+            for j, chunk in enumerate(chunks):
+                if volumes[j] + volume <= self.page_size and len(chunk) < self.max_chunk_subs:
+                    chunk.append(subreddit_name)
+                    volumes[j] += volume
+                    break
+            else:
+                chunks.append([subreddit_name])
+                volumes.append(volume)
+        return chunks
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Optional, Set, Tuple
+
+from sqlalchemy import or_
+
+from core import dbobj
+from logger import logger as log
+from models.reddit_models import Task
+
+
+def default_node_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+# Locks on Tasks2 rows so that several bot processes sharing a database run singleton tasks once between them.
+# A lock is the row's lock_owner + lock_expires_at; a background thread extends the locks this process holds, so
+# the locks of a process that died run out after ttl_secs.  Uses its own session, safe to call from any thread.
+class TaskLocks:
+
+    def __init__(self, ttl_secs: int = 120, node_id: Optional[str] = None):
+        self.ttl_secs = ttl_secs
+        self.node_id = node_id or default_node_id()
+        self.held: Set[str] = set()
+        self.s = dbobj.new_session()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="mhb-task-locks", daemon=True)
+        self.thread.start()
+
+    def acquire(self, target_function: str, check_due: bool = True) -> Tuple[bool, Optional[datetime]]:
+        # -> (acquired, last_run_dt in the db).  With check_due, a task another process ran within its frequency is
+        # not acquired either.
+        with self.lock:
+            now = datetime.now()
+            self.s.expire_all()
+            task: Task = self.s.query(Task).get(target_function)
+            if not task:
+                return False, None
+            last_run_dt = task.last_run_dt
+            if check_due and last_run_dt and last_run_dt + timedelta(seconds=task.frequency_secs) > now:
+                return False, last_run_dt
+            acquired = self.s.query(Task) \
+                .filter(Task.target_function == target_function,
+                        or_(Task.lock_owner.is_(None), Task.lock_owner == self.node_id, Task.lock_expires_at < now),
+                        Task.last_run_dt.is_(None) if last_run_dt is None else Task.last_run_dt == last_run_dt) \
+                .update({Task.lock_owner: self.node_id, Task.lock_expires_at: now + timedelta(seconds=self.ttl_secs)},
+                        synchronize_session=False)
+            self.s.commit()
+            if acquired:
+                self.held.add(target_function)
+            return bool(acquired), last_run_dt
+
+    def release(self, target_function: str, ran_at: Optional[datetime] = None):
+        # ran_at is written with the release, so nobody takes the lock and reruns before our Tasks2 commit
+        values = {Task.lock_owner: None, Task.lock_expires_at: None}
+        if ran_at:
+            values[Task.last_run_dt] = ran_at
+        with self.lock:
+            self.held.discard(target_function)
+            self.s.query(Task).filter(Task.target_function == target_function, Task.lock_owner == self.node_id) \
+                .update(values, synchronize_session=False)
+            self.s.commit()
+
+    @contextmanager
+    def holding(self, target_function: str):
+        # plain mutual exclusion, e.g. for the heavy part of a task every process runs - yields whether we got it
+        acquired, _ = self.acquire(target_function, check_due=False)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self.release(target_function)
+
+    def _run(self):
+        while True:
+            time.sleep(self.ttl_secs / 3)
+            try:
+                with self.lock:
+                    if self.held:
+                        self.s.query(Task).filter(Task.target_function.in_(self.held),
+                                                  Task.lock_owner == self.node_id) \
+                            .update({Task.lock_expires_at: datetime.now() + timedelta(seconds=self.ttl_secs)},
+                                    synchronize_session=False)
+                    self.s.commit()
+            except Exception:
+                self.s.rollback()
+                log.exception("task lock heartbeat failed")
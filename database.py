@@ -8,10 +8,16 @@ class Database:
     def __init__(self):
         self.engine = create_engine(DB_ENGINE)
         self.Base = declarative_base(bind=self.engine)
-        Session = sessionmaker(bind=self.engine)
-        self.s = Session()
+        self.Session = sessionmaker(bind=self.engine)
+        self.s = self.Session()
         self.s.rollback()
 
+    def new_session(self):
+        # for worker threads - sessions are not thread safe, so each worker gets its own
+        s = self.Session()
+        s.rollback()
+        return s
+
     def load_models(self):
         import models.reddit_models
 
@@ -1,3 +1,4 @@
 from .countedstatus import CountedStatus
 from .postedstatus import PostedStatus
 from .substatus import SubStatus
+from .apipriority import ApiPriority
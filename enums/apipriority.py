@@ -0,0 +1,7 @@
+from enum import IntEnum
+
+
+class ApiPriority(IntEnum):
+    HIGH = 0  # removals, replies, modmail - can use the reserve
+    NORMAL = 1
+    BACKGROUND = 2  # author history scans, stats - first to wait when the limit gets close
@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import re
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List, Optional, Pattern, Tuple
+
+import pytz
+from sqlalchemy import case, literal
+
+from enums import CountedStatus, PostedStatus
+from logger import logger as log
+from models.reddit_models import SubmittedPost, TrackedSubreddit
+
+Verdict = Tuple[CountedStatus, str]
+# one step of a chain: (post, posted status) -> verdict if the step exempts the post, else None
+Predicate = Callable[[SubmittedPost, Optional[PostedStatus]], Optional[Verdict]]
+
+# TrackedSubreddit settings a chain is compiled from - a change to any of them recompiles the subreddit's chain
+CONFIG_ATTRS = ('ignore_AutoModerator_removed', 'ignore_moderator_removed', 'exempt_oc', 'exempt_self_posts',
+                'exempt_link_posts', 'exempt_moderator_posts', 'mod_list', 'author_exempt_flair_keyword',
+                'author_not_exempt_flair_keyword', 'title_exempt_keyword', 'title_not_exempt_keyword')
+
+# the only columns the chains look at
+POST_COLUMNS = (SubmittedPost.id, SubmittedPost.subreddit_name, SubmittedPost.author, SubmittedPost.title,
+                SubmittedPost.is_self, SubmittedPost.is_oc, SubmittedPost.author_flair, SubmittedPost.post_flair,
+                SubmittedPost.posted_status)
+
+
+def keyword_pattern(keyword) -> Optional[Pattern]:
+    # config keyword setting -> regex matching any of its keywords anywhere, ignoring case.  Lists in the config
+    # come joined with '|' by reload_yaml_settings
+    if not keyword:
+        return None
+    keywords = keyword if isinstance(keyword, list) else str(keyword).split('|')
+    keywords = [re.escape(str(k)) for k in keywords if k]
+    return re.compile('|'.join(keywords), re.IGNORECASE) if keywords else None
+
+
+def as_posted_status(posted_status) -> Optional[PostedStatus]:
+    if posted_status is None or isinstance(posted_status, PostedStatus):
+        return posted_status
+    try:
+        return PostedStatus(posted_status)
+    except ValueError:
+        return None
+
+
+def exemption_config(tr_sub: TrackedSubreddit) -> tuple:
+    return tuple(getattr(tr_sub, attr, None) for attr in CONFIG_ATTRS) + (tuple(tr_sub.subreddit_mods or ()),)
+
+
+# A subreddit's post exemption settings compiled into the ordered list of checks check_for_post_exemptions makes:
+# settings that are off add no step, keywords are matched with one precompiled regex each.  Steps only look at the
+# post's columns (and the posted status given), so a chain runs the same on a SubmittedPost or a query row.
+class ExemptionChain:
+
+    def __init__(self, tr_sub: TrackedSubreddit, config: tuple = None):
+        self.config = config if config is not None else exemption_config(tr_sub)
+        self.steps: List[Predicate] = []
+        step = self.steps.append
+
+        step(lambda post, posted_status: (CountedStatus.SPAMMED_EXMPT, "")
+             if posted_status == PostedStatus.SPAM_FLT else None)
+        if tr_sub.ignore_AutoModerator_removed:
+            step(lambda post, posted_status: (CountedStatus.AM_RM_EXEMPT, "")
+                 if posted_status == PostedStatus.AUTOMOD_RM else None)
+        if tr_sub.ignore_moderator_removed:
+            step(lambda post, posted_status: (CountedStatus.FLAIR_HELPER, "")
+                 if posted_status == PostedStatus.FH_RM else None)
+            step(lambda post, posted_status: (CountedStatus.MOD_RM_EXEMPT, "")
+                 if posted_status == PostedStatus.MOD_RM else None)
+        if tr_sub.exempt_oc:  # won't change
+            step(lambda post, posted_status: (CountedStatus.OC_EXEMPT, "") if post.is_oc else None)
+        if tr_sub.exempt_self_posts:  # won't change
+            step(lambda post, posted_status: (CountedStatus.SELF_EXEMPT, "") if post.is_self else None)
+        if tr_sub.exempt_link_posts:  # won't change
+            step(lambda post, posted_status: (CountedStatus.LINK_EXEMPT, "") if post.is_self is not True else None)
+
+        mods = {name.strip().lower() for name in (tr_sub.mod_list or "").split(',') if name.strip()}
+        mods |= {name.lower() for name in tr_sub.subreddit_mods or ()}
+        if tr_sub.exempt_moderator_posts and mods:  # may change
+            step(lambda post, posted_status: (CountedStatus.MODPOST_EXEMPT, "moderator exempt")
+                 if post.author and post.author.lower() in mods else None)
+
+        # flairs as of ingestion or the last posted status check
+        flair_exempt = keyword_pattern(tr_sub.author_exempt_flair_keyword)
+        if flair_exempt:
+            step(lambda post, posted_status: (CountedStatus.FLAIR_EXEMPT, f"flair exempt {post.author_flair}")
+                 if post.author_flair and flair_exempt.search(post.author_flair) else None)
+
+        # only restrict certain flairs
+        flair_not_exempt = keyword_pattern(tr_sub.author_not_exempt_flair_keyword)
+        if flair_not_exempt:
+            step(lambda post, posted_status: (CountedStatus.FLAIR_NOT_EXEMPT, f"flair not exempt {post.author_flair}")
+                 if not post.author_flair or not flair_not_exempt.search(post.author_flair) else None)
+
+        title_exempt = keyword_pattern(tr_sub.title_exempt_keyword)
+        if title_exempt:
+            reason = f"title keyword exempt {tr_sub.title_exempt_keyword} -> exemption"
+            step(lambda post, posted_status: (CountedStatus.TITLE_KW_EXEMPT, reason)
+                 if title_exempt.search(post.title or "") else None)
+
+        # title keywords only to restrict: no required keyword in title or post flair -> exempt
+        title_required = keyword_pattern(tr_sub.title_not_exempt_keyword)
+        if title_required:
+            not_met = f"title does not have {tr_sub.title_not_exempt_keyword} -> exemption"
+            step(lambda post, posted_status: None
+                 if title_required.search(post.title or "")
+                 or (post.post_flair and title_required.search(post.post_flair))
+                 else (CountedStatus.TITLE_CRITERIA_NOT_MET, not_met))
+
+    def check(self, post, posted_status=None) -> Verdict:
+        posted_status = as_posted_status(posted_status)
+        for predicate in self.steps:
+            verdict = predicate(post, posted_status)
+            if verdict:
+                return verdict
+        return CountedStatus.COUNTS, "no exemptions"
+
+
+# Compiled exemption chains by subreddit, recompiled when a subreddit's settings change.  Runs them over new posts
+# before they are inserted (screen) and, for automated_reviews, in batches over the unreviewed posts in the rule
+# windows, writing each batch's exemptions with a single UPDATE.  Shared by all threads of the process.
+class ExemptionChains:
+
+    def __init__(self, batch_size: int = 500):
+        self.batch_size = batch_size
+        self.chains: Dict[str, ExemptionChain] = {}
+        self.lock = threading.Lock()
+
+    def chain(self, tr_sub: TrackedSubreddit) -> ExemptionChain:
+        config = exemption_config(tr_sub)
+        with self.lock:
+            chain = self.chains.get(tr_sub.subreddit_name.lower())
+            if chain is None or chain.config != config:
+                chain = self.chains[tr_sub.subreddit_name.lower()] = ExemptionChain(tr_sub, config)
+        return chain
+
+    def screen(self, sub_dict: Dict[str, TrackedSubreddit], posts: Iterable[SubmittedPost]) -> int:
+        # mark the exempt ones of posts about to be inserted, so the insert itself writes their counted status
+        subs = {subreddit_name.lower(): tr_sub for subreddit_name, tr_sub in sub_dict.items()}
+        now = datetime.now(pytz.utc)
+        count = 0
+        for post in posts:
+            tr_sub = subs.get(post.subreddit_name.lower())
+            if not tr_sub or post.counted_status_enum != CountedStatus.NOT_CHKD:
+                continue
+            counted_status, _ = self.chain(tr_sub).check(post, post.posted_status)
+            if counted_status != CountedStatus.COUNTS:
+                post.counted_status_enum = counted_status
+                post.counted_status = counted_status.value
+                post.reviewed = True
+                post.last_reviewed = now
+                count += 1
+        return count
+
+    def review(self, wd) -> int:
+        # exempt the unreviewed posts of wd's subreddits that are still young enough to count; not committed
+        subs = {subreddit_name.lower(): tr_sub for subreddit_name, tr_sub in wd.sub_dict.items()}
+        intervals = [tr_sub.min_post_interval_mins for tr_sub in subs.values() if tr_sub.min_post_interval_mins]
+        if not intervals:
+            return 0
+        since = datetime.utcnow() - timedelta(minutes=max(intervals))
+
+        now = datetime.now(pytz.utc)
+        count = 0
+        counts: Dict[str, int] = defaultdict(int)
+        after_id = ""
+        while True:
+            rows = wd.s.query(*POST_COLUMNS) \
+                .filter(SubmittedPost.counted_status_enum == CountedStatus.NOT_CHKD,
+                        SubmittedPost.reviewed.is_(False),
+                        SubmittedPost.time_utc > since,
+                        SubmittedPost.id > after_id) \
+                .order_by(SubmittedPost.id).limit(self.batch_size).all()
+            exempt: Dict[str, CountedStatus] = {}
+            for row in rows:
+                tr_sub = subs.get(row.subreddit_name.lower())
+                if not tr_sub:
+                    continue
+                counted_status, _ = self.chain(tr_sub).check(row, row.posted_status)
+                if counted_status != CountedStatus.COUNTS:
+                    exempt[row.id] = counted_status
+                    counts[counted_status.name] += 1
+            if exempt:
+                count += self._write(wd.s, exempt, now)
+            if len(rows) < self.batch_size:
+                break
+            after_id = rows[-1].id
+        log.debug(f"exemptions: {count} posts exempted {dict(counts)}")
+        return count
+
+    @staticmethod
+    def _write(s, exempt: Dict[str, CountedStatus], now: datetime) -> int:
+        # one UPDATE for the batch, each post's status picked by a CASE on its id
+        enum_type = SubmittedPost.counted_status_enum.type
+        return s.query(SubmittedPost).filter(SubmittedPost.id.in_(list(exempt))) \
+            .update({SubmittedPost.counted_status:
+                         case({post_id: counted_status.value for post_id, counted_status in exempt.items()},
+                              value=SubmittedPost.id),
+                     SubmittedPost.counted_status_enum:
+                         case({post_id: literal(counted_status, enum_type)
+                               for post_id, counted_status in exempt.items()}, value=SubmittedPost.id),
+                     SubmittedPost.reviewed: True,
+                     SubmittedPost.last_reviewed: now}, synchronize_session=False)
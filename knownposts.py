@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Iterable, Set
+
+from logger import logger as log
+from models.reddit_models import SubmittedPost
+
+
+# Ids of posts already in RedditPost, so ingestion can tell new posts from known ones without a query per post.
+# LRU bounded to `size` ids; misses are looked up with one IN query per batch.  Shared by all threads of the process.
+class KnownPostIds:
+
+    def __init__(self, size: int = 200000):
+        self.size = size
+        self.ids: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+    def warm(self, s, look_back: timedelta = timedelta(days=2)):
+        rows = s.query(SubmittedPost.id).filter(SubmittedPost.time_utc > datetime.utcnow() - look_back) \
+            .order_by(SubmittedPost.time_utc).all()
+        self.add_all(row[0] for row in rows)
+        log.info(f"known post ids: warmed with {len(rows)} posts")
+
+    def add(self, post_id: str):
+        self.add_all((post_id,))
+
+    def add_all(self, post_ids: Iterable[str]):
+        with self.lock:
+            for post_id in post_ids:
+                self.ids[post_id] = True
+                self.ids.move_to_end(post_id)
+            while len(self.ids) > self.size:
+                self.ids.popitem(last=False)
+
+    def unknown(self, s, post_ids: Iterable[str]) -> Set[str]:
+        # -> the ids that are not in RedditPost
+        post_ids = set(post_ids)
+        with self.lock:
+            misses = {post_id for post_id in post_ids if post_id not in self.ids}
+            for post_id in post_ids - misses:
+                self.ids.move_to_end(post_id)
+        if not misses:
+            return set()
+        found = {row[0] for row in s.query(SubmittedPost.id).filter(SubmittedPost.id.in_(misses)).all()}
+        self.add_all(found)
+        return misses - found
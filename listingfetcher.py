@@ -0,0 +1,36 @@
+from __future__ import annotations
+
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, TypeVar
+
+from models.reddit_models import RedditInterface
+from ratelimiting import TokenBucket, api_priority, current_priority
+
+T = TypeVar('T')
+
+
+# Pulls reddit listings for several multireddit chunks at once.  praw instances are not thread safe, so each fetch
+# thread borrows one of `threads` RedditInterfaces; all of them draw on api_budget and the process-wide governor,
+# so running in parallel only uses the budget that a sequential pull would leave idle while waiting on responses.
+class ListingFetcher:
+
+    def __init__(self, threads: int = 4, api_budget: TokenBucket = None):
+        self.idle: queue.Queue = queue.Queue()
+        for _ in range(threads):
+            self.idle.put(RedditInterface(api_budget=api_budget))
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="mhb-fetch")
+
+    def map(self, fetch: Callable[[RedditInterface, str], T], sub_lists: Iterable[str]) -> List[T]:
+        # -> fetch(ri, sub_list) for each sub_list, in order.  Calls keep the caller's api priority
+        priority = current_priority()
+
+        def run(sub_list: str) -> T:
+            ri = self.idle.get()
+            try:
+                with api_priority(priority):
+                    return fetch(ri, sub_list)
+            finally:
+                self.idle.put(ri)
+
+        return list(self.executor.map(run, sub_lists))
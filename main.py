@@ -18,7 +18,24 @@ from core import dbobj
 from workingdata import WorkingData
 from nsfw_monitoring import check_post_nsfw_eligibility, nsfw_checking
 from modmail import handle_modmail_message, handle_modmail_messages, handle_dm_command, handle_direct_messages
-from utils import check_spam_submissions, check_new_submissions, do_reddit_actions
+from utils import check_spam_submissions, check_new_submissions, check_submissions_concurrently, check_mod_log, \
+    do_reddit_actions
+from scheduler import TaskScheduler, TaskResult, WorkerPool, ResourceClaims, INTERACTIVE_TASKS, TASK_RESOURCES, \
+    interactive_lanes, TaskBudget, task_budget_secs, TASK_API_PRIORITIES, SINGLETON_TASKS
+from clusterlocks import TaskLocks
+from knownposts import KnownPostIds
+from chunkplanner import ChunkPlanner
+from listingfetcher import ListingFetcher
+from spamqueue import SpamQueueCursors
+from modlog import ModLogTracker
+from postwindows import PostWindows
+from exemptions import ExemptionChains
+from postedstatuscache import posted_statuses
+from ratelimiting import TokenBucket, api_priority
+from metrics import LaneLatency
+from sharding import ShardLeases, GLOBAL_TASKS
+from pipeline import SubmissionPipeline
+import settings
 
 
 from logger import logger as log
@@ -43,23 +60,55 @@ add non-binary gender
 
 
 def check_submissions(wd):
-    chunk_size = 150
     assert isinstance(wd.sub_dict, dict)
-    wd.sub_list = list(wd.sub_dict.keys())
-    chunked_list = [wd.sub_list[j:j + chunk_size] for j in range(0, len(wd.sub_list), chunk_size)]
+    wd.sub_list = [subreddit_name for subreddit_name in wd.sub_dict.keys() if wd.handles(subreddit_name)]
+    chunked_list = (wd.chunk_planner or ChunkPlanner()).chunks(wd.s, wd.sub_list)
+    if wd.listing_fetcher:
+        check_submissions_concurrently(wd, ["+".join(sub_list) for sub_list in chunked_list])
+        return
 
     for sub_list in chunked_list:
         sub_list_str = "+".join(sub_list)
         check_new_submissions(wd, sub_list=sub_list_str, intensity=0)
         check_spam_submissions(wd, sub_list=sub_list_str, intensity=0)
+        if wd.mod_log:
+            check_mod_log(wd, sub_list=sub_list_str)
 
 def main_loop():
+    interactive_lane = getattr(settings, 'INTERACTIVE_LANE', False)
+    batch_api_budget = TokenBucket(getattr(settings, 'BATCH_API_CALLS_PER_MIN', 70)) if interactive_lane else None
+
     wd: WorkingData = WorkingData()
     wd.s = dbobj.s  # Database Session object
-    wd.ri = RedditInterface()  # Reddit API instance
+    wd.ri = RedditInterface(api_budget=batch_api_budget)  # Reddit API instance
     wd.most_recent_review = None  # not used?
     wd.bot_name = wd.ri.reddit_client.user.me().name  # what is my name?
     log.debug(f"My name is {wd.bot_name}")
+    if getattr(settings, 'CLUSTER_LOCKS', False):
+        wd.task_locks = TaskLocks(ttl_secs=getattr(settings, 'CLUSTER_LOCK_TTL_SECS', 120),
+                                  node_id=getattr(settings, 'SHARD_NODE_ID', None))
+        wd.task_locks.start()
+    shard_partitions = getattr(settings, 'SHARD_PARTITIONS', 0)
+    if shard_partitions:
+        wd.shard = ShardLeases(shard_partitions, lease_secs=getattr(settings, 'SHARD_LEASE_SECS', 90),
+                               node_id=getattr(settings, 'SHARD_NODE_ID', None))
+        # partitions moved -> reload the sub list so ingestion and rule checks follow
+        wd.shard.start(on_change=lambda: wd.scheduler and wd.scheduler.wake('update_sub_list'))
+    wd.known_posts = KnownPostIds(size=getattr(settings, 'KNOWN_POST_IDS_SIZE', 200000))
+    wd.known_posts.warm(wd.s)
+    wd.chunk_planner = ChunkPlanner(interval_secs=getattr(settings, 'LISTING_CHUNK_INTERVAL_SECS', 120),
+                                    replan_secs=getattr(settings, 'LISTING_CHUNK_REPLAN_SECS', 3600))
+    wd.spam_queue = SpamQueueCursors(fresh_secs=getattr(settings, 'SPAM_QUEUE_FRESH_SECS', 120),
+                                     rescan_secs=getattr(settings, 'SPAM_QUEUE_RESCAN_SECS', 600))
+    wd.exemption_chains = ExemptionChains()
+    if getattr(settings, 'POST_WINDOWS', False):
+        wd.post_windows = PostWindows(reconcile_secs=getattr(settings, 'POST_WINDOWS_RECONCILE_SECS', 3600))
+        wd.post_windows.rebuild(wd.s)
+    if getattr(settings, 'MOD_LOG_TRACKING', False):
+        wd.mod_log = ModLogTracker()
+    listing_fetch_threads = getattr(settings, 'LISTING_FETCH_THREADS', 0)
+    if listing_fetch_threads:
+        wd.listing_fetcher = ListingFetcher(threads=listing_fetch_threads, api_budget=batch_api_budget)
     tasks = wd.s.query(Task).all()
     if not tasks:
         tasks_to_populate = [Task(wd, 'purge_old_records', timedelta(hours=12)),
@@ -88,50 +137,149 @@ def main_loop():
         #  do_automated_replies()  This is currently disabled!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 
         # nsfw_checking(wd)
+    wd.scheduler = TaskScheduler()
+    wd.claims = ResourceClaims()
+    wd.claims.listeners.append(wd.scheduler)
+    wd.lane_latency = LaneLatency('batch')
+    if interactive_lane:
+        # DMs and modmail get their own threads, sessions and api budgets so commands are answered within seconds
+        for lane in interactive_lanes(wd, wd.claims):
+            lane.start(execute_task, record_task_result)
+        tasks = [task for task in tasks if task.target_function not in INTERACTIVE_TASKS]
+    if getattr(settings, 'SUBMISSION_PIPELINE', False):
+        # new posts are ingested and checked as they come in, rather than by check_submissions
+        pipeline = SubmissionPipeline(wd, poll_secs=getattr(settings, 'SUBMISSION_PIPELINE_POLL_SECS', 60),
+                                      queue_size=getattr(settings, 'SUBMISSION_PIPELINE_QUEUE_SIZE', 20),
+                                      api_budget=batch_api_budget)
+        pipeline.start()
+        tasks = [task for task in tasks if task.target_function != 'check_submissions']
+    for task in tasks:
+        wd.scheduler.add(task)
+
+    worker_count = getattr(settings, 'TASK_WORKERS', 0)
+    if worker_count:
+        run_tasks_parallel(wd, worker_count, batch_api_budget)
+        return
+
     rate_limiting_errors = 0
     while True:
-        for task in tasks:
+        task = wd.scheduler.next_task()  # sleeps until the next task is due
+        if not task:
+            continue
+        with wd.claims.holding(TASK_RESOURCES.get(task.target_function)):
+            wd.lane_latency.record("start_lag",
+                                   (datetime.now() - wd.scheduler.last_due[task.target_function]).total_seconds())
             return_val = run_task(wd, task)
+        wd.scheduler.reschedule(task)
+        wd.lane_latency.save_if_due(wd)
+        posted_statuses.save_if_due(wd)
+        if return_val == -1:
+            rate_limiting_errors += 1
+            if rate_limiting_errors > 2:
+                import time
+                time.sleep(60 * 5)
+                rate_limiting_errors = 0
+
+
+def run_tasks_parallel(wd: WorkingData, worker_count, api_budget=None):
+    pool = WorkerPool(wd, execute_task, wd.claims, worker_count=worker_count, api_budget=api_budget)
+    rate_limiting_errors = 0
+    while True:
+        task = wd.scheduler.next_task(can_run=pool.claim)  # None -> a worker finished
+        if task:
+            wd.lane_latency.record("start_lag",
+                                   (datetime.now() - wd.scheduler.last_due[task.target_function]).total_seconds())
+            pool.submit(task)
+        for task, result in pool.collect():
+            return_val = record_task_result(task, result)
+            wd.scheduler.reschedule(task)
             if return_val == -1:
                 rate_limiting_errors += 1
                 if rate_limiting_errors > 2:
                     import time
                     time.sleep(60 * 5)
                     rate_limiting_errors = 0
+        wd.s.commit()  # Tasks2 rows
+        wd.lane_latency.save_if_due(wd)
+        posted_statuses.save_if_due(wd)
 
-def run_task(wd:WorkingData, task):
 
+def run_task(wd:WorkingData, task):
+    # Due-ness and the error back off are handled by the scheduler (Task.next_due_dt)
+    log.debug(f"Running task: {task.target_function}, last ran:{task.last_run_dt}")
+    return record_task_result(task, execute_task(wd, task.target_function, task_budget_secs(task)))
+
+
+def execute_task(wd: WorkingData, target_function: str, budget_secs=None) -> TaskResult:
+    # Takes no Task row, so it can run on a worker thread
+    start_time = datetime.now()
+    wd.task_load = None
+    wd.budget = TaskBudget(budget_secs)
+    locked = False
+    try:
+        if wd.task_locks and target_function in SINGLETON_TASKS:
+            locked, last_run_dt = wd.task_locks.acquire(target_function)
+            if not locked:
+                log.debug(f"Skipping {target_function}, another process has it or ran it at {last_run_dt}")
+                return TaskResult(start_time, datetime.now(), skipped=True, last_run_dt=last_run_dt)
+        elif target_function in GLOBAL_TASKS and not wd.handles_global():
+            log.debug(f"Skipping {target_function}, another shard runs it")
+            return TaskResult(start_time, datetime.now(), skipped=True)
+        with api_priority(TASK_API_PRIORITIES.get(target_function, ApiPriority.NORMAL)):
+            globals()[target_function](wd)
+        end_time = datetime.now()
+        log.debug(f"Task complete {target_function} {end_time - start_time}")
+        if locked:
+            wd.task_locks.release(target_function, ran_at=start_time)
+            locked = False
+        if wd.budget.cut_short and wd.scheduler:  # stopped early -> pick up the rest after the other due tasks
+            wd.scheduler.wake(target_function)
+        return TaskResult(start_time, end_time, load=wd.task_load)
+    except (prawcore.exceptions.ServerError, prawcore.exceptions.ResponseException):
+        wd.s.commit()
+        import traceback
+        trace = traceback.format_exc()
+        print(trace)
+        return TaskResult(start_time, datetime.now(), error=str(trace), rate_limited=True)
+    except Exception:
+        wd.s.commit()
+        import traceback
+        trace = traceback.format_exc()
+        print(trace)
+        return TaskResult(start_time, datetime.now(), error=str(trace))
+    finally:
+        if locked:
+            wd.task_locks.release(target_function)
+
+
+def record_task_result(task, result: TaskResult):
+    if result.skipped:
+        if result.last_run_dt:
+            task.last_run_dt = result.last_run_dt
+        task.not_before = result.end_time + timedelta(seconds=task.current_frequency_secs())
+        return
+    if result.rate_limited:
+        task.error_count += 1
+        task.record_run(result.start_time, result.end_time, outcome="rate_limited", error=result.error)
+        return -1
+    if result.error:
+        task.last_error = result.error
+        task.record_run(result.start_time, result.end_time, outcome="error", error=result.error)
+        return
+    task.last_run_dt = result.start_time
+    task.record_run(result.start_time, result.end_time)
+    budget_secs = task_budget_secs(task)
+    if budget_secs and (result.end_time - result.start_time).total_seconds() > budget_secs:
+        log.warning(f"{task.target_function} ran over its {budget_secs}s budget: {result.end_time - result.start_time}")
+    frequency_bounds = getattr(settings, 'ADAPTIVE_TASK_FREQUENCY', {}).get(task.target_function)
+    if not frequency_bounds:
+        task.adapted_secs = None  # taken out of ADAPTIVE_TASK_FREQUENCY -> back to the configured frequency
+    elif result.load is not None:
+        task.adapt_frequency(result.load, *frequency_bounds)
+    stats = task.metrics.summary()
+    log.debug(f"{task.target_function} p50 {stats['p50']:.1f}s p95 {stats['p95']:.1f}s max {stats['max']:.1f}s "
+              f"error rate {stats['error_rate']:.0%} over {stats['runs']} runs")
 
-    if task.last_run_dt and task.last_run_dt + timedelta(seconds=task.frequency_secs) > datetime.now():
-        log.debug(f"Skipping task as not due for task: {task.target_function}")
-        pass
-    elif task.error_count > 5 and task.last_run_dt + timedelta(hours=5) > datetime.now():
-        # if had multiple erros  and last ran less than five hours ago
-        log.debug(f"Skipping task due to previous errors: {task.target_function} {task.last_error}")
-    else:
-
-        start_time = datetime.now()
-        try:
-            log.debug(f"Running task: {task.target_function}, last ran:{task.last_run_dt}")
-
-            globals()[task.target_function](wd)
-            end_time = datetime.now()
-            task.last_run_dt = start_time
-            log.debug(f"Task complete {task.target_function} {end_time - start_time}")
-            task.task_durations.append((end_time - start_time).seconds)
-        except (prawcore.exceptions.ServerError, prawcore.exceptions.ResponseException):
-            wd.s.commit()
-            task.error_count += 1
-            import traceback
-            trace = traceback.format_exc()
-            print(trace)
-            return -1
-        except Exception:
-            wd.s.commit()
-            import traceback
-            trace = traceback.format_exc()
-            task.last_error = str(trace)
-            print(trace)
 
 def update_sub_list(wd: WorkingData, intensity=0):
     log.info('updating subs..')
@@ -140,47 +288,53 @@ def update_sub_list(wd: WorkingData, intensity=0):
     trs = wd.s.query(TrackedSubreddit)\
         .filter(~TrackedSubreddit.active_status_enum.in_((SubStatus.SUB_FORBIDDEN, SubStatus.SUB_GONE))).all()
 
-    # go through all subs in database
-    for tr in trs:
-        assert isinstance(tr, TrackedSubreddit)
-
-        # See if due for complete re-pull from subreddit wiki (do periodically)
-        if not tr.config_last_checked\
-                or (tr.config_last_checked < datetime.now() - timedelta(days=1))\
-                or (not tr.mod_list)\
-                or (intensity == 3):
-            log.debug(f'***** rechecking...{tr.subreddit_name}, {tr.active_status_enum}'
-                  f' last updated:{tr.last_updated} last config check:{tr.config_last_checked}')
-
-            sub_info = wd.ri.get_subreddit_info(tr.subreddit_name)
-            tr.update_from_subinfo(sub_info)  # repopulate db with new values/settings from sub
-            tr.config_last_checked = datetime.now()  # record this is updated
-            wd.s.add(tr)
-        if wd.ri.bot_name.lower() == "moderatelyhelpfulbot" and "moderatelyusefulbot" in tr.mod_list.lower():
-            tr.active_status_enum = SubStatus.BOT_NOT_PRIMARY
-            wd.s.add(tr)
-
-        # skip adding  if config is NOT okay
-        if tr.active_status_enum in (SubStatus.YAML_SYNTAX_ERROR, SubStatus.NO_CONFIG, SubStatus.CONFIG_ACCESS_ERROR, SubStatus.BOT_NOT_PRIMARY):
-            log.info(f" active status for {tr.subreddit_name} is {tr.active_status_enum},  skipping")
-            continue  # don't bother with this
-
-        # Attempt to load config assuming it's okay
-        if tr.subreddit_name not in wd.sub_dict:
-            worked, status = tr.reload_yaml_settings()
-            wd.s.add(tr)
-            if not worked:
-                log.info(f" active status for {tr.subreddit_name} is {tr.active_status_enum},  skipping")
+    # with several processes on one database, one of them at a time re-pulls the wiki configs
+    with wd.cluster_lock('update_sub_list') as refresh_configs:
+        # go through all subs in database
+        for tr in trs:
+            assert isinstance(tr, TrackedSubreddit)
+            if not wd.handles(tr.subreddit_name):  # another shard's
+                wd.sub_dict.pop(tr.subreddit_name, None)
                 continue
 
-        # Add sub to dict to check
-        wd.sub_dict[tr.subreddit_name] = tr
+            # See if due for complete re-pull from subreddit wiki (do periodically)
+            if refresh_configs and (not tr.config_last_checked\
+                    or (tr.config_last_checked < datetime.now() - timedelta(days=1))\
+                    or (not tr.mod_list)\
+                    or (intensity == 3)):
+                log.debug(f'***** rechecking...{tr.subreddit_name}, {tr.active_status_enum}'
+                      f' last updated:{tr.last_updated} last config check:{tr.config_last_checked}')
+
+                sub_info = wd.ri.get_subreddit_info(tr.subreddit_name)
+                tr.update_from_subinfo(sub_info)  # repopulate db with new values/settings from sub
+                tr.config_last_checked = datetime.now()  # record this is updated
+                wd.s.add(tr)
+            if wd.ri.bot_name.lower() == "moderatelyhelpfulbot" and tr.mod_list \
+                    and "moderatelyusefulbot" in tr.mod_list.lower():
+                tr.active_status_enum = SubStatus.BOT_NOT_PRIMARY
+                wd.s.add(tr)
+
+            # skip adding  if config is NOT okay
+            if tr.active_status_enum in (SubStatus.YAML_SYNTAX_ERROR, SubStatus.NO_CONFIG, SubStatus.CONFIG_ACCESS_ERROR, SubStatus.BOT_NOT_PRIMARY):
+                log.info(f" active status for {tr.subreddit_name} is {tr.active_status_enum},  skipping")
+                continue  # don't bother with this
+
+            # Attempt to load config assuming it's okay
+            if tr.subreddit_name not in wd.sub_dict:
+                worked, status = tr.reload_yaml_settings()
+                wd.s.add(tr)
+                if not worked:
+                    log.info(f" active status for {tr.subreddit_name} is {tr.active_status_enum},  skipping")
+                    continue
 
-        # Add nsfw moderation if applicable:
-        if tr.nsfw_pct_moderation:
-            wd.nsfw_monitoring_subs[tr.subreddit_name] = tr
+            # Add sub to dict to check
+            wd.sub_dict[tr.subreddit_name] = tr
 
-        wd.s.commit()
+            # Add nsfw moderation if applicable:
+            if tr.nsfw_pct_moderation:
+                wd.nsfw_monitoring_subs[tr.subreddit_name] = tr
+
+            wd.s.commit()
     return
 
 
@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Dict, Iterable, List
+
+from logger import logger as log
+
+
+def percentile(values: Iterable[float], pct: float) -> float:
+    ordered: List[float] = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+# Recent latency samples for one lane, by series (e.g. "start_lag" for every task run, "response" for commands).
+# Percentiles are logged and saved to Stats2 every save_interval_secs.
+class LaneLatency:
+
+    def __init__(self, lane_name: str, size: int = 500, save_interval_secs: int = 600):
+        self.lane_name = lane_name
+        self.size = size
+        self.series: Dict[str, deque] = {}
+        self.save_interval_secs = save_interval_secs
+        self.last_saved = datetime.now()
+        self.lock = threading.Lock()
+
+    def record(self, series: str, secs: float):
+        with self.lock:
+            if series not in self.series:
+                self.series[series] = deque(maxlen=self.size)
+            self.series[series].append(max(0.0, secs))
+
+    def percentiles(self) -> Dict[str, Dict[str, float]]:
+        with self.lock:
+            return {name: {"p50": percentile(samples, 50), "p95": percentile(samples, 95),
+                           "p99": percentile(samples, 99), "count": len(samples)}
+                    for name, samples in self.series.items()}
+
+    def save_if_due(self, wd):
+        if (datetime.now() - self.last_saved).total_seconds() < self.save_interval_secs:
+            return
+        self.last_saved = datetime.now()
+        from models.reddit_models import Stats2
+
+        today = datetime.now().date()
+        for series, stats in self.percentiles().items():
+            log.info(f"lane {self.lane_name} {series} latency: p50 {stats['p50']:.1f}s p95 {stats['p95']:.1f}s "
+                     f"p99 {stats['p99']:.1f}s ({stats['count']} samples)")
+            for pct in ("p50", "p95", "p99"):
+                stat_name = f"lane_{self.lane_name}_{series}_{pct}_ms"
+                stat = wd.s.query(Stats2).get((wd.bot_name, today, stat_name))
+                if not stat:
+                    stat = Stats2(wd.bot_name, today, stat_name)
+                stat.value_int = int(stats[pct] * 1000)
+                wd.s.add(stat)
+        wd.s.commit()
+
+
+# Recent runs of one task, loaded from and written to the TaskRuns ring buffer (models.reddit_models.TaskRun):
+# duration percentiles of successful runs, error rate and the last few errors.
+class TaskMetrics:
+
+    def __init__(self, target_function: str, size: int = 100, errors_kept: int = 5):
+        self.target_function = target_function
+        self.size = size
+        self.run_number = 0
+        self.runs: deque = deque(maxlen=size)  # (start_dt, duration_secs, outcome)
+        self.errors: deque = deque(maxlen=errors_kept)  # (start_dt, error)
+
+    @classmethod
+    def load(cls, s, target_function: str, size: int = 100, errors_kept: int = 5) -> TaskMetrics:
+        from models.reddit_models import TaskRun
+
+        metrics = cls(target_function, size=size, errors_kept=errors_kept)
+        for run in s.query(TaskRun).filter(TaskRun.target_function == target_function) \
+                .order_by(TaskRun.run_number).all():
+            metrics.run_number = run.run_number
+            metrics.runs.append((run.start_dt, run.duration_secs, run.outcome))
+            if run.error:
+                metrics.errors.append((run.start_dt, run.error))
+        return metrics
+
+    def record(self, s, start_dt: datetime, duration_secs: float, outcome: str, error: str = None):
+        from models.reddit_models import TaskRun
+
+        self.run_number += 1
+        self.runs.append((start_dt, duration_secs, outcome))
+        if error:
+            self.errors.append((start_dt, error))
+
+        slot = self.run_number % self.size
+        run = s.query(TaskRun).get((self.target_function, slot))
+        if not run:
+            run = TaskRun(self.target_function, slot)
+        run.run_number = self.run_number
+        run.start_dt = start_dt
+        run.duration_secs = duration_secs
+        run.outcome = outcome
+        run.error = error
+        s.add(run)
+
+    def summary(self) -> Dict[str, float]:
+        durations = [duration for _, duration, outcome in self.runs if outcome == "ok"]
+        failed = sum(1 for _, _, outcome in self.runs if outcome != "ok")
+        return {"runs": len(self.runs),
+                "p50": percentile(durations, 50),
+                "p95": percentile(durations, 95),
+                "max": max(durations, default=0.0),
+                "error_rate": failed / len(self.runs) if self.runs else 0.0}
@@ -12,4 +12,8 @@ from models.reddit_models.submittedpost import SubmittedPost  # noqa: F401
 from models.reddit_models.trackedauthor import TrackedAuthor  # noqa: F401
 from models.reddit_models.trackedsubreddit import TrackedSubreddit
 from models.reddit_models.redditinterface import RedditInterface  # noqa: F401
-from models.reddit_models.task import Task
\ No newline at end of file
+from models.reddit_models.task import Task
+from models.reddit_models.taskrun import TaskRun  # noqa: F401
+from models.reddit_models.shardlease import ShardLease, ShardNode  # noqa: F401
+from models.reddit_models.reviewcheckpoint import ReviewCheckpoint  # noqa: F401
+from models.reddit_models.ingestmark import IngestMark  # noqa: F401
\ No newline at end of file
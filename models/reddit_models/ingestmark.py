@@ -0,0 +1,14 @@
+from core import dbobj
+from sqlalchemy import Column, DateTime, String
+
+
+# High-water mark of new-post ingestion: every post of the subreddit created before seen_until (utc) has been
+# pulled, so check_new_submissions can stop paging there
+class IngestMark(dbobj.Base):
+    __tablename__ = 'IngestMarks'
+    subreddit_name = Column(String(191), nullable=False, primary_key=True)
+    seen_until = Column(DateTime, nullable=False)
+
+    def __init__(self, subreddit_name, seen_until):
+        self.subreddit_name = subreddit_name
+        self.seen_until = seen_until
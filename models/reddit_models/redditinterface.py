@@ -6,7 +6,7 @@ import praw
 import yaml
 import prawcore
 from logger import logger
-from enums import SubStatus, PostedStatus, CountedStatus
+from enums import SubStatus, PostedStatus, CountedStatus, ApiPriority
 
 
 from models.reddit_models import SubmittedPost, TrackedSubreddit, TrackedAuthor
@@ -15,18 +15,38 @@ from settings import MAIN_BOT_NAME
 from typing import List
 from datetime import datetime
 from static import DEFAULT_CONFIG
+from ratelimiting import MeteredRequestor, TokenBucket, with_api_priority
+from postedstatuscache import posted_statuses
 import pytz
+import time
 # Set up PRAW
 
 
+def removed_status(banned_by, bot_name) -> PostedStatus:
+    # posted status of a post removed by banned_by (True -> reddit's spam filter)
+    if banned_by is True:
+        return PostedStatus.SPAM_FLT
+    elif banned_by == "AutoModerator":
+        return PostedStatus.AUTOMOD_RM
+    elif banned_by == "Flair_Helper":
+        return PostedStatus.FH_RM
+    elif banned_by in (bot_name, MAIN_BOT_NAME):
+        return PostedStatus.MHB_RM
+    elif "bot" in banned_by.lower():
+        return PostedStatus.BOT_RM
+    else:
+        return PostedStatus.MOD_RM
+
+
 class RedditInterface:
     bot_sub = None
     reddit_client = None
     bot_name = None
 
-    def __init__(self):
-        self.reddit_client = praw.Reddit(
-                                    )
+    def __init__(self, api_budget: TokenBucket = None):
+        # api_budget: calls/minute shared by everything using this interface (e.g. one lane)
+        self.reddit_client = praw.Reddit(requestor_class=MeteredRequestor,
+                                         requestor_kwargs={"api_budget": api_budget})
         self.bot_name = self.reddit_client.user.me().name
 
     '''SUBMISSION STUFF'''
@@ -70,6 +90,17 @@ class RedditInterface:
 
 
     def get_posted_status(self, submission: SubmittedPost, get_removed_info=False) -> PostedStatus:
+        # also sets banned_by and the flairs; fetched at most once per posted_statuses.ttl_secs
+        entry = posted_statuses.get(submission.id, removed_info=get_removed_info)
+        if entry:
+            return entry.apply(submission)
+        fetched_at = time.monotonic()
+        posted_status = self.fetch_posted_status(submission, get_removed_info=get_removed_info)
+        if posted_status != PostedStatus.UNKNOWN:
+            posted_statuses.put(submission, posted_status, removed_info=get_removed_info, fetched_at=fetched_at)
+        return posted_status
+
+    def fetch_posted_status(self, submission: SubmittedPost, get_removed_info=False) -> PostedStatus:
         print(f'getting posted status...  current status:{submission.posted_status}')
         # _ = submission.get_api_handle()  what was this for again?
         post_api_handle = self.get_submission_api_handle(submission)  # updates the api handle
@@ -78,6 +109,8 @@ class RedditInterface:
         except prawcore.exceptions.Forbidden:
             return PostedStatus.UNKNOWN
         submission.banned_by = submission.api_handle.banned_by
+        submission.post_flair = post_api_handle.link_flair_text
+        submission.author_flair = post_api_handle.author_flair_text
         if not submission.banned_by and not submission.self_deleted:
             return PostedStatus.UP
         elif submission.banned_by:
@@ -89,22 +122,47 @@ class RedditInterface:
                     if hasattr(c, 'author') and c.author and c.author.name == submission.banned_by:
                         submission.bot_comment_id = c.id
                         break
-            if submission.banned_by == "AutoModerator":
-                return PostedStatus.AUTOMOD_RM
-            elif submission.banned_by == "Flair_Helper":
-                return PostedStatus.FH_RM
-            elif submission.banned_by in (self.bot_name, MAIN_BOT_NAME):
-                return PostedStatus.MHB_RM
-            elif "bot" in submission.banned_by.lower():
-                return PostedStatus.BOT_RM
-            else:
-                return PostedStatus.MOD_RM
+            return removed_status(submission.banned_by, self.bot_name)
         elif submission.self_deleted:
             return PostedStatus.SELF_DEL
         else:
             print(f"unknown status: {submission.banned_by}")
             return PostedStatus.UNKNOWN
 
+    def refresh_posted_statuses(self, submissions: List[SubmittedPost]) -> int:
+        # update_posted_status for many posts: 100 per info() request, taken from the listing data (SubmissionInfo).
+        # Changes are made on the objects, saved with the caller's flush/commit.  -> number of posts refreshed
+        by_fullname = {f"t3_{submission.id}": submission for submission in submissions}
+        fullnames = list(by_fullname)
+        now = datetime.now(pytz.utc)
+        refreshed = 0
+        for i in range(0, len(fullnames), 100):
+            fetched_at = time.monotonic()
+            try:
+                api_posts = list(self.reddit_client.info(fullnames=fullnames[i:i + 100]))
+            except prawcore.exceptions.Forbidden:
+                continue
+            for api_post in api_posts:
+                submission = by_fullname.get(api_post.fullname)
+                if not submission:
+                    continue
+                subm_info = SubmissionInfo(api_post)
+                submission.self_deleted = subm_info.author == "None"
+                submission.banned_by = subm_info.banned_by
+                if not submission.banned_by and not submission.self_deleted:
+                    submission.posted_status = PostedStatus.UP.value
+                elif submission.banned_by:
+                    submission.posted_status = removed_status(submission.banned_by, self.bot_name).value
+                else:
+                    submission.posted_status = PostedStatus.SELF_DEL.value
+                submission.post_flair = subm_info.post_flair
+                submission.author_flair = subm_info.author_flair
+                submission.last_checked = now
+                posted_statuses.put(submission, PostedStatus(submission.posted_status), fetched_at=fetched_at)
+                refreshed += 1
+        return refreshed
+
+    @with_api_priority(ApiPriority.HIGH)
     def mod_remove(self, submission: SubmittedPost) -> bool:
         _ = self.get_submission_api_handle(submission)  # updates the api handle
         try:
@@ -116,7 +174,10 @@ class RedditInterface:
         except (prawcore.exceptions.Forbidden, prawcore.exceptions.ServerError):
             logger.warning(f'I was not allowed to remove the post: http://redd.it/{submission.id}')
             return False
+        finally:
+            posted_statuses.invalidate(submission.id)  # after the call, so no one caches the status from before it
 
+    @with_api_priority(ApiPriority.HIGH)
     def reply(self, submission, response, distinguish=True, approve=False, lock_thread=True):
         _ = self.get_submission_api_handle(submission)  # updates the api handle
         try:
@@ -172,6 +233,7 @@ class RedditInterface:
             if initiating_author_name == self.bot_name and convo.id !="11ejht":
                 return convo.id
 
+    @with_api_priority(ApiPriority.HIGH)
     def send_modmail(self, subreddit=None, subreddit_name=None, subject=None, body = "Unspecified text",
                      thread_id=None, use_same_thread=False):
         conversation = None
@@ -215,6 +277,7 @@ class RedditInterface:
 
 
 
+    @with_api_priority(ApiPriority.HIGH)
     def send_message(self, redditor, subject, message):
         if isinstance(redditor, str):
             redditor = self.reddit_client.redditor(redditor)
@@ -238,34 +301,40 @@ class RedditInterface:
 
 
 
+# Snapshot of a submission taken from the listing JSON praw already has - reads the loaded attributes directly, so
+# it never triggers a lazy fetch, and holds no reference to the praw object.  SubmittedPost is built from it.
 class SubmissionInfo:
+    __slots__ = ('id', 'title', 'submission_text', 'time_utc', 'subreddit_name', 'is_self', 'is_oc', 'author',
+                 'banned_by', 'post_flair', 'author_flair')
+
     def __init__(self, submission):
-        subm_api_handle = None
+        data = vars(submission)  # what came with the listing; getattr would fetch anything missing
         # static
-        self.id = submission.id
-        self.title = submission.title[0:190]
-        self.submission_text = submission.selftext[0:190]
-        self.time_utc = datetime.utcfromtimestamp(submission.created_utc)
-        self.subreddit_name = str(submission.subreddit).lower()
-        self.is_self = submission.is_self
+        self.id = data['id']
+        self.title = (data.get('title') or "")[0:190]
+        self.submission_text = (data.get('selftext') or "")[0:190]
+        self.time_utc = datetime.utcfromtimestamp(data['created_utc'])
+        self.subreddit_name = str(data.get('subreddit')).lower()
+        self.is_self = data.get('is_self')
         # self.is_nsfw = submission.over18
-        self.is_oc = submission.is_original_content
+        self.is_oc = bool(data.get('is_original_content'))
 
         # may change
-        self.author = str(submission.author)  # don't change once deleted
-        self.banned_by = submission.banned_by
-        self.post_flair = submission.link_flair_text
-        self.author_flair = submission.author_flair_text
-        # self.author_css = submission.author_flair_css_class
-
+        self.author = str(data.get('author'))  # don't change once deleted
+        self.banned_by = None
+        self.post_flair = None
+        self.author_flair = None
+        self.update(submission)
 
     def update(self, submission):
+        data = vars(submission)
         # self.author = str(submission.author)
-        self.banned_by = submission.banned_by
-        self.post_flair = submission.link_flair_text
-        self.author_flair = submission.author_flair_text
+        self.banned_by = data.get('banned_by')
+        self.post_flair = data.get('link_flair_text')
+        self.author_flair = data.get('author_flair_text')
         # self.author_css = submission.author_flair_css_class
 
+
 class SubredditInfo:
     subreddit_api_handle = None
     active_status_enum = SubStatus.UNKNOWN
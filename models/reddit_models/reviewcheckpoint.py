@@ -0,0 +1,25 @@
+import json
+from datetime import datetime
+
+from core import dbobj
+from sqlalchemy import Column, DateTime, Integer, String, UnicodeText
+
+
+# Pending posting groups of an interrupted look_for_rule_violations3 pass and how far it got, so the next run picks
+# up there instead of redoing the GROUP_CONCAT query
+class ReviewCheckpoint(dbobj.Base):
+    __tablename__ = 'ReviewCheckpoints'
+    name = Column(String(191), nullable=False, primary_key=True)
+    created_at = Column(DateTime, nullable=False)
+    next_index = Column(Integer, nullable=False)
+    groups = Column(UnicodeText, nullable=False)  # json: [[latest_post_id, author_name, subreddit_name, [post ids]]]
+
+    def __init__(self, name, posting_groups):
+        self.name = name
+        self.created_at = datetime.now()
+        self.next_index = 0
+        self.groups = json.dumps([[pg.latest_post_id, pg.author_name, pg.subreddit_name,
+                                   [post.id for post in pg.posts if post]] for pg in posting_groups])
+
+    def group_specs(self):
+        return json.loads(self.groups)
@@ -0,0 +1,27 @@
+from core import dbobj
+from sqlalchemy import Column, DateTime, Integer, String
+
+
+# Subreddits are split into partitions by name hash; a bot process handles the partitions it holds a live lease on.
+# See sharding.ShardLeases.
+class ShardLease(dbobj.Base):
+    __tablename__ = 'ShardLeases'
+    partition = Column(Integer, nullable=False, primary_key=True, autoincrement=False)
+    owner = Column(String(191), nullable=True)
+    expires_at = Column(DateTime, nullable=True)
+
+    def __init__(self, partition):
+        self.partition = partition
+        self.owner = None
+        self.expires_at = None
+
+
+# Heartbeat of each bot process, used to work out a fair share of partitions
+class ShardNode(dbobj.Base):
+    __tablename__ = 'ShardNodes'
+    node_id = Column(String(191), nullable=False, primary_key=True)
+    last_seen = Column(DateTime, nullable=False)
+
+    def __init__(self, node_id, last_seen):
+        self.node_id = node_id
+        self.last_seen = last_seen
@@ -9,7 +9,6 @@ from praw.models import Submission
 from sqlalchemy import Boolean, Column, DateTime, Integer, String, UnicodeText
 from enums import CountedStatus, PostedStatus
 from sqlalchemy import Enum
-# from models.reddit_models.redditinterface import SubmissionInfo
 
 s = dbobj.s
 
@@ -58,64 +57,67 @@ class SubmittedPost(dbobj.Base):  # need posted_status
     api_handle = None
 
     def __init__(self, submission, save_text: bool = False):
-        self.nsfw_last_checked = datetime.now(pytz.utc)
+        # submission: a praw Submission from a listing, or a SubmissionInfo.  Only the snapshot's fields are kept -
+        # api_handle is set on demand (RedditInterface.get_submission_api_handle) when the post is acted on
+        from models.reddit_models.redditinterface import SubmissionInfo
+
+        subm_info = SubmissionInfo(submission) if isinstance(submission, Submission) else submission
+        self.id = subm_info.id
+        self.title = subm_info.title
+        self.author = subm_info.author
+        self.submission_text = subm_info.submission_text if save_text else None
+        self.time_utc = subm_info.time_utc
+        self.subreddit_name = subm_info.subreddit_name
+        self.added_time = datetime.now(pytz.utc)
+        self.last_reviewed = datetime.now(pytz.utc)
         self.last_checked = datetime.now(pytz.utc)
         self.flushed_to_log = False
-        if isinstance(submission, Submission):
-
-            self.id = submission.id
-            self.title = submission.title[0:190]
-            self.author = str(submission.author)
-            if save_text:
-                self.submission_text = submission.selftext[0:190]
-            self.time_utc = datetime.utcfromtimestamp(submission.created_utc)
-            self.subreddit_name = str(submission.subreddit).lower()
-            self.added_time = datetime.now(pytz.utc)
-            self.last_reviewed = datetime.now(pytz.utc)
-            self.flagged_duplicate = False
-            self.reviewed = False
-            self.banned_by = None
-            self.api_handle = submission
-            self.pre_duplicate = False
-            self.self_deleted = False
-            self.is_self = submission.is_self
-            self.counted_status = CountedStatus.NOT_CHKD.value
-            self.counted_status_enum = CountedStatus.NOT_CHKD
-            self.post_flair = submission.link_flair_text
-            self.author_flair = submission.author_flair_text
-            # self.author_css = submission.author_flair_css_class
-            self.response_time = None
-            self.nsfw_last_checked = self.time_utc
-            self.nsfw_repliers_checked = False
-            self.posted_status = PostedStatus.UNKNOWN.value
-            self.is_oc = submission.is_original_content
-        else:
-            subm_info = submission
-
-            self.id = subm_info.id
-            self.title = subm_info.title
-            self.submission_text = None
-            self.subreddit_name = subm_info.subreddit_name
-            self.added_time = datetime.now(pytz.utc)
-            self.last_reviewed = datetime.now(pytz.utc)
-            self.flagged_duplicate = False
-            self.reviewed = False
-            self.banned_by = subm_info.banned_by
-            self.api_handle = None
-            self.pre_duplicate = False
-            self.self_deleted = False
-            self.is_self = subm_info.is_self
-            self.counted_status = -1  # CountedStatus.NOT_CHKD.value
-            self.counted_status_enum = CountedStatus.NOT_CHKD
-            self.post_flair = subm_info.post_flair
-            self.author_flair = subm_info.author_flair
-            # self.author_css = subm_info.author_css
-            self.response_time = None
-            self.nsfw_last_checked = self.time_utc
-            self.nsfw_repliers_checked = False
-            self.posted_status = PostedStatus.UNKNOWN.value
-            self.is_oc = subm_info.is_oc
-
+        self.flagged_duplicate = False
+        self.reviewed = False
+        self.banned_by = None  # set by RedditInterface.update_posted_status
+        self.api_handle = None
+        self.pre_duplicate = False
+        self.self_deleted = False
+        self.is_self = subm_info.is_self
+        self.counted_status = CountedStatus.NOT_CHKD.value
+        self.counted_status_enum = CountedStatus.NOT_CHKD
+        self.post_flair = subm_info.post_flair
+        self.author_flair = subm_info.author_flair
+        # self.author_css = subm_info.author_css
+        self.response_time = None
+        self.nsfw_last_checked = self.time_utc
+        self.nsfw_repliers_checked = False
+        self.posted_status = PostedStatus.UNKNOWN.value
+        self.is_oc = subm_info.is_oc
+
+    def as_row(self) -> dict:
+        return {column.key: getattr(self, column.key) for column in self.__table__.columns}
+
+    @classmethod
+    def bulk_insert(cls, s, posts) -> list:
+        # Multi-row INSERT of new (transient) posts, leaving rows that are already there alone.  Returns the ids it
+        # inserted.  Posts are normally pre-filtered (knownposts), so a batch is tried as a plain INSERT first: if it
+        # goes through, all of it is new and that is the only round trip.  A batch that hits a duplicate is rolled
+        # back to its savepoint and sent again without the ids that are in the table.  Callers hold posts.ingest
+        # (scheduler.TASK_RESOURCES) and other bot processes take other subreddits (sharding), so no other insert of
+        # the same posts can come between that select and the insert.
+        from sqlalchemy import exc, insert
+
+        rows = list({post.id: post.as_row() for post in posts}.values())
+        inserted_ids = []
+        for i in range(0, len(rows), 500):
+            batch = rows[i:i + 500]
+            try:
+                with s.begin_nested():
+                    s.execute(insert(cls.__table__).values(batch))
+            except exc.IntegrityError:
+                batch_ids = [row["id"] for row in batch]
+                existing = {row[0] for row in s.query(cls.id).filter(cls.id.in_(batch_ids)).all()}
+                batch = [row for row in batch if row["id"] not in existing]
+                if batch:
+                    s.execute(insert(cls.__table__).values(batch))
+            inserted_ids += [row["id"] for row in batch]
+        return inserted_ids
 
     def get_url(self) -> str:
         return f"http://redd.it/{self.id}"
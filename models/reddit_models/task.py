@@ -2,7 +2,12 @@ from datetime import datetime, timedelta
 import prawcore
 from core import dbobj
 from sqlalchemy import Boolean, Column, DateTime, Integer, String, UnicodeText
+from sqlalchemy.orm import object_session
 from logger import logger as log
+from metrics import TaskMetrics
+
+ADAPT_FACTOR = 4  # an adapted frequency is at most this many times faster or slower than the configured one
+
 
 class Task(dbobj.Base):
     __tablename__ = 'Tasks2'
@@ -13,14 +18,19 @@ class Task(dbobj.Base):
     frequency_secs = Column(Integer, nullable=False)
     max_duration_secs = Column(Integer, nullable=True)
     last_error = Column(UnicodeText, nullable=True)
+    # ALTER TABLE `Tasks2` ADD `lock_owner` VARCHAR(191) NULL, ADD `lock_expires_at` DATETIME NULL;
+    lock_owner = Column(String(191), nullable=True)  # clusterlocks.TaskLocks
+    lock_expires_at = Column(DateTime, nullable=True)
     # time out?
 
     #target_function = None
     # last_run_dt = None
     # frequency_secs = timedelta(minutes=5)
     # max_duration = timedelta(minutes=5)
-    task_durations = []
     error_count = 0
+    metrics = None  # TaskMetrics, loaded on first run
+    not_before = None  # skipped because another process runs it -> not due again before this
+    adapted_secs = None  # frequency picked by adapt_frequency; in memory only, frequency_secs stays as configured
     # last_error = ""
 
     def __init__(self, wd,  target_function,  frequency: timedelta):
@@ -32,7 +42,42 @@ class Task(dbobj.Base):
         self.max_duration_secs = 0
         self.last_run_dt = None
         self.last_error = None
+        self.lock_owner = None
+        self.lock_expires_at = None
+
+    def next_due_dt(self) -> datetime:
+        if not self.last_run_dt:
+            return max(datetime.now(), self.not_before) if self.not_before else datetime.now()
+        next_due = self.last_run_dt + timedelta(seconds=self.current_frequency_secs())
+        if self.error_count > 5:
+            # had multiple errors -> wait at least five hours after last run
+            next_due = max(next_due, self.last_run_dt + timedelta(hours=5))
+        if self.not_before:
+            next_due = max(next_due, self.not_before)
+        return next_due
+
+    def current_frequency_secs(self):
+        return self.adapted_secs or self.frequency_secs
+
+    def adapt_frequency(self, load, min_secs, max_secs):
+        # found work -> come back twice as soon; found nothing -> back off by a quarter.  Stays within min_secs and
+        # max_secs, and within ADAPT_FACTOR of the configured frequency either way
+        lowest = max(min_secs, self.frequency_secs / ADAPT_FACTOR)
+        highest = max(lowest, min(max_secs, self.frequency_secs * ADAPT_FACTOR))
+        current_secs = self.current_frequency_secs()
+        frequency_secs = current_secs / 2 if load else current_secs * 1.25 + 1
+        frequency_secs = int(min(highest, max(lowest, frequency_secs)))
+        if frequency_secs != current_secs:
+            log.debug(f"{self.target_function}: load {load}, frequency {current_secs}s -> {frequency_secs}s "
+                      f"(configured {self.frequency_secs}s)")
+            self.adapted_secs = frequency_secs
 
+    def record_run(self, start_time: datetime, end_time: datetime, outcome="ok", error=None):
+        # kept in the TaskRuns table, written with this task's session
+        s = object_session(self)
+        if self.metrics is None:
+            self.metrics = TaskMetrics.load(s, self.target_function)
+        self.metrics.record(s, start_time, (end_time - start_time).total_seconds(), outcome, error=error)
 
 
         """
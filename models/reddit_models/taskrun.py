@@ -0,0 +1,19 @@
+from core import dbobj
+from sqlalchemy import Column, DateTime, Float, Integer, String, UnicodeText
+
+
+# Ring buffer of recent runs per task: run N goes in slot N % size, so the table stays bounded and the history
+# survives restarts.  See metrics.TaskMetrics.
+class TaskRun(dbobj.Base):
+    __tablename__ = 'TaskRuns'
+    target_function = Column(String(191), nullable=False, primary_key=True)
+    slot = Column(Integer, nullable=False, primary_key=True)
+    run_number = Column(Integer, nullable=False)
+    start_dt = Column(DateTime, nullable=False)
+    duration_secs = Column(Float, nullable=False)
+    outcome = Column(String(20), nullable=False)  # ok, error, rate_limited
+    error = Column(UnicodeText, nullable=True)
+
+    def __init__(self, target_function, slot):
+        self.target_function = target_function
+        self.slot = slot
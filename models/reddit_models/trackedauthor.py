@@ -12,6 +12,9 @@ from praw.models import ListingGenerator, Submission
 from praw.models.listing.mixins.redditor import SubListing
 from sqlalchemy import Column, DateTime, Integer, String, UnicodeText
 
+from enums import ApiPriority
+from ratelimiting import with_api_priority
+
 
 def get_age(input_text):
     matches = re.search(ASL_REGEX, input_text)
@@ -62,6 +65,7 @@ class TrackedAuthor(dbobj.Base):
 
 
 
+    @with_api_priority(ApiPriority.BACKGROUND)
     def calculate_nsfw(self, wd, instaban_subs=None):
         if self.author_name and  self.author_name.lower() == "automoderator":
             self.nsfw_pct=0
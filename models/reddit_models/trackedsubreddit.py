@@ -332,7 +332,7 @@ class TrackedSubreddit(dbobj.Base):
         if author_name.startswith('u/'):
             author_name = author_name.replace("u/", "")
 
-        recent_posts = s.query(SubmittedPost).filter(
+        recent_posts = wd.s.query(SubmittedPost).filter(
             SubmittedPost.subreddit_name.ilike(self.subreddit_name),
             SubmittedPost.author == author_name,
             SubmittedPost.time_utc > datetime.now(pytz.utc) - timedelta(days=182)).all()
@@ -355,7 +355,8 @@ class TrackedSubreddit(dbobj.Base):
                               f"per {self.min_post_interval_txt}")
         return "".join(response_lines)
 
-    def get_sub_stats(self) -> str:
+    def get_sub_stats(self, wd=None) -> str:
+        s = wd.s if wd else dbobj.s
         total_reviewed = s.query(SubmittedPost) \
             .filter(SubmittedPost.subreddit_name.ilike(self.subreddit_name)) \
             .count()
@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set
+
+import prawcore
+import pytz
+from sqlalchemy import func
+
+from enums import PostedStatus
+from logger import logger as log
+from models.reddit_models import SubmittedPost
+from models.reddit_models.redditinterface import removed_status
+from postedstatuscache import posted_statuses
+
+# mod log actions that change a post's posted status
+MOD_LOG_ACTIONS = ('removelink', 'spamlink', 'approvelink')
+NO_ACCESS_RETRY_SECS = 3600  # a subreddit whose mod log the bot may not read is left out of chunk reads this long
+RECHECK_HRS = 3  # how long posted_status_stale trusts a status - listed posts marked up in that time are re-checked
+
+
+# Keeps RedditPost.posted_status / banned_by up to date from the subreddits' mod logs, read per listing chunk along
+# with the new and spam listings, so reviews don't have to fetch each post to see whether it was removed.  One
+# unfiltered log read per chunk, the post removals/approvals picked out here.  Remembers how far each subreddit's log
+# has been read, so re-chunking doesn't re-read anything; a subreddit's log is only followed from the time it is
+# first seen - replaying older entries could undo what later posted status checks found.
+# A subreddit is followed only while every read of its log went back far enough: a read cut off at max_read leaves
+# the subreddits it didn't reach where they were (read again next time) and unfollowed, and a chunk refused with
+# Forbidden is read again one subreddit at a time, leaving out the one without access.  Posts of unfollowed
+# subreddits are listed with an unknown status, so reviews fetch it.
+# Self-deletions are not in the mod log - those are still found by the periodic posted status check.
+class ModLogTracker:
+
+    def __init__(self, max_read: int = 500):
+        self.max_read = max_read
+        self.seen_until: Dict[str, float] = {}  # subreddit_name: created_utc of the newest entry read
+        self.followed: Set[str] = set()  # subreddits ('mod': all of them) whose log was read up to seen_until
+        self.unfollowed: Set[str] = set()  # were followed until a read fell short - their listed posts are re-checked
+        self.no_access: Dict[str, float] = {}  # subreddit_name: time.time() it is read again after a Forbidden
+        self.lock = threading.Lock()
+
+    def follows(self, subreddit_name: str) -> bool:
+        with self.lock:
+            return subreddit_name.lower() in self.followed or 'mod' in self.followed
+
+    def read(self, ri, sub_list: str) -> list:
+        # -> the chunk's post removal/approval entries since the last read, newest first.  Reddit api only
+        now = time.time()
+        with self.lock:
+            sub_names = [subreddit_name.lower() for subreddit_name in sub_list.split('+')
+                         if self.no_access.get(subreddit_name.lower(), 0) <= now]
+            for subreddit_name in sub_names:
+                self.seen_until.setdefault(subreddit_name, now)
+            since = dict(self.seen_until)
+        if not sub_names:
+            return []
+        try:
+            return self._read(ri, sub_names, since, now)
+        except prawcore.exceptions.Forbidden:  # no mod log access in one of the subs
+            if len(sub_names) > 1:
+                entries = [entry for subreddit_name in sub_names for entry in self.read(ri, subreddit_name)]
+                entries.sort(key=lambda entry: entry.created_utc, reverse=True)
+                return entries
+            log.warning(f"mod log: no access to {sub_names[0]}, left out for {NO_ACCESS_RETRY_SECS}s")
+            with self.lock:
+                self.no_access[sub_names[0]] = now + NO_ACCESS_RETRY_SECS
+                self._unfollow(sub_names[0])
+            return []
+
+    def _read(self, ri, sub_names: List[str], since: Dict[str, float], now: float) -> list:
+        oldest = min(since[subreddit_name] for subreddit_name in sub_names)
+        # sub_list 'mod' (all modded subreddits): subreddits not seen before are followed from the first 'mod' read
+        all_subs = sub_names == ['mod']
+        first_seen = since['mod'] if all_subs else now
+
+        entries = []
+        newest: Dict[str, float] = {}
+        read_count = 0
+        covered_from = 0.0  # the read saw every entry newer than this
+        for entry in ri.reddit_client.subreddit("+".join(sub_names)).mod.log(limit=self.max_read):
+            read_count += 1
+            if entry.created_utc <= oldest:
+                break
+            if read_count >= self.max_read:  # cut off before reaching oldest
+                covered_from = entry.created_utc
+            subreddit_name = str(entry.subreddit).lower()
+            if entry.created_utc <= since.setdefault(subreddit_name, first_seen):
+                continue
+            newest[subreddit_name] = max(newest.get(subreddit_name, 0), entry.created_utc)
+            if all_subs:
+                newest['mod'] = max(newest.get('mod', 0), entry.created_utc)
+            if entry.action in MOD_LOG_ACTIONS:
+                entries.append(entry)
+        with self.lock:
+            for subreddit_name in set(sub_names) | set(newest):
+                since_utc = since[subreddit_name]
+                if since_utc < covered_from:  # may have missed entries - read from since_utc again next time
+                    self._unfollow(subreddit_name)
+                    continue
+                self.seen_until[subreddit_name] = max(self.seen_until.get(subreddit_name, 0),
+                                                      newest.get(subreddit_name, since_utc))
+                if subreddit_name in sub_names:  # under 'mod', a subreddit without entries this time isn't known
+                    self.followed.add(subreddit_name)
+        if covered_from:
+            log.debug(f"mod log: read of {'+'.join(sub_names)} cut off at {self.max_read} entries")
+        entries.sort(key=lambda entry: entry.created_utc, reverse=True)
+        return entries
+
+    def _unfollow(self, subreddit_name: str):
+        # lock held
+        if subreddit_name in self.followed:
+            self.followed.discard(subreddit_name)
+            self.unfollowed.add(subreddit_name)
+
+    def apply(self, wd, entries: list) -> int:
+        # one UPDATE per (posted_status, banned_by) for the posts' latest entries; saved with the caller's commit
+        self.recheck_unfollowed(wd)
+        latest = {}
+        for entry in entries:
+            target = getattr(entry, 'target_fullname', None)
+            if target and target.startswith('t3_'):
+                latest.setdefault(target[3:], entry)
+
+        post_ids_by_status = defaultdict(list)
+        for post_id, entry in latest.items():
+            posted_statuses.invalidate(post_id)
+            if entry.action == 'approvelink':
+                post_ids_by_status[(PostedStatus.UP.value, None)].append(post_id)
+            else:
+                banned_by = str(entry.mod)
+                post_ids_by_status[(removed_status(banned_by, wd.bot_name).value, banned_by)].append(post_id)
+
+        now = datetime.now(pytz.utc)
+        count = 0
+        for (posted_status, banned_by), post_ids in post_ids_by_status.items():
+            count += wd.s.query(SubmittedPost).filter(SubmittedPost.id.in_(post_ids)) \
+                .update({SubmittedPost.posted_status: posted_status, SubmittedPost.banned_by: banned_by,
+                         SubmittedPost.last_checked: now}, synchronize_session=False)
+        if count:
+            log.debug(f"mod log: updated posted status of {count} posts")
+        return count
+
+    def recheck_unfollowed(self, wd) -> int:
+        # posts listed as up in subreddits whose log has since been missed go back to unknown, so reviews fetch them
+        with self.lock:
+            unfollowed, self.unfollowed = self.unfollowed, set()
+        if not unfollowed:
+            return 0
+        query = wd.s.query(SubmittedPost).filter(
+            SubmittedPost.posted_status == PostedStatus.UP.value,
+            SubmittedPost.last_checked > datetime.now(pytz.utc).replace(tzinfo=None) - timedelta(hours=RECHECK_HRS))
+        if 'mod' not in unfollowed:
+            query = query.filter(func.lower(SubmittedPost.subreddit_name).in_(unfollowed))
+        count = query.update({SubmittedPost.posted_status: PostedStatus.UNKNOWN.value}, synchronize_session=False)
+        log.info(f"mod log: lost track of {', '.join(sorted(unfollowed))}, {count} posts to re-check")
+        return count
+
+    def track(self, wd, sub_list: str) -> int:
+        return self.apply(wd, self.read(wd.ri, sub_list))
+
+
+def listing_post(wd, post_to_review) -> SubmittedPost:
+    # a post from a new listing.  With the subreddit's mod log followed, a post that is up when listed is taken as
+    # up - later removals and approvals come from the log
+    post = SubmittedPost(post_to_review)
+    if wd.mod_log and wd.mod_log.follows(post.subreddit_name) and post.author != "None" \
+            and not vars(post_to_review).get('banned_by'):
+        post.posted_status = PostedStatus.UP.value
+    return post
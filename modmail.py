@@ -14,9 +14,16 @@ from utils import check_spam_submissions
 from utils import get_subreddit_by_name
 from workingdata import WorkingData
 from models.reddit_models.loggedactions import open_logged_action
+from postedstatuscache import posted_statuses
+from enums import ApiPriority
+from ratelimiting import api_priority
+from scheduler import COMMAND_RESOURCES
 from typing import Optional
 from sqlalchemy import or_
 
+MODMAIL_CHUNK_SIZE = 50  # subreddits per modmail listing request
+MODMAIL_UNREAD_LIMIT = 100  # unread conversations per chunk and pass - the rest come up on the next pass
+
 def handle_dm_command(wd: WorkingData, subreddit_name: str, requestor_name, command, parameters) \
         -> tuple[str, bool]:
     subreddit_name: str = subreddit_name[2:] if subreddit_name.startswith('r/') else subreddit_name
@@ -136,7 +143,7 @@ def handle_dm_command(wd: WorkingData, subreddit_name: str, requestor_name, comm
             lines.append("{}: {}".format(count + 1, rule['short_name']))
         return "\n\n".join(lines), True
     elif command == "stats":
-        return tr_sub.get_sub_stats(), True
+        return tr_sub.get_sub_stats(wd), True
     elif command == "approve":
         submission_id = parameters[0] if parameters else None
         if not submission_id:
@@ -144,7 +151,9 @@ def handle_dm_command(wd: WorkingData, subreddit_name: str, requestor_name, comm
         submission = wd.ri.reddit_client.submission(submission_id)
         if not submission:
             return "Cannot find that submission", True
-        submission.mod.approve()
+        with api_priority(ApiPriority.HIGH):
+            submission.mod.approve()
+        posted_statuses.invalidate(submission.id)
         return "Submission was approved.", False
     elif command == "remove":
         submission_id = parameters[0] if parameters else None
@@ -153,7 +162,9 @@ def handle_dm_command(wd: WorkingData, subreddit_name: str, requestor_name, comm
         submission = wd.ri.reddit_client.submission(submission_id)
         if not submission:
             return "Cannot find that submission", True
-        submission.mod.remove()
+        with api_priority(ApiPriority.HIGH):
+            submission.mod.remove()
+        posted_statuses.invalidate(submission.id)
         return "Submission was removed.", True
 
     elif command == "citerule" or command == "testciterule":
@@ -267,6 +278,8 @@ def handle_dm_command(wd: WorkingData, subreddit_name: str, requestor_name, comm
         wd.s.add(tr_sub)
         wd.s.commit()
         wd.to_update_list = True
+        if wd.scheduler:
+            wd.scheduler.wake('update_sub_list')
         return reply_text, True
     else:
         return "I did not understand that command", True
@@ -274,7 +287,9 @@ def handle_dm_command(wd: WorkingData, subreddit_name: str, requestor_name, comm
 
 def handle_direct_messages(wd: WorkingData):
     print("checking direct messages")
+    wd.report_load(0)
     for message in wd.ri.reddit_client.inbox.unread(limit=None):
+        wd.report_load(1)
         import pprint
         pprint.pprint(message)
 
@@ -283,6 +298,8 @@ def handle_direct_messages(wd: WorkingData):
         new_action = open_logged_action(wd, message.subject, 'dm', message.id)
         if not new_action.is_new:
             continue
+        if wd.lane_latency:
+            wd.lane_latency.record("response", datetime.now(timezone.utc).timestamp() - message.created_utc)
 
         # Get author name, message_id if available
         requestor_name = message.author.name if message.author else None
@@ -320,15 +337,19 @@ def handle_direct_messages(wd: WorkingData):
                 # record actioned first out of safety in case of error
                 record_actioned(wd, "ban_note: {0}".format(message.author))
 
-                tr_sub = TrackedSubreddit.get_subreddit_by_name(subreddit_name)
-                if tr_sub and tr_sub.modmail_posts_reply and message.author:
-                    try:
-                        message.reply(body=tr_sub.get_author_summary(wd, message.author.name))
-                    except (praw.exceptions.APIException, prawcore.exceptions.Forbidden):
-                        pass
+                with wd.holding(COMMAND_RESOURCES):
+                    tr_sub = TrackedSubreddit.get_subreddit_by_name(subreddit_name)
+                    if tr_sub and tr_sub.modmail_posts_reply and message.author:
+                        try:
+                            author_summary = tr_sub.get_author_summary(wd, message.author.name)
+                            with api_priority(ApiPriority.HIGH):
+                                message.reply(body=author_summary)
+                        except (praw.exceptions.APIException, prawcore.exceptions.Forbidden):
+                            pass
         # Respond to an invitation to moderate
         elif message_subject.startswith('invitation to moderate'):
-            mod_mail_invitation_to_moderate(wd, message)
+            with wd.holding(COMMAND_RESOURCES):
+                mod_mail_invitation_to_moderate(wd, message)
         elif command in ("summary", "update", "stats") or command.startswith("$"):
             subreddit_name = None
             thread_id = None
@@ -355,17 +376,20 @@ def handle_direct_messages(wd: WorkingData):
             if not subreddit_name or not subreddit_name.replace('_','').isalnum()  \
                     or '/' in subreddit_name or len(subreddit_name) > 21 or subreddit_name == "yoursubredditname":
                 message.mark_read()
-                message.reply(body=f"Sorry, I don''t think '{message_subject}' contains a valid subreddit?")
+                with api_priority(ApiPriority.HIGH):
+                    message.reply(body=f"Sorry, I don''t think '{message_subject}' contains a valid subreddit?")
                 continue
-            result: tuple[Optional[TrackedSubreddit], str] = get_subreddit_by_name(wd, subreddit_name)
-            tr_sub, response = result
-            if tr_sub:
-                response, _ = handle_dm_command(wd, subreddit_name, requestor_name, command, body_parts[1:])
+            with wd.holding(COMMAND_RESOURCES):
+                result: tuple[Optional[TrackedSubreddit], str] = get_subreddit_by_name(wd, subreddit_name)
+                tr_sub, response = result
+                if tr_sub:
+                    response, _ = handle_dm_command(wd, subreddit_name, requestor_name, command, body_parts[1:])
             if tr_sub and thread_id:
                 wd.ri.send_modmail(subreddit=tr_sub, body=response[:9999], thread_id=thread_id)
             else:
 
-                message.reply(body=response[:9999])
+                with api_priority(ApiPriority.HIGH):
+                    message.reply(body=response[:9999])
             bot_owner_message = f"subreddit: {subreddit_name}\n\n" \
                                 f"requestor: {requestor_name}\n\n" \
                                 f"command: {command}\n\n" \
@@ -383,11 +407,12 @@ def handle_direct_messages(wd: WorkingData):
                 # ignore profanity
                 if "fuck" in message.body:
                     continue
-                message.reply(body="Hi, thank you for messaging me! "
-                                   "I am a non-sentient bot, and I act only in the accordance of the rules set by the "
-                                   "moderators "
-                                   "of the subreddit. Unfortunately, I am unable to answer or direct requests. Please "
-                                   "see this [link](https://www.reddit.com/r/SolariaHues/comments/mz7zdp/)")
+                with api_priority(ApiPriority.HIGH):
+                    message.reply(body="Hi, thank you for messaging me! "
+                                       "I am a non-sentient bot, and I act only in the accordance of the rules set by "
+                                       "the moderators "
+                                       "of the subreddit. Unfortunately, I am unable to answer or direct requests. "
+                                       "Please see this [link](https://www.reddit.com/r/SolariaHues/comments/mz7zdp/)")
                 import pprint
 
                 # assume you have a Reddit instance bound to variable `reddit`
@@ -417,7 +442,8 @@ def mod_mail_invitation_to_moderate(wd: WorkingData, message):
         except (praw.exceptions.RedditAPIException, prawcore.exceptions.ServerError) as ex:  # Changed from praw.exceptions.APIException
             reply =  f"Message from reddit: {ex.message}"
             print(f"error reply {reply}")
-            message.reply(body=reply)
+            with api_priority(ApiPriority.HIGH):
+                message.reply(body=reply)
             message.mark_read()
 
         if not tr_sub:
@@ -425,11 +451,12 @@ def mod_mail_invitation_to_moderate(wd: WorkingData, message):
                                                                                    create_if_not_exist=False)
             tr_sub, req_status = result
 
-        message.reply(
-            body=f"Hi, thank you for inviting me!  I will start working now. Please make sure I have a config. "
-                 f"I will try to create one at https://www.reddit.com/r/{subreddit_name}/wiki/{wd.bot_name} . "
-                 f"You may need to create it. You can find examples at "
-                 f"https://www.reddit.com/r/{wd.bot_name}/wiki/index . ")
+        with api_priority(ApiPriority.HIGH):
+            message.reply(
+                body=f"Hi, thank you for inviting me!  I will start working now. Please make sure I have a config. "
+                     f"I will try to create one at https://www.reddit.com/r/{subreddit_name}/wiki/{wd.bot_name} . "
+                     f"You may need to create it. You can find examples at "
+                     f"https://www.reddit.com/r/{wd.bot_name}/wiki/index . ")
         try:
             sub_info = wd.ri.get_subreddit_info(tr_sub.subreddit_name)
             access_status = sub_info.check_sub_access(wd.ri, ignore_no_mod_access=True)
@@ -452,8 +479,9 @@ def mod_mail_invitation_to_moderate(wd: WorkingData, message):
             wd.s.add(tr_sub)
     else:
         try:
-            message.reply(body=f"Invitation received. Please wait for approval by bot owner. In the mean time, "
-                               f"you may create a config at https://www.reddit.com/r/{subreddit_name}/wiki/{wd.bot_name} .")
+            with api_priority(ApiPriority.HIGH):
+                message.reply(body=f"Invitation received. Please wait for approval by bot owner. In the mean time, "
+                                   f"you may create a config at https://www.reddit.com/r/{subreddit_name}/wiki/{wd.bot_name} .")
         except (praw.exceptions.RedditAPIException, prawcore.exceptions.ServerError) as ex:
             message.mark_read()
     message.mark_read()
@@ -485,6 +513,9 @@ def handle_modmail_message(wd: WorkingData, convo):
     new_action = open_logged_action(wd, subreddit_name, 'mm', f"{convo.id}-{convo.num_messages}")
     if not new_action.is_new:
         return
+    if wd.lane_latency:
+        wd.lane_latency.record("response",
+                               (datetime.now(timezone.utc) - iso8601.parse_date(convo.last_updated)).total_seconds())
 
     #ignore verification modmails
     if "verification" in convo.subject:
@@ -504,8 +535,9 @@ def handle_modmail_message(wd: WorkingData, convo):
     if initiating_author_name:
         subreddit_author: SubAuthor = wd.s.query(SubAuthor).get((subreddit_name, initiating_author_name))
         if subreddit_author and subreddit_author.currently_blacklisted:
-            convo.reply("This author is modmail-blacklisted", internal=True)
-            convo.archive()
+            with api_priority(ApiPriority.HIGH):
+                convo.reply("This author is modmail-blacklisted", internal=True)
+                convo.archive()
 
             return
 
@@ -545,7 +577,9 @@ def handle_modmail_message(wd: WorkingData, convo):
                     if not in_submission_urls and 'http' not in submission.selftext \
                             and submission.banned_by and submission.banned_by == "AutoModerator" \
                             and not any(bad_word in submission.selftext for bad_word in bad_words):
-                        submission.mod.approve()
+                        with api_priority(ApiPriority.HIGH):
+                            submission.mod.approve()
+                        posted_statuses.invalidate(submission.id)
                         response = "Since you contacted the mods this bot " \
                                    "has approved your post on a preliminary basis. " \
                                    " The subreddit moderators may override this decision, however\n\n Your text:\n\n>" \
@@ -561,8 +595,9 @@ def handle_modmail_message(wd: WorkingData, convo):
                 .filter(SubmittedPost.author == initiating_author_name).all()
             removal_reason = None
             # Check again if still no posts in database
-            if not recent_posts:
-                check_spam_submissions(wd, sub_list=subreddit_name)
+            if not recent_posts and not (wd.spam_queue and wd.spam_queue.fresh(subreddit_name)):
+                with wd.holding({'posts.ingest'}):
+                    check_spam_submissions(wd, sub_list=subreddit_name)
                 recent_posts: List[SubmittedPost] = wd.s.query(SubmittedPost) \
                     .filter(SubmittedPost.subreddit_name.ilike(subreddit_name)) \
                     .filter(SubmittedPost.author == initiating_author_name).all()
@@ -637,7 +672,8 @@ def handle_modmail_message(wd: WorkingData, convo):
                         if "status:mod-removed" not in non_internal_response \
                                 and "status: AutoMod-removed" not in non_internal_response:
                             # don't answer if not particularly helpful
-                            convo.reply(non_internal_response, internal=False)
+                            with api_priority(ApiPriority.HIGH):
+                                convo.reply(non_internal_response, internal=False)
                     smart_link = f"https://old.reddit.com/message/compose?to={wd.bot_name}" \
                                  f"&subject={subreddit_name}:{convo.id}" \
                                  f"&message="
@@ -697,7 +733,9 @@ def handle_modmail_message(wd: WorkingData, convo):
             """
     if response:
         try:
-            convo.reply(body=tr_sub.populate_tags2(response[0:9999], recent_post=last_post), internal=response_internal)
+            reply_body = tr_sub.populate_tags2(response[0:9999], recent_post=last_post)
+            with api_priority(ApiPriority.HIGH):
+                convo.reply(body=reply_body, internal=response_internal)
 
             bot_owner_message = f"subreddit: {subreddit_name}\n\nresponse:\n\n{response}\n\n" \
                                 f"https://mod.reddit.com/mail/all/{convo.id}"[0:9999]
@@ -715,37 +753,45 @@ def handle_modmail_message(wd: WorkingData, convo):
 
 def handle_modmail_messages(wd: WorkingData):
     print("checking modmail  0---")
-    import traceback
+    wd.report_load(0)
     # ALTER TABLE `TrackedSubs` ADD `modmail_access` TINYINT NOT NULL DEFAULT '-1' AFTER `config_last_checked`;
     sub_list1 = wd.s.query(TrackedSubreddit).filter(TrackedSubreddit.active_status=="ACTIVE")\
         .filter(or_(TrackedSubreddit.modmail_access==-1 , TrackedSubreddit.modmail_access==1) ).all()
-    sub_list=[]
-    for subreddit in sub_list1:
-        """
-        print(subreddit)
-        assert isinstance(subreddit, TrackedSubreddit)
-        sub_list.append(subreddit.subreddit_name)
-    chunk_size=20
-    chunked_list = [wd.sub_list[j:j + chunk_size] for j in range(0, len(sub_list), chunk_size)]
-
-    for sub_list in chunked_list:
-
-        sub_list_str = "+".join(sub_list)
-        print(sub_list_str)
-    """
+    sub_list = [subreddit for subreddit in sub_list1 if wd.handles(subreddit.subreddit_name)]  # not another shard's
+    chunked_list = [sub_list[j:j + MODMAIL_CHUNK_SIZE] for j in range(0, len(sub_list), MODMAIL_CHUNK_SIZE)]
 
-        print(f"checking modmail  0---1 {subreddit.subreddit_name} {subreddit.modmail_access}")
-        try:
-            for convo in wd.ri.reddit_client.subreddit(subreddit.subreddit_name).modmail.conversations(state="all", sort='unread', limit=15):
+    for chunk in chunked_list:
+        for convo in unread_conversations(wd, chunk):
+            print(f"message {convo.id}")
+            wd.report_load(1)
+            with wd.holding(COMMAND_RESOURCES):
+                handle_modmail_message(wd, convo=convo)
 
-                    print(f"message {convo.id}")
-                    handle_modmail_message(wd, convo=convo)
-        except (prawcore.exceptions.ServerError, prawcore.exceptions.Forbidden):
-            trace = traceback.format_exc()
-            print(trace)
-            subreddit.modmail_access =  0
-            wd.s.add(subreddit)
-            wd.s.commit()
+
+def unread_conversations(wd: WorkingData, sub_list: List[TrackedSubreddit]) -> list:
+    # the unread conversations of a chunk of subreddits, with one request rather than one per subreddit.  Sorted
+    # unread first, so the listing stops at the first read one.  A subreddit without modmail access fails the
+    # whole request -> the chunk is asked for again one subreddit at a time, to find and skip that one
+    import traceback
+    first, others = sub_list[0].subreddit_name, [subreddit.subreddit_name for subreddit in sub_list[1:]]
+    try:
+        convos = []
+        for convo in wd.ri.reddit_client.subreddit(first).modmail.conversations(
+                other_subreddits=others, state="all", sort='unread', limit=MODMAIL_UNREAD_LIMIT):
+            if not convo.last_unread:
+                break
+            convos.append(convo)
+        return convos
+    except (prawcore.exceptions.ServerError, prawcore.exceptions.Forbidden):
+        if len(sub_list) > 1:
+            return [convo for subreddit in sub_list for convo in unread_conversations(wd, [subreddit])]
+        trace = traceback.format_exc()
+        print(trace)
+        subreddit = sub_list[0]
+        subreddit.modmail_access = 0
+        wd.s.add(subreddit)
+        wd.s.commit()
+        return []
 
 
 """
@@ -129,9 +129,9 @@ def nsfw_checking(wd: WorkingData):  # Does not expand comments
             wd.s.commit()
             continue
 
-        tock = datetime.now()
-        if tock - tick > timedelta(minutes=3):
-            print("NC: Taking too long, will break for now")
+        if wd.out_of_time():  # posts checked so far have nsfw_last_checked set and are skipped next run
+            print(f"NC: Taking too long ({datetime.now() - tick}), will break for now")
+            wd.s.commit()
             break
 
         if op_age < 10:
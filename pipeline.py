@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from typing import List, Set, Tuple
+
+from chunkplanner import ChunkPlanner
+from core import dbobj
+from enums import SubStatus
+from logger import logger as log
+from modlog import listing_post
+from models.reddit_models import RedditInterface, SubmittedPost, TrackedSubreddit
+from utils import find_author_posting_group, get_subreddit_by_name, insert_new_posts, new_post_pages, \
+    insert_spam_posts, review_posting_group, spam_listing, spam_post
+from workingdata import WorkingData
+
+INGEST_RESOURCES = {'posts.ingest', 'authors.nsfw'}  # as check_submissions
+REVIEW_RESOURCES = {'posts.review'}  # as look_for_rule_violations3
+
+# subreddits update_sub_list leaves out of the sub list
+SKIPPED_SUB_STATUSES = (SubStatus.SUB_FORBIDDEN, SubStatus.SUB_GONE, SubStatus.YAML_SYNTAX_ERROR, SubStatus.NO_CONFIG,
+                        SubStatus.CONFIG_ACCESS_ERROR, SubStatus.BOT_NOT_PRIMARY)
+
+
+# Streams posts through fetch -> dedupe -> persist -> rule check, one thread per stage, instead of the polled
+# check_submissions + look_for_rule_violations3 pair: a post is checked against the subreddit's limit as soon as it
+# is in the db.  Stages are joined by queues of at most queue_size pages (new_pages / spam_pages carry listing pages
+# to dedupe), so a slow stage holds up the ones before it rather than piling posts up in memory.
+# Each stage has its own WorkingData / db session; a failing batch is logged and fetched again next pass.
+class SubmissionPipeline:
+
+    def __init__(self, wd: WorkingData, poll_secs: int = 60, queue_size: int = 20, api_budget=None):
+        self.poll_secs = poll_secs
+        self.fetch_wd = self._stage_wd(wd, RedditInterface(api_budget=api_budget))
+        self.dedupe_wd = self._stage_wd(wd, None)  # db only
+        self.persist_wd = self._stage_wd(wd, RedditInterface(api_budget=api_budget))  # nsfw checks
+        self.review_wd = self._stage_wd(wd, RedditInterface(api_budget=api_budget))
+        self.new_pages: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.spam_pages: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.to_persist: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.to_review: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.sub_names: Set[str] = set()
+        self.dropped = False  # a page failed dedupe/persist since the fetch stage last raised the high-water marks
+        self.threads: List[threading.Thread] = []
+
+    @staticmethod
+    def _stage_wd(wd: WorkingData, ri) -> WorkingData:
+        stage_wd = wd.spawn_worker(dbobj.new_session(), ri)
+        stage_wd.claims = wd.claims
+        return stage_wd
+
+    def start(self):
+        for name, stage in (('fetch', self._fetch), ('dedupe', self._dedupe), ('persist', self._persist),
+                            ('review', self._review)):
+            thread = threading.Thread(target=stage, name=f"mhb-pipeline-{name}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _refresh_sub_names(self):
+        wd = self.fetch_wd
+        rows = wd.s.query(TrackedSubreddit.subreddit_name) \
+            .filter(~TrackedSubreddit.active_status_enum.in_(SKIPPED_SUB_STATUSES)).all()
+        wd.s.commit()
+        self.sub_names = {row[0] for row in rows if wd.handles(row[0])}
+
+    def _sync_subs(self, wd: WorkingData):
+        wd.sync_subs(set(self.sub_names), ())
+        wd.nsfw_monitoring_subs = {subreddit_name: tr for subreddit_name, tr in wd.sub_dict.items()
+                                   if tr.nsfw_pct_moderation}
+
+    # fetch: new and spam listings of every chunk of subreddits, once per poll_secs
+    def _fetch(self):
+        wd = self.fetch_wd
+        while True:
+            started = time.monotonic()
+            try:
+                self._refresh_sub_names()
+                for chunk in (wd.chunk_planner or ChunkPlanner()).chunks(wd.s, self.sub_names, self.poll_secs):
+                    sub_list = "+".join(chunk)
+                    for page in new_post_pages(wd, sub_list=sub_list):
+                        self.new_pages.put(page)  # blocks while the later stages are behind
+                    spam = spam_listing(wd.ri, sub_list, wd.spam_queue)
+                    if spam:
+                        self.spam_pages.put(spam)
+                    # raise the chunk's high-water marks only once its posts are in the db
+                    self.new_pages.join()
+                    self.spam_pages.join()
+                    self.to_persist.join()
+                    if self.dropped:  # leave the marks, so the next pass fetches those posts again
+                        wd.s.rollback()
+                        self.dropped = False
+                    else:
+                        wd.s.commit()
+                    if wd.mod_log:
+                        wd.mod_log.track(wd, sub_list)
+                        wd.s.commit()
+            except Exception:
+                wd.s.rollback()
+                log.exception("pipeline: fetch failed")
+            time.sleep(max(0.0, self.poll_secs - (time.monotonic() - started)))
+
+    def _next_page(self) -> Tuple[str, queue.Queue, list]:
+        while True:
+            for kind, q in (('new', self.new_pages), ('spam', self.spam_pages)):
+                try:
+                    return kind, q, q.get(timeout=0.5)
+                except queue.Empty:
+                    pass
+
+    # dedupe: listing items -> SubmittedPosts not in the db yet
+    def _dedupe(self):
+        wd = self.dedupe_wd
+        while True:
+            kind, q, page = self._next_page()
+            try:
+                new_ids = wd.known_posts.unknown(wd.s, (item.id for item in page))
+                wd.s.commit()  # don't keep a read snapshot open between pages
+                posts = [spam_post(item) if kind == 'spam' else listing_post(wd, item)
+                         for item in page if item.id in new_ids]
+                if posts:
+                    self.to_persist.put((kind, posts))
+            except Exception:
+                wd.s.rollback()
+                self.dropped = True
+                log.exception("pipeline: dedupe failed")
+            finally:
+                q.task_done()
+
+    # persist: one multi-row insert per page; hall passes for the spam queue posts that went in
+    def _persist(self):
+        wd = self.persist_wd
+        while True:
+            kind, posts = self.to_persist.get()
+            try:
+                self._sync_subs(wd)
+                with wd.holding(INGEST_RESOURCES):
+                    inserted_ids = insert_spam_posts(wd, posts) if kind == 'spam' \
+                        else insert_new_posts(wd, posts, check_nsfw=True)
+                    wd.s.commit()
+                if inserted_ids and kind == 'new':
+                    self.to_review.put([post for post in posts if post.id in inserted_ids])
+            except Exception:
+                wd.s.rollback()
+                self.dropped = True
+                log.exception("pipeline: persist failed")
+            finally:
+                self.to_persist.task_done()
+
+    # rule check: authors of new posts that are now over their subreddit's limit
+    def _review(self):
+        wd = self.review_wd
+        while True:
+            posts = self.to_review.get()
+            try:
+                self._sync_subs(wd)
+                self._review_authors(wd, posts)
+            except Exception:
+                wd.s.rollback()
+                log.exception("pipeline: review failed")
+            finally:
+                self.to_review.task_done()
+
+    @staticmethod
+    def _review_authors(wd: WorkingData, posts: List[SubmittedPost]):
+        claims = wd.claims
+        if claims and not claims.try_claim(REVIEW_RESOURCES):
+            # look_for_rule_violations3 is running - it finds these posts itself, no point holding up ingestion
+            if wd.scheduler:
+                wd.scheduler.wake('look_for_rule_violations3')
+            return
+        try:
+            for subreddit_name, author_name in sorted({(post.subreddit_name, post.author) for post in posts}):
+                tr_sub, _ = get_subreddit_by_name(wd, subreddit_name, create_if_not_exist=False)
+                if not tr_sub or tr_sub.active_status_enum not in (SubStatus.ACTIVE, SubStatus.NO_BAN_ACCESS):
+                    continue
+                pg = find_author_posting_group(wd, tr_sub, author_name)
+                if pg:
+                    wd.s.commit()  # review_debug, in case the review fails part way
+                    review_posting_group(wd, pg)
+            wd.s.commit()
+        finally:
+            if claims:
+                claims.release(REVIEW_RESOURCES)
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Optional
+
+import settings
+from enums import PostedStatus
+from logger import logger as log
+
+
+# What RedditInterface.get_posted_status found for a post, with the fields it sets on the SubmittedPost alongside
+class PostedStatusEntry:
+    __slots__ = ('posted_status', 'banned_by', 'self_deleted', 'post_flair', 'author_flair', 'bot_comment_id',
+                 'removed_info', 'expires_at')
+
+    def __init__(self, submission, posted_status: PostedStatus, removed_info: bool, expires_at: float):
+        self.posted_status = posted_status
+        self.banned_by = submission.banned_by
+        self.self_deleted = getattr(submission, 'self_deleted', None)
+        self.post_flair = submission.post_flair
+        self.author_flair = submission.author_flair
+        self.bot_comment_id = submission.bot_comment_id
+        self.removed_info = removed_info  # looked for the remover's comment
+        self.expires_at = expires_at
+
+    def apply(self, submission) -> PostedStatus:
+        submission.banned_by = self.banned_by
+        submission.self_deleted = self.self_deleted
+        submission.post_flair = self.post_flair
+        submission.author_flair = self.author_flair
+        if self.bot_comment_id and not submission.bot_comment_id:
+            submission.bot_comment_id = self.bot_comment_id
+        return self.posted_status
+
+
+# Posted statuses fetched in the last ttl_secs, by post id.  Reviews, summary tables and modmail replies look at the
+# same posts within minutes of each other; this saves them fetching each post again.  Entries are dropped when the
+# bot has removed or approved a post itself, or the mod log shows a mod did; a fetch that started before that is
+# not cached (put's fetched_at), so another thread can't put the old status back.  Hit/miss counts are logged and
+# added to Stats2 every save_interval_secs.  One per process (like the api rate governor), shared by all
+# RedditInterfaces.
+class PostedStatusCache:
+
+    def __init__(self, ttl_secs: int = 300, max_size: int = 50000, save_interval_secs: int = 600):
+        self.ttl_secs = ttl_secs
+        self.max_size = max_size
+        self.entries: Dict[str, PostedStatusEntry] = {}
+        self.invalidated: Dict[str, float] = {}  # post id -> when it was last invalidated, for ttl_secs
+        self.hits = 0
+        self.misses = 0
+        self.saved_hits = 0
+        self.saved_misses = 0
+        self.save_interval_secs = save_interval_secs
+        self.last_saved = datetime.now()
+        self.lock = threading.Lock()
+
+    def get(self, post_id: str, removed_info=False) -> Optional[PostedStatusEntry]:
+        # removed_info: caller wants the remover's comment looked up -> entries that didn't look for it don't do
+        with self.lock:
+            entry = self.entries.get(post_id)
+            if entry and entry.expires_at <= time.monotonic():
+                del self.entries[post_id]
+                entry = None
+            if entry and removed_info and not entry.removed_info and isinstance(entry.banned_by, str):
+                entry = None
+            if entry:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return entry
+
+    def put(self, submission, posted_status: PostedStatus, removed_info=False, fetched_at: Optional[float] = None):
+        # fetched_at: time.monotonic() when the fetch started - older than the post's last invalidation -> not cached
+        if not self.ttl_secs:
+            return
+        now = time.monotonic()
+        entry = PostedStatusEntry(submission, posted_status, removed_info, now + self.ttl_secs)
+        with self.lock:
+            invalidated_at = self.invalidated.get(submission.id)
+            if fetched_at is not None and invalidated_at is not None and fetched_at <= invalidated_at:
+                return
+            self.entries.pop(submission.id, None)  # re-inserted at the end, entries stay in expiry order
+            self.entries[submission.id] = entry
+            if len(self.entries) > self.max_size:
+                for post_id in list(self.entries)[:len(self.entries) - self.max_size]:
+                    del self.entries[post_id]
+
+    def invalidate(self, post_id: str):
+        # call once the change is made on reddit, not before
+        now = time.monotonic()
+        with self.lock:
+            self.entries.pop(post_id, None)
+            self.invalidated.pop(post_id, None)  # kept in invalidation order, like entries
+            self.invalidated[post_id] = now
+            for invalidated_id, invalidated_at in list(self.invalidated.items()):
+                if invalidated_at > now - self.ttl_secs:
+                    break
+                del self.invalidated[invalidated_id]
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.entries),
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+    def save_if_due(self, wd):
+        if (datetime.now() - self.last_saved).total_seconds() < self.save_interval_secs:
+            return
+        self.last_saved = datetime.now()
+        from models.reddit_models import Stats2
+
+        stats = self.stats()
+        log.info(f"posted status cache: {stats['hits']} hits {stats['misses']} misses "
+                 f"({stats['hit_rate']:.0%}), {stats['size']} entries")
+        today = datetime.now().date()
+        for stat_name, count, saved in (("posted_status_cache_hits", stats['hits'], self.saved_hits),
+                                        ("posted_status_cache_misses", stats['misses'], self.saved_misses)):
+            stat = wd.s.query(Stats2).get((wd.bot_name, today, stat_name))
+            if not stat:
+                stat = Stats2(wd.bot_name, today, stat_name)
+            stat.value_int = (stat.value_int or 0) + count - saved
+            wd.s.add(stat)
+        self.saved_hits, self.saved_misses = stats['hits'], stats['misses']
+        wd.s.commit()
+
+
+posted_statuses = PostedStatusCache(ttl_secs=getattr(settings, 'POSTED_STATUS_CACHE_SECS', 300))
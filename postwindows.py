@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import bisect
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Set, Tuple
+
+from enums import CountedStatus, SubStatus
+from logger import logger as log
+from models.reddit_models import SubmittedPost, TrackedSubreddit
+
+# counted statuses look_for_rule_violations3 counts towards the limit
+WINDOW_STATUSES = (CountedStatus.NEEDS_UPDATE, CountedStatus.NOT_CHKD, CountedStatus.PREV_EXEMPT, CountedStatus.COUNTS)
+
+Key = Tuple[str, str]  # (subreddit_name, author)
+
+
+# Sliding windows of recent posts per (subreddit, author), fed by ingestion: when a post takes an author over the
+# subreddit's max_count_per_interval within min_post_interval, the pair becomes a violation candidate for
+# look_for_rule_violations3 - no GROUP BY over the whole RedditPost window.  Candidates are only candidates (posts
+# may be exempt); the review works out the rest from the db.  The db is read to rebuild the windows on start and to
+# refresh the subreddit limits every limits_secs; every reconcile_secs the review still runs the full query, for posts
+# that came in some other way (another process).  Shared by all threads of the process.
+class PostWindows:
+
+    def __init__(self, limits_secs: int = 600, reconcile_secs: int = 3600):
+        self.limits_secs = limits_secs
+        self.reconcile_secs = reconcile_secs
+        self.reconciled_at = None
+        self.limits: Dict[str, Tuple[int, timedelta]] = {}  # subreddit_name: (max_count, interval)
+        self.limits_at = None
+        self.windows: Dict[Key, List[Tuple[datetime, str]]] = {}  # sorted (time_utc, post id)
+        self.candidates: Set[Key] = set()
+        self.lock = threading.Lock()
+
+    def _load_limits(self, s):
+        rows = s.query(TrackedSubreddit.subreddit_name, TrackedSubreddit.max_count_per_interval,
+                       TrackedSubreddit.min_post_interval_mins) \
+            .filter(TrackedSubreddit.active_status_enum.in_((SubStatus.ACTIVE, SubStatus.NO_BAN_ACCESS))).all()
+        self.limits = {subreddit_name.lower(): (max_count, timedelta(minutes=interval_mins))
+                       for subreddit_name, max_count, interval_mins in rows
+                       if max_count is not None and interval_mins}
+        self.limits_at = time.monotonic()
+
+        # drop the windows that ran out without a new post to push them along
+        now = datetime.utcnow()
+        for key, window in list(self.windows.items()):
+            limit = self.limits.get(key[0])
+            if not limit or window[-1][0] <= now - limit[1]:
+                del self.windows[key]
+
+    def rebuild(self, s):
+        # windows from the posts already in RedditPost, e.g. on start
+        with self.lock:
+            self._load_limits(s)
+            self.windows = {}
+            self.candidates = set()
+            if not self.limits:
+                return
+            longest = max(interval for _, interval in self.limits.values())
+            rows = s.query(SubmittedPost.id, SubmittedPost.subreddit_name, SubmittedPost.author,
+                           SubmittedPost.time_utc) \
+                .filter(SubmittedPost.time_utc > datetime.utcnow() - longest,
+                        SubmittedPost.counted_status_enum.in_(WINDOW_STATUSES)).all()
+            for post_id, subreddit_name, author, time_utc in rows:
+                self._add(post_id, subreddit_name, author, time_utc)
+        log.info(f"post windows: {len(self.windows)} authors from {len(rows)} posts, "
+                 f"{len(self.candidates)} candidates")
+
+    def add_all(self, s, posts: Iterable[SubmittedPost]):
+        with self.lock:
+            if self.limits_at is None or time.monotonic() - self.limits_at > self.limits_secs:
+                self._load_limits(s)
+            for post in posts:
+                self._add(post.id, post.subreddit_name, post.author, post.time_utc)
+
+    def _add(self, post_id: str, subreddit_name: str, author: str, time_utc: datetime):
+        limit = self.limits.get(subreddit_name.lower())
+        if not limit:
+            return
+        max_count, interval = limit
+        key = (subreddit_name.lower(), author)
+        window = self.windows.setdefault(key, [])
+        bisect.insort(window, (time_utc, post_id))
+        cutoff = datetime.utcnow() - interval
+        while window and window[0][0] <= cutoff:
+            window.pop(0)
+        if not window:
+            del self.windows[key]
+        elif len(window) > max_count:
+            self.candidates.add(key)
+
+    def take_candidates(self) -> Set[Key]:
+        with self.lock:
+            candidates, self.candidates = self.candidates, set()
+        return candidates
+
+    def reconcile_due(self) -> bool:
+        # -> whether the review should run the full query this time (and then not again for reconcile_secs)
+        with self.lock:
+            if self.reconciled_at is not None and time.monotonic() - self.reconciled_at < self.reconcile_secs:
+                return False
+            self.reconciled_at = time.monotonic()
+            self.candidates = set()  # the full query finds them too
+            return True
@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+import functools
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+import prawcore
+
+import settings
+from enums import ApiPriority
+
+
+# Plain token bucket: rate_per_min tokens are added per minute, up to burst.  acquire() sleeps until a token is free.
+class TokenBucket:
+
+    def __init__(self, rate_per_min: float, burst: float = None):
+        self.rate = rate_per_min / 60
+        self.capacity = burst if burst else max(1.0, rate_per_min / 6)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens: float = 1):
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait_secs = (tokens - self.tokens) / self.rate
+            time.sleep(wait_secs)
+
+
+_local = threading.local()
+
+
+def current_priority() -> ApiPriority:
+    return getattr(_local, 'priority', ApiPriority.NORMAL)
+
+
+@contextmanager
+def api_priority(priority: ApiPriority):
+    # reddit calls made on this thread inside the block queue at this priority
+    previous = current_priority()
+    _local.priority = priority
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def with_api_priority(priority: ApiPriority):
+    # decorator version of api_priority
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with api_priority(priority):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Meters every reddit api call of the process (the rate limit is per account, however many praw instances there are).
+# Calls are spread over what is left of the current window according to the x-ratelimit headers, higher priority
+# callers are served first, and the last `reserve` calls of a window are kept for higher priority callers.
+class RateGovernor:
+
+    def __init__(self, calls_per_min: float = 100, burst: float = 10, reserve: int = 50):
+        self.default_rate = calls_per_min / 60  # until the first headers come in
+        self.rate = self.default_rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.reserve = reserve
+        self.remaining = None  # from x-ratelimit-remaining, None -> unknown / window reset
+        self.reset_at = None
+        self.waiting = []  # heap of (priority, seq)
+        self.seq = itertools.count()
+        self.cv = threading.Condition()
+
+    def _refill(self, now: float):
+        if self.reset_at is not None and now >= self.reset_at:
+            self.remaining, self.reset_at, self.rate = None, None, self.default_rate
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _can_go(self, priority: ApiPriority) -> bool:
+        if self.tokens < 1:
+            return False
+        floor = self.reserve * priority // ApiPriority.BACKGROUND  # HIGH 0, NORMAL reserve/2, BACKGROUND reserve
+        return self.remaining is None or self.remaining > floor
+
+    def _wait_secs(self, now: float) -> float:
+        wait_secs = (1 - self.tokens) / self.rate if self.tokens < 1 else 1.0
+        if self.reset_at is not None:
+            wait_secs = min(wait_secs, max(0.0, self.reset_at - now))
+        return max(wait_secs, 0.01)
+
+    def acquire(self, priority: ApiPriority = None):
+        priority = current_priority() if priority is None else priority
+        entry = (priority, next(self.seq))
+        with self.cv:
+            heapq.heappush(self.waiting, entry)
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if self.waiting[0] == entry and self._can_go(priority):
+                    heapq.heappop(self.waiting)
+                    self.tokens -= 1
+                    if self.remaining is not None:
+                        self.remaining -= 1
+                    self.cv.notify_all()
+                    return
+                self.cv.wait(timeout=self._wait_secs(now))
+
+    def update(self, headers):
+        if "x-ratelimit-remaining" not in headers:
+            return
+        with self.cv:
+            now = time.monotonic()
+            self._refill(now)
+            seconds_to_reset = max(1, int(headers["x-ratelimit-reset"]))
+            self.remaining = int(float(headers["x-ratelimit-remaining"]))
+            self.reset_at = now + seconds_to_reset
+            self.rate = max(self.remaining, 1) / seconds_to_reset
+            self.cv.notify_all()
+
+
+governor = RateGovernor(calls_per_min=getattr(settings, 'API_CALLS_PER_MIN', 100),
+                        reserve=getattr(settings, 'API_HIGH_PRIORITY_RESERVE', 50))
+
+
+# Requestor for praw.Reddit(requestor_class=...): every HTTP request takes a token from the lane's api budget (if
+# any) and then waits its turn with the governor, whose window is updated from the response headers
+class MeteredRequestor(prawcore.Requestor):
+
+    def __init__(self, *args, api_budget: TokenBucket = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.api_budget = api_budget
+
+    def request(self, *args, **kwargs):
+        if self.api_budget:
+            self.api_budget.acquire()
+        governor.acquire()
+        response = super().request(*args, **kwargs)
+        governor.update(response.headers)
+        return response
@@ -0,0 +1,390 @@
+from __future__ import annotations
+
+import heapq
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import settings
+from core import dbobj
+from enums import ApiPriority
+from logger import logger as log
+from metrics import LaneLatency
+from ratelimiting import TokenBucket
+from models.reddit_models import RedditInterface, Task
+from workingdata import WorkingData
+
+# What each task writes.  Two tasks that share a resource never run at the same time (worker pool or lanes).
+# Tasks that are not listed here conflict with everything and run on their own.
+TASK_RESOURCES: Dict[str, Set[str]] = {
+    'purge_old_records': {'posts.ingest', 'posts.review', 'posts.removal'},  # deletes rows the others hold
+    'do_reddit_actions': {'posts.removal'},  # NEEDS_UPDATE status refresh, NEED_REMOVE -> REMOVED
+    'update_sub_list': {'subs.config'},
+    'handle_direct_messages': set(),  # claims COMMAND_RESOURCES itself around each command
+    'handle_modmail_messages': set(),  # same, per conversation; posts.ingest around the on-demand spam queue pull
+    'look_for_rule_violations3': {'posts.review'},
+    'check_submissions': {'posts.ingest', 'authors.nsfw'},
+    'calculate_stats': {'stats'},
+    'nsfw_checking': {'authors.nsfw'},
+}
+
+# What mod commands and modmail replies touch: $update / $reload rewrite TrackedSubs, $hallpass, $reset etc. write
+# authors and posts, summaries read them.  The inbox and modmail tasks claim these around each message they act on
+# rather than for their whole run, so polling for new messages never waits on a batch task.
+COMMAND_RESOURCES: Set[str] = {'subs.config', 'posts.review'}
+
+# Time budgets for tasks whose Tasks2.max_duration_secs is not set (entries in settings' TASK_TIME_BUDGETS win)
+DEFAULT_TIME_BUDGETS: Dict[str, int] = {
+    'look_for_rule_violations3': 60 * 10,
+    'nsfw_checking': 60 * 3,
+}
+
+# Tasks that run once across all bot processes sharing the database (with CLUSTER_LOCKS, see clusterlocks.TaskLocks)
+SINGLETON_TASKS = ('purge_old_records', 'calculate_stats')
+
+# Reddit api priority of each task's calls (ratelimiting.governor); unlisted tasks are NORMAL.  Removals, approvals,
+# replies and modmail raise their own priority (RedditInterface, api_priority around the praw calls) - the inbox and
+# modmail polling and status refreshes of the same tasks stay NORMAL, so they don't eat into the reserve.
+TASK_API_PRIORITIES: Dict[str, ApiPriority] = {
+    'nsfw_checking': ApiPriority.BACKGROUND,
+    'calculate_stats': ApiPriority.BACKGROUND,
+    'purge_old_records': ApiPriority.BACKGROUND,
+}
+
+# Low latency lanes (thread, db session and reddit api budget each) when INTERACTIVE_LANE is set: lane name ->
+# (tasks, setting with its api calls/min, default).  DMs have a lane of their own, so a command sent by DM never
+# waits behind a modmail pass over every subreddit, nor for api calls that pass has used up.
+INTERACTIVE_LANES: Dict[str, Tuple[Tuple[str, ...], str, int]] = {
+    'dm': (('handle_direct_messages',), 'INTERACTIVE_API_CALLS_PER_MIN', 30),
+    'modmail': (('handle_modmail_messages',), 'MODMAIL_API_CALLS_PER_MIN', 30),
+}
+INTERACTIVE_TASKS = tuple(task_name for task_names, _, _ in INTERACTIVE_LANES.values() for task_name in task_names)
+
+
+# Resources held by running tasks, shared by the main loop, the worker pool and the lanes
+class ResourceClaims:
+
+    def __init__(self):
+        self.claimed: Set[str] = set()
+        self.exclusive = False
+        self.running = 0
+        self.listeners: List[TaskScheduler] = []  # interrupted on release so they can retry blocked tasks
+        self.cv = threading.Condition()
+
+    def _free(self, resources: Optional[Set[str]]) -> bool:
+        if self.exclusive:
+            return False
+        if resources is None:
+            return self.running == 0
+        return not (resources & self.claimed)
+
+    def try_claim(self, resources: Optional[Set[str]]) -> bool:
+        with self.cv:
+            if not self._free(resources):
+                return False
+            self.running += 1
+            if resources is None:
+                self.exclusive = True
+            else:
+                self.claimed |= resources
+            return True
+
+    def claim(self, resources: Optional[Set[str]]):
+        with self.cv:
+            while not self.try_claim(resources):
+                self.cv.wait()
+
+    def release(self, resources: Optional[Set[str]]):
+        with self.cv:
+            self.running -= 1
+            if resources is None:
+                self.exclusive = False
+            else:
+                self.claimed -= resources
+            self.cv.notify_all()
+        for scheduler in self.listeners:
+            scheduler.interrupt()
+
+    @contextmanager
+    def holding(self, resources: Optional[Set[str]]):
+        self.claim(resources)
+        try:
+            yield
+        finally:
+            self.release(resources)
+
+
+def task_budget_secs(task: Task) -> Optional[int]:
+    if task.max_duration_secs:
+        return task.max_duration_secs
+    return {**DEFAULT_TIME_BUDGETS, **getattr(settings, 'TASK_TIME_BUDGETS', {})}.get(task.target_function)
+
+
+# Time budget for one task run.  Long loops check WorkingData.out_of_time() between items and stop early, leaving
+# the rest for the next run; the task is then queued again behind whatever else is due.
+class TaskBudget:
+
+    def __init__(self, secs: Optional[float]):
+        self.secs = secs
+        self.started = time.monotonic()
+        self.cut_short = False  # the task saw the budget run out (out_of_time) and stopped with work left
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def remaining(self) -> float:
+        if self.secs is None:
+            return float("inf")
+        return self.secs - self.elapsed()
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+
+class TaskResult:
+    def __init__(self, start_time: datetime, end_time: datetime, error: Optional[str] = None,
+                 rate_limited: bool = False, load: Optional[int] = None, skipped: bool = False,
+                 last_run_dt: Optional[datetime] = None):
+        self.start_time = start_time
+        self.end_time = end_time
+        self.error = error
+        self.rate_limited = rate_limited
+        self.load = load  # WorkingData.report_load total, None if the task doesn't report load
+        self.skipped = skipped  # another process runs this task (shard / TaskLocks)
+        self.last_run_dt = last_run_dt  # when that process last ran it, if known
+
+
+# Priority queue of tasks keyed by next-due time (last_run_dt + frequency_secs).
+# Entries are never removed from the heap in place: rescheduling or waking a task pushes a new entry, and the old
+# one is dropped when it is popped because its due time no longer matches self.due
+class TaskScheduler:
+
+    def __init__(self, max_interval_secs: Optional[int] = None):
+        self.max_interval_secs = max_interval_secs  # run at least this often, whatever Tasks2 says (lanes)
+        self.tasks: Dict[str, Task] = {}
+        self.due: Dict[str, datetime] = {}  # queued tasks only - running tasks are not in here
+        self.heap: List[Tuple[datetime, int, str]] = []
+        self.counter = 0
+        self.woken: Set[str] = set()  # woken while running -> due again as soon as it finishes
+        self.last_due: Dict[str, datetime] = {}  # when the task last came due, for start lag
+        self.interrupted = False
+        self.peers: List[TaskScheduler] = []  # other lanes' schedulers, for wake()
+        self.cv = threading.Condition()
+
+    def add(self, task: Task):
+        with self.cv:
+            self.tasks[task.target_function] = task
+            self._push(task.target_function, self._next_due(task))
+
+    def reschedule(self, task: Task):
+        with self.cv:
+            if task.target_function in self.woken:
+                self.woken.discard(task.target_function)
+                self._push(task.target_function, datetime.now())
+            else:
+                self._push(task.target_function, self._next_due(task))
+
+    def wake(self, target_function: str):
+        # Run a task now rather than waiting for its frequency to come around (DM command, new work found, etc.)
+        if target_function not in self.tasks:
+            for peer in self.peers:
+                if target_function in peer.tasks:
+                    peer.wake(target_function)
+                    return
+            log.debug(f"Asked to wake unknown task: {target_function}")
+            return
+        with self.cv:
+            if target_function in self.due:
+                self._push(target_function, datetime.now())
+            else:
+                self.woken.add(target_function)
+
+    def interrupt(self):
+        # Makes a blocked next_task() return None, e.g. so the main thread can collect a finished worker
+        with self.cv:
+            self.interrupted = True
+            self.cv.notify_all()
+
+    def next_task(self, timeout: Optional[float] = None,
+                  can_run: Optional[Callable[[Task], bool]] = None) -> Optional[Task]:
+        # Blocks until the earliest task is due (or a wake-up makes one due).  Due tasks that can_run() refuses
+        # are left queued.  Returns None on timeout or interrupt.
+        deadline = datetime.now().timestamp() + timeout if timeout is not None else None
+        with self.cv:
+            while True:
+                if self.interrupted:
+                    self.interrupted = False
+                    return None
+                now = datetime.now()
+                wait_secs = None
+                refused = []  # due, but can_run said no - pushed back once the heap has been looked through
+                try:
+                    while self.heap:
+                        entry = heapq.heappop(self.heap)
+                        due, _, target_function = entry
+                        if self.due.get(target_function) != due:
+                            continue  # stale
+                        if due > now:
+                            heapq.heappush(self.heap, entry)
+                            wait_secs = (due - now).total_seconds()
+                            break
+                        if can_run is None or can_run(self.tasks[target_function]):
+                            del self.due[target_function]
+                            self.last_due[target_function] = due
+                            return self.tasks[target_function]
+                        refused.append(entry)
+                finally:
+                    for entry in refused:
+                        heapq.heappush(self.heap, entry)
+
+                if deadline is not None:
+                    remaining = deadline - now.timestamp()
+                    if remaining <= 0:
+                        return None
+                    wait_secs = remaining if wait_secs is None else min(wait_secs, remaining)
+                log.debug(f"Nothing to run, sleeping {wait_secs if wait_secs is not None else 'until woken'} secs")
+                self.cv.wait(timeout=wait_secs)
+
+    def _next_due(self, task: Task) -> datetime:
+        next_due = task.next_due_dt()
+        if self.max_interval_secs and task.last_run_dt and task.error_count <= 5:
+            next_due = min(next_due, task.last_run_dt + timedelta(seconds=self.max_interval_secs))
+        return next_due
+
+    def _push(self, target_function: str, due: datetime):
+        self.counter += 1
+        self.due[target_function] = due
+        heapq.heappush(self.heap, (due, self.counter, target_function))
+        self.cv.notify_all()
+
+
+# Runs tasks at the same time on a fixed set of worker threads.  Every worker has its own WorkingData with its own
+# db session and RedditInterface; the main thread's session is only used for the Tasks2 rows.
+class WorkerPool:
+
+    def __init__(self, wd: WorkingData, runner: Callable[[WorkingData, str, Optional[int]], TaskResult],
+                 claims: ResourceClaims,
+                 worker_count: int = 4, api_budget=None):
+        self.runner = runner
+        self.claims = claims
+        self.idle: queue.Queue = queue.Queue()
+        for _ in range(worker_count):
+            worker_wd = wd.spawn_worker(dbobj.new_session(), RedditInterface(api_budget=api_budget))
+            worker_wd.claims = claims
+            self.idle.put(worker_wd)
+        self.executor = ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix="mhb-worker")
+        self.scheduler: TaskScheduler = wd.scheduler
+        self.running: Dict[str, Tuple[Task, WorkingData]] = {}
+        self.finished: queue.Queue = queue.Queue()
+        self.sub_names: Set[str] = set(wd.sub_dict)
+        self.nsfw_sub_names: Set[str] = set(wd.nsfw_monitoring_subs)
+
+    def claim(self, task: Task) -> bool:
+        # used as next_task(can_run=...) - claims the task's resources if it can start now
+        if self.idle.empty():
+            return False
+        return self.claims.try_claim(TASK_RESOURCES.get(task.target_function))
+
+    def submit(self, task: Task):
+        worker_wd: WorkingData = self.idle.get_nowait()
+        self.running[task.target_function] = (task, worker_wd)
+        sub_names, nsfw_sub_names = set(self.sub_names), set(self.nsfw_sub_names)
+        # read on this thread - the Task row belongs to the main thread's session
+        target_function, budget_secs = task.target_function, task_budget_secs(task)
+
+        def work():
+            worker_wd.sync_subs(sub_names, nsfw_sub_names)
+            return self.runner(worker_wd, target_function, budget_secs)
+
+        future = self.executor.submit(work)
+        future.add_done_callback(lambda f: self._done(task, f))
+
+    def _done(self, task: Task, future):
+        # worker thread - hand the result back to the main thread
+        self.finished.put((task, future))
+        self.scheduler.interrupt()
+
+    def collect(self) -> List[Tuple[Task, TaskResult]]:
+        results = []
+        while not self.finished.empty():
+            task, future = self.finished.get_nowait()
+            _, worker_wd = self.running.pop(task.target_function)
+            try:
+                result = future.result()
+            except Exception:
+                now = datetime.now()
+                result = TaskResult(now, now, error=traceback.format_exc())
+                worker_wd.s.rollback()
+            self.claims.release(TASK_RESOURCES.get(task.target_function))
+
+            # share subreddits the worker picked up (update_sub_list, get_subreddit_by_name) with the other workers
+            if task.target_function == 'update_sub_list':
+                self.sub_names = set(worker_wd.sub_dict)
+                self.nsfw_sub_names = set(worker_wd.nsfw_monitoring_subs)
+            else:
+                self.sub_names |= set(worker_wd.sub_dict)
+            self.idle.put(worker_wd)
+            results.append((task, result))
+        return results
+
+
+# A set of tasks with its own thread, scheduler, db session and reddit api budget, so that e.g. mod commands are
+# answered while a long batch task is running.  Task rows are loaded in the lane's own session.
+class Lane:
+
+    def __init__(self, name: str, wd: WorkingData, task_names, claims: ResourceClaims, api_budget=None,
+                 max_interval_secs: Optional[int] = None):
+        self.name = name
+        self.claims = claims
+        self.latency = LaneLatency(name)
+        self.scheduler = TaskScheduler(max_interval_secs=max_interval_secs)
+        self.wd = wd.spawn_worker(dbobj.new_session(), RedditInterface(api_budget=api_budget))
+        self.wd.scheduler = self.scheduler
+        self.wd.claims = claims
+        self.wd.lane_latency = self.latency
+        self.wd.sync_subs(set(wd.sub_dict), set(wd.nsfw_monitoring_subs))
+        for task in self.wd.s.query(Task).filter(Task.target_function.in_(task_names)).all():
+            self.scheduler.add(task)
+        self.thread = None
+
+    def start(self, runner: Callable[[WorkingData, str, Optional[int]], TaskResult],
+              recorder: Callable[[Task, TaskResult], int]):
+        self.thread = threading.Thread(target=self._run, args=(runner, recorder), name=f"mhb-lane-{self.name}",
+                                       daemon=True)
+        self.thread.start()
+
+    def _run(self, runner, recorder):
+        rate_limiting_errors = 0
+        while True:
+            task = self.scheduler.next_task()
+            if not task:
+                continue
+            resources = TASK_RESOURCES.get(task.target_function)
+            with self.claims.holding(resources):
+                self.latency.record("start_lag", (datetime.now() - self.scheduler.last_due[task.target_function])
+                                    .total_seconds())
+                return_val = recorder(task, runner(self.wd, task.target_function, task_budget_secs(task)))
+                self.wd.s.commit()  # Tasks2 rows
+            self.scheduler.reschedule(task)
+            self.latency.save_if_due(self.wd)
+            if return_val == -1:
+                rate_limiting_errors += 1
+                if rate_limiting_errors > 2:
+                    time.sleep(60 * 5)
+                    rate_limiting_errors = 0
+
+
+def interactive_lanes(wd: WorkingData, claims: ResourceClaims) -> List[Lane]:
+    # the INTERACTIVE_LANES, each able to wake the others' tasks and wd.scheduler's
+    lanes = [Lane(name, wd, task_names, claims, api_budget=TokenBucket(getattr(settings, budget_setting, default)),
+                  max_interval_secs=getattr(settings, 'INTERACTIVE_POLL_SECS', 15))
+             for name, (task_names, budget_setting, default) in INTERACTIVE_LANES.items()]
+    schedulers = [wd.scheduler] + [lane.scheduler for lane in lanes]
+    for scheduler in schedulers:
+        scheduler.peers += [peer for peer in schedulers if peer is not scheduler]
+    return lanes
@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import math
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from typing import Callable, FrozenSet, Optional
+
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+
+from clusterlocks import default_node_id
+from core import dbobj
+from logger import logger as log
+from models.reddit_models import ShardLease, ShardNode
+
+# Tasks that work on the whole bot account rather than on subreddits - run by the holder of partition 0 only
+GLOBAL_TASKS = ('handle_direct_messages', 'purge_old_records', 'calculate_stats')
+
+
+def partition_of(subreddit_name: str, partitions: int) -> int:
+    return zlib.crc32(subreddit_name.lower().encode()) % partitions
+
+
+# Splits the tracked subreddits between bot processes.  Every process heartbeats a ShardNodes row and holds leases
+# on about partitions / live nodes ShardLeases rows, renewed from a background thread.  Leases of a dead process
+# expire after lease_secs and are picked up by the others; a new process gets its share as the others shed extras.
+class ShardLeases:
+
+    def __init__(self, partitions: int, lease_secs: int = 90, node_id: Optional[str] = None):
+        self.partitions = partitions
+        self.lease_secs = lease_secs
+        self.node_id = node_id or default_node_id()
+        self.node_id_configured = bool(node_id)  # the default (hostname-pid) changes with every restart
+        self.owned: FrozenSet[int] = frozenset()
+        self.on_change: Optional[Callable[[], None]] = None
+        self.s = dbobj.new_session()
+        self.thread = None
+
+    def handles(self, subreddit_name: str) -> bool:
+        return partition_of(subreddit_name, self.partitions) in self.owned
+
+    def handles_global(self) -> bool:
+        return 0 in self.owned
+
+    def stable_key(self) -> str:
+        # names this process's share of the work across restarts: the configured node id, else the partitions held
+        if self.node_id_configured:
+            return self.node_id
+        return "p" + ",".join(str(partition) for partition in sorted(self.owned))
+
+    def start(self, on_change: Optional[Callable[[], None]] = None):
+        self.on_change = on_change
+        self._create_rows()
+        self.renew()
+        self.thread = threading.Thread(target=self._run, name="mhb-shard-leases", daemon=True)
+        self.thread.start()
+
+    def _create_rows(self):
+        for partition in range(self.partitions):
+            if not self.s.query(ShardLease).get(partition):
+                self.s.add(ShardLease(partition))
+        try:
+            self.s.commit()
+        except IntegrityError:  # another process created them first
+            self.s.rollback()
+
+    def _run(self):
+        while True:
+            time.sleep(self.lease_secs / 3)
+            try:
+                self.renew()
+            except Exception:
+                # keep going - leases run out on their own if the db stays unreachable
+                self.s.rollback()
+                log.exception("shard lease renewal failed")
+
+    def renew(self):
+        now = datetime.now()
+        expires_at = now + timedelta(seconds=self.lease_secs)
+        node = self.s.query(ShardNode).get(self.node_id)
+        if not node:
+            node = ShardNode(self.node_id, now)
+        node.last_seen = now
+        self.s.add(node)
+
+        live_nodes = self.s.query(ShardNode) \
+            .filter(ShardNode.last_seen > now - timedelta(seconds=self.lease_secs)).count()
+        fair_share = math.ceil(self.partitions / max(1, live_nodes))
+
+        # keep what is still ours, up to the fair share (shed the highest partitions so partition 0 stays put)
+        held = sorted(lease.partition for lease in self.s.query(ShardLease)
+                      .filter(ShardLease.owner == self.node_id, ShardLease.expires_at >= now).all())
+        keep, shed = held[:fair_share], held[fair_share:]
+        if keep:
+            self.s.query(ShardLease).filter(ShardLease.partition.in_(keep), ShardLease.owner == self.node_id) \
+                .update({ShardLease.expires_at: expires_at}, synchronize_session=False)
+        if shed:
+            self.s.query(ShardLease).filter(ShardLease.partition.in_(shed), ShardLease.owner == self.node_id) \
+                .update({ShardLease.owner: None, ShardLease.expires_at: None}, synchronize_session=False)
+
+        # take free or expired partitions; the conditional update makes sure only one process gets each
+        owned = set(keep)
+        if len(owned) < fair_share:
+            free = [lease.partition for lease in self.s.query(ShardLease)
+                    .filter(or_(ShardLease.owner.is_(None), ShardLease.expires_at < now))
+                    .order_by(ShardLease.partition).all()]
+            for partition in free:
+                if len(owned) >= fair_share:
+                    break
+                claimed = self.s.query(ShardLease) \
+                    .filter(ShardLease.partition == partition,
+                            or_(ShardLease.owner.is_(None), ShardLease.expires_at < now)) \
+                    .update({ShardLease.owner: self.node_id, ShardLease.expires_at: expires_at},
+                            synchronize_session=False)
+                if claimed:
+                    owned.add(partition)
+        self.s.commit()
+
+        if owned != self.owned:
+            log.info(f"shard {self.node_id}: now holding partitions {sorted(owned)} "
+                     f"({live_nodes} live nodes, fair share {fair_share})")
+            self.owned = frozenset(owned)
+            if self.on_change:
+                self.on_change()
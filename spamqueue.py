@@ -0,0 +1,54 @@
+from __future__ import annotations
+
+import threading
+import time
+from typing import Dict, Optional
+
+
+# Where each chunk's last read of the spam queue got to, so the next read asks reddit only for entries above it
+# (`before` the newest one seen) instead of the whole queue.  If that entry left the queue (approved, removed) reddit
+# returns nothing for it, so a read above the cursor that comes back empty drops the cursor, and the queue is re-read
+# from the top every rescan_secs anyway.  Also remembers when each
+# subreddit's queue was last read, so an on-demand lookup (modmail) can use the scheduled scan's results instead
+# of pulling the queue again.  Shared by all threads of the process.
+class SpamQueueCursors:
+
+    def __init__(self, fresh_secs: int = 120, rescan_secs: int = 600):
+        self.fresh_secs = fresh_secs
+        self.rescan_secs = rescan_secs
+        self.cursors: Dict[str, str] = {}  # sub_list: fullname of the newest entry seen
+        self.rescanned_at: Dict[str, float] = {}  # sub_list: when last read from the top
+        self.read_at: Dict[str, float] = {}  # subreddit_name: when its queue was last read
+        self.lock = threading.Lock()
+
+    def fresh(self, subreddit_name: str) -> bool:
+        # was the subreddit's queue read (and ingested) within fresh_secs
+        with self.lock:
+            read_at = self.read_at.get(subreddit_name.lower())
+        return read_at is not None and time.monotonic() - read_at < self.fresh_secs
+
+    def cursor(self, sub_list: str) -> Optional[str]:
+        # -> fullname to read `before`, or None to read from the top
+        with self.lock:
+            rescanned_at = self.rescanned_at.get(sub_list.lower())
+            if rescanned_at is None or time.monotonic() - rescanned_at > self.rescan_secs:
+                return None
+            return self.cursors.get(sub_list.lower())
+
+    def advance(self, sub_list: str, cursor: Optional[str], items: list):
+        # record a read of sub_list's queue that started at cursor and returned items (newest first)
+        now = time.monotonic()
+        with self.lock:
+            if cursor is not None and not items:
+                # usually the cursor entry left the queue, not an empty queue: read from the top next time, and
+                # don't count this as a read of the queue
+                self.cursors.pop(sub_list.lower(), None)
+                return
+            if items:
+                self.cursors[sub_list.lower()] = items[0].fullname
+            else:  # queue is empty
+                self.cursors.pop(sub_list.lower(), None)
+            if cursor is None:
+                self.rescanned_at[sub_list.lower()] = now
+            for subreddit_name in sub_list.lower().split('+'):
+                self.read_at[subreddit_name] = now
@@ -0,0 +1,81 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# settings.py is per deployment (and points at the live database) - run against settings_EXAMPLE and a throwaway
+# sqlite database instead
+if 'settings' not in sys.modules:
+    settings = types.ModuleType('settings')
+    with open(os.path.join(ROOT, 'settings_EXAMPLE.py')) as f:
+        exec(f.read(), settings.__dict__)
+    settings.DB_ENGINE = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db') + '?check_same_thread=false'
+    sys.modules['settings'] = settings
+
+import settings  # noqa: E402
+import scheduler  # noqa: E402
+from core import dbobj  # noqa: E402
+from models.reddit_models import Task  # noqa: E402
+from scheduler import ResourceClaims, TaskResult, TaskScheduler, interactive_lanes  # noqa: E402
+from workingdata import WorkingData  # noqa: E402
+
+
+# Stands in for RedditInterface: an api call only takes a token from the lane's budget
+class FakeRedditInterface:
+
+    def __init__(self, api_budget=None):
+        self.api_budget = api_budget
+
+    def call(self):
+        self.api_budget.acquire()
+
+
+def test_dm_latency_bounded_while_modmail_scan_runs(monkeypatch):
+    monkeypatch.setattr(scheduler, 'RedditInterface', FakeRedditInterface)
+    monkeypatch.setattr(settings, 'MODMAIL_API_CALLS_PER_MIN', 6, raising=False)  # a scan that takes half an hour
+    for task_name in ('handle_direct_messages', 'handle_modmail_messages'):
+        dbobj.s.merge(Task(None, task_name, timedelta(minutes=1)))
+    dbobj.s.commit()
+
+    wd = WorkingData()
+    wd.s = dbobj.s
+    wd.bot_name = "testbot"
+    wd.scheduler = TaskScheduler()
+    scan_started, scan_finished, dm_ran = threading.Event(), threading.Event(), threading.Event()
+
+    def runner(lane_wd, target_function, budget_secs):
+        start_time = datetime.now()
+        if target_function == 'handle_modmail_messages':
+            scan_started.set()
+            for _ in range(200):  # listing requests and replies of a pass over many subreddits
+                lane_wd.ri.call()
+            scan_finished.set()
+        else:
+            lane_wd.ri.call()  # inbox
+            lane_wd.ri.call()  # reply
+            dm_ran.set()
+        return TaskResult(start_time, datetime.now())
+
+    def recorder(task, result):
+        task.last_run_dt = result.end_time
+        return 0
+
+    for lane in interactive_lanes(wd, ResourceClaims()):
+        lane.start(runner, recorder)
+    assert scan_started.wait(5)
+    assert dm_ran.wait(5)
+
+    # a DM comes in mid-scan: the command task is woken and gets its api calls straight away
+    time.sleep(0.5)
+    dm_ran.clear()
+    woken_at = time.monotonic()
+    wd.scheduler.wake('handle_direct_messages')
+    assert dm_ran.wait(5)
+    assert time.monotonic() - woken_at < 2
+    assert not scan_finished.is_set()
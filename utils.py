@@ -3,7 +3,7 @@ from __future__ import annotations
 from static import *
 import logging
 from datetime import datetime, timedelta
-from typing import List
+from typing import Dict, List
 import humanize
 import iso8601
 import praw
@@ -16,25 +16,92 @@ from sqlalchemy.ext.declarative import declarative_base
 from praw.models.listing.generator import ListingGenerator
 import queue
 from models.reddit_models import SubAuthor, SubmittedPost, \
-    TrackedAuthor, TrackedSubreddit, RedditInterface, PostingGroup
+    TrackedAuthor, TrackedSubreddit, RedditInterface, PostingGroup, ReviewCheckpoint, IngestMark
 from logger import logger
 from sqlalchemy import exc
 from settings import MAIN_BOT_NAME
 from nsfw_monitoring import check_post_nsfw_eligibility
+from knownposts import KnownPostIds
+from spamqueue import SpamQueueCursors
+from modlog import listing_post
+from exemptions import ExemptionChains
+from postedstatuscache import posted_statuses
+from enums import ApiPriority
+from ratelimiting import api_priority
+from postwindows import WINDOW_STATUSES
+from praw.const import API_PATH
+from itertools import islice
 from typing import Optional
 
 
-def check_new_submissions(wd: WorkingData, query_limit=800, sub_list='mod', intensity=0):
-    subreddit_names = []
-    subreddit_names_complete = []
-    logger.info(f"main/CNW: pulling new posts!  intensity: {intensity}")
-    print(sub_list)
-    possible_new_posts = [a for a in wd.ri.reddit_client.subreddit(sub_list).new(limit=query_limit)]
+def pages(listing, size=100):
+    # a praw listing in chunks of one request's worth of items
+    listing = iter(listing)
+    while True:
+        page = list(islice(listing, size))
+        if not page:
+            return
+        yield page
+
+
+def ingest_marks(wd: WorkingData, sub_list='mod', intensity=0):
+    # -> (high-water marks of the chunk's subreddits, where to stop paging back).  Only pages back as far as the
+    # oldest mark of the chunk, less some slack for posts that show up in the listing late
+    chunk_sub_names = [name.lower() for name in sub_list.split('+')] if sub_list != 'mod' else []
+    marks = {mark.subreddit_name: mark for mark in
+             wd.s.query(IngestMark).filter(IngestMark.subreddit_name.in_(chunk_sub_names)).all()} \
+        if chunk_sub_names else {}
+    stop_before = None
+    if intensity == 0 and chunk_sub_names and len(marks) == len(set(chunk_sub_names)):
+        stop_before = min(mark.seen_until for mark in marks.values()) - timedelta(minutes=5)
+    return marks, stop_before
+
+
+def new_listing_pages(ri, sub_list='mod', stop_before=None, query_limit=800):
+    # Pages of the subreddits' new listing, newest first, down to stop_before.  Reddit api only, so it can run on
+    # any thread with its own RedditInterface; the listing is fetched lazily, 100 posts a request
+    for page in pages(ri.reddit_client.subreddit(sub_list).new(limit=query_limit)):
+        fresh = [post_to_review for post_to_review in page
+                 if not stop_before or datetime.utcfromtimestamp(post_to_review.created_utc) >= stop_before]
+        if fresh:
+            yield fresh
+        if len(fresh) < len(page):  # reached the mark
+            return
 
-    count = 0
-    total = 0
-    for post_to_review in possible_new_posts:
-        total += 1
+
+def raise_ingest_marks(wd: WorkingData, sub_list, marks, newest: Optional[datetime]):
+    # everything in the chunk up to the newest post has been seen now - saved with the caller's next commit
+    if not newest or sub_list == 'mod':
+        return
+    for subreddit_name in (name.lower() for name in sub_list.split('+')):
+        mark = marks.get(subreddit_name)
+        if not mark:
+            mark = marks[subreddit_name] = IngestMark(subreddit_name, newest)
+        mark.seen_until = max(mark.seen_until, newest)
+        wd.s.add(mark)
+
+
+def newest_post_time(items) -> Optional[datetime]:
+    return max((datetime.utcfromtimestamp(item.created_utc) for item in items), default=None)
+
+
+def new_post_pages(wd: WorkingData, sub_list='mod', query_limit=800, intensity=0):
+    # new_listing_pages for wd.ri, raising the chunk's high-water marks once the walk is done
+    marks, stop_before = ingest_marks(wd, sub_list, intensity)
+    newest = None
+    for page in new_listing_pages(wd.ri, sub_list, stop_before=stop_before, query_limit=query_limit):
+        page_newest = newest_post_time(page)
+        newest = max(newest, page_newest) if newest else page_newest
+        yield page
+    raise_ingest_marks(wd, sub_list, marks, newest)
+
+
+def new_posts_in(wd: WorkingData, items, subreddit_names_complete: set, intensity=0) -> List[SubmittedPost]:
+    # listing items (newest first per subreddit) -> SubmittedPosts for the ones not in the db yet
+    known_posts = wd.known_posts or KnownPostIds()
+    new_ids = known_posts.unknown(wd.s, (post_to_review.id for post_to_review in items))
+    new_posts = []
+    for post_to_review in items:
         subreddit_name = str(post_to_review.subreddit).lower()
 
         # If we have seen this post for this subreddit, stop going any further
@@ -43,53 +110,191 @@ def check_new_submissions(wd: WorkingData, query_limit=800, sub_list='mod', inte
             continue
 
         # check if we know this post
-        previous_post: SubmittedPost = wd.s.query(SubmittedPost).get(post_to_review.id)
-        if previous_post:  # seen this post before -> ignore posts from this  sub
-            subreddit_names_complete.append(subreddit_name)
+        if post_to_review.id not in new_ids:  # seen this post before -> ignore posts from this  sub
+            subreddit_names_complete.add(subreddit_name)
             # logger.info(f"seen this post before {subreddit_name} {post_to_review.id}")
             continue
-        if not previous_post:  # have not seen this post, add to db
-            post = SubmittedPost(post_to_review)
-            if post.subreddit_name in wd.nsfw_monitoring_subs:   # do nsfw eligibility check if applicable
-                check_post_nsfw_eligibility(wd, post)
+        # have not seen this post, add to db
+        new_ids.discard(post_to_review.id)
+        new_posts.append(listing_post(wd, post_to_review))
+    return new_posts
 
-            wd.s.add(post)
-            count += 1
+
+def check_new_submissions(wd: WorkingData, query_limit=800, sub_list='mod', intensity=0):
+    subreddit_names_complete = set()
+    logger.info(f"main/CNW: pulling new posts!  intensity: {intensity}")
+    print(sub_list)
+
+    count = 0
+    total = 0
+    for page in new_post_pages(wd, sub_list=sub_list, query_limit=query_limit, intensity=intensity):
+        total += len(page)
+        count += len(insert_new_posts(wd, new_posts_in(wd, page, subreddit_names_complete, intensity=intensity)))
     logger.info(f'main/CNW: found {count} posts out of {total}')
     wd.s.commit()
+    wd.report_load(count)
+    if count and wd.scheduler:  # new posts -> review them now rather than next cycle
+        wd.scheduler.wake('look_for_rule_violations3')
 
 
-def check_spam_submissions(wd: WorkingData, sub_list='mod', intensity=0):
-    possible_spam_posts = []
+def check_submissions_concurrently(wd: WorkingData, sub_lists: List[str], intensity=0):
+    # check_new_submissions + check_spam_submissions for all chunks at once: wd.listing_fetcher pulls the chunks'
+    # listings in parallel (within the api budget), and the posts go in as one batch
+    chunk_marks = {sub_list: ingest_marks(wd, sub_list, intensity) for sub_list in sub_lists}
+
+    def fetch(ri, sub_list):
+        new_items = [post_to_review for page in
+                     new_listing_pages(ri, sub_list, stop_before=chunk_marks[sub_list][1]) for post_to_review in page]
+        return new_items, spam_listing(ri, sub_list, wd.spam_queue, intensity=intensity), \
+            wd.mod_log.read(ri, sub_list) if wd.mod_log else []
+
+    tick = datetime.now()
+    results = wd.listing_fetcher.map(fetch, sub_lists)
+    logger.info(f"main/CSC: pulled {len(sub_lists)} chunks in {datetime.now() - tick}")
+
+    subreddit_names_complete = set()
+    new_posts = []
+    spam_posts = []
+    mod_log_entries = []
+    for sub_list, (new_items, spam_items, chunk_mod_log_entries) in zip(sub_lists, results):
+        new_posts += new_posts_in(wd, new_items, subreddit_names_complete, intensity=intensity)
+        spam_posts += spam_posts_in(wd, spam_items, intensity=intensity)
+        mod_log_entries += chunk_mod_log_entries
+        raise_ingest_marks(wd, sub_list, chunk_marks[sub_list][0], newest_post_time(new_items))
+    inserted_ids = insert_new_posts(wd, new_posts)
+    insert_spam_posts(wd, [post for post in spam_posts if post.id not in inserted_ids])
+    if wd.mod_log:
+        wd.mod_log.apply(wd, sorted(mod_log_entries, key=lambda entry: entry.created_utc, reverse=True))
+    logger.info(f'main/CSC: found {len(inserted_ids)} posts')
+    wd.s.commit()
+    wd.report_load(len(inserted_ids))
+    if inserted_ids and wd.scheduler:  # new posts -> review them now rather than next cycle
+        wd.scheduler.wake('look_for_rule_violations3')
+
+
+def insert_new_posts(wd: WorkingData, posts: List[SubmittedPost], check_nsfw=True) -> List[str]:
+    # one multi-row insert instead of a unit-of-work flush per post; returns the ids that went in.  Exempt posts
+    # are marked first, so the insert writes their counted status
+    if wd.exemption_chains:
+        wd.exemption_chains.screen(wd.sub_dict, posts)
+    inserted_ids = SubmittedPost.bulk_insert(wd.s, posts)
+    known_posts = wd.known_posts or KnownPostIds()
+    known_posts.add_all(inserted_ids)
+    if wd.post_windows:
+        inserted = set(inserted_ids)
+        wd.post_windows.add_all(wd.s, (post for post in posts if post.id in inserted
+                                       and post.counted_status_enum in WINDOW_STATUSES))
+
+    # do nsfw eligibility check if applicable - on the inserted rows, so changes are saved with the next commit
+    nsfw_ids = [post.id for post in posts if check_nsfw and post.id in inserted_ids
+                and post.subreddit_name in wd.nsfw_monitoring_subs]
+    if nsfw_ids:
+        for post in wd.s.query(SubmittedPost).filter(SubmittedPost.id.in_(nsfw_ids)).all():
+            check_post_nsfw_eligibility(wd, post)
+    return inserted_ids
+
+
+def spam_listing(ri, sub_list='mod', cursors: SpamQueueCursors = None, intensity=0) -> list:
+    # the subreddits' spam queue (submissions only), newest first - reddit api only, like new_listing_pages.
+    # With cursors, only the entries added since the last read: one request for the page above the cursor
+    cursor = cursors.cursor(sub_list) if cursors and intensity == 0 else None
     try:
-        possible_spam_posts = [a for a in wd.ri.reddit_client.subreddit(sub_list).mod.spam(only='submissions')]
+        if cursor:
+            items = list(ri.reddit_client.get(API_PATH["about_spam"].format(subreddit=sub_list),
+                                              params={'only': 'links', 'before': cursor, 'limit': 100}))
+        else:
+            items = [a for a in ri.reddit_client.subreddit(sub_list).mod.spam(only='submissions')]
     except prawcore.exceptions.Forbidden:
-        pass
-    for post_to_review in possible_spam_posts:
-        previous_post: SubmittedPost = wd.s.query(SubmittedPost).get(post_to_review.id)
+        return []
+    if cursors:
+        cursors.advance(sub_list, cursor, items)
+    return items
+
+
+def check_mod_log(wd: WorkingData, sub_list='mod'):
+    # posted statuses of the chunk's posts removed or approved since the last read of its mod log
+    wd.mod_log.track(wd, sub_list)
+    wd.s.commit()
+
+
+def spam_posts_in(wd: WorkingData, items, intensity=0) -> List[SubmittedPost]:
+    # spam queue items -> SubmittedPosts for the ones not in the db yet
+    known_posts = wd.known_posts or KnownPostIds()
+    new_ids = known_posts.unknown(wd.s, (post_to_review.id for post_to_review in items))
+    new_posts = []
+    for post_to_review in items:
+        previous_post = post_to_review.id not in new_ids
         if previous_post and intensity == 0:
             break
         if not previous_post:
-            post = SubmittedPost(post_to_review)
-            if post.banned_by is True:
-                post.posted_status = PostedStatus.AUTOMOD_RM
-            elif post.banned_by == "AutoModerator":
-                post.posted_status = PostedStatus.SPAM_FLT.value
-            post.reviewed = True
-            sub_list = post.subreddit_name.lower()
+            new_ids.discard(post_to_review.id)
             # logger.info("found spam post: '{0}...' http://redd.it/{1} ({2})".format(post.title[0:20], post.id,
             #                                                                         subreddit_name))
+            new_posts.append(spam_post(post_to_review))
+    return new_posts
 
-            # post.reviewed = True
-            wd.s.add(post)
-            subreddit_author: SubAuthor = wd.s.query(SubAuthor).get((sub_list, post.author))
-            if subreddit_author and subreddit_author.hall_pass >= 1:
-                subreddit_author.hall_pass -= 1
-                post.api_handle.mod.approve()
-                wd.s.add(subreddit_author)
+
+def check_spam_submissions(wd: WorkingData, sub_list='mod', intensity=0):
+    new_posts = spam_posts_in(wd, spam_listing(wd.ri, sub_list, wd.spam_queue, intensity=intensity),
+                              intensity=intensity)
+    insert_spam_posts(wd, new_posts)
     wd.s.commit()
 
 
+def insert_spam_posts(wd: WorkingData, posts: List[SubmittedPost]) -> List[str]:
+    # spam queue posts go in like new ones; hall passes are only used for the ones that went in, once they are in
+    # the db.  Not committed
+    inserted_ids = insert_new_posts(wd, posts, check_nsfw=False)
+    for post in posts:
+        if post.id in inserted_ids:
+            use_hall_pass(wd, post)
+    return inserted_ids
+
+
+def spam_post(post_to_review) -> SubmittedPost:
+    # a post from the spam queue - already removed, so it goes in as reviewed
+    post = SubmittedPost(post_to_review)
+    if post.banned_by is True:
+        post.posted_status = PostedStatus.AUTOMOD_RM.value
+    elif post.banned_by == "AutoModerator":
+        post.posted_status = PostedStatus.SPAM_FLT.value
+    post.reviewed = True
+    return post
+
+
+def use_hall_pass(wd: WorkingData, post: SubmittedPost):
+    # approve a removed post if the author has a hall pass left for the subreddit
+    subreddit_author: SubAuthor = wd.s.query(SubAuthor).get((post.subreddit_name.lower(), post.author))
+    if subreddit_author and subreddit_author.hall_pass >= 1:
+        subreddit_author.hall_pass -= 1
+        with api_priority(ApiPriority.HIGH):
+            wd.ri.reddit_client.submission(id=post.id).mod.approve()  # post may come from another thread's instance
+        posted_statuses.invalidate(post.id)
+        wd.s.add(subreddit_author)
+
+
+def posted_status_stale(post: SubmittedPost) -> bool:
+    # check_for_post_exemptions would fetch this post's posted status
+    return post.counted_status_enum in (CountedStatus.NEEDS_UPDATE, CountedStatus.NOT_CHKD, CountedStatus.PREV_EXEMPT,
+                                        CountedStatus.COUNTS, CountedStatus.REVIEWED) \
+        and (post.posted_status == PostedStatus.UNKNOWN.value
+             or (post.last_checked  # aware until reloaded, if set in this session
+                 and post.last_checked.replace(tzinfo=None)
+                 < datetime.now(pytz.utc).replace(tzinfo=None) - timedelta(hours=3)))
+
+
+def refresh_posted_statuses(wd: WorkingData, posts: List[SubmittedPost]) -> int:
+    # fetch the stale posted statuses of posts about to be reviewed in a few info() requests, one flush
+    stale = [post for post in posts if isinstance(post, SubmittedPost) and not post.reviewed
+             and posted_status_stale(post)]
+    if not stale:
+        return 0
+    refreshed = wd.ri.refresh_posted_statuses(stale)
+    wd.s.flush()
+    logger.debug(f"refreshed posted status of {refreshed}/{len(stale)} posts")
+    return refreshed
+
+
 def check_for_post_exemptions(tr_sub: TrackedSubreddit, recent_post: SubmittedPost, wd=None):  # uses some reddit api
     # check if removed
     if recent_post.counted_status_enum not in (CountedStatus.NEEDS_UPDATE, CountedStatus.NOT_CHKD, CountedStatus.PREV_EXEMPT, CountedStatus.COUNTS, CountedStatus.REVIEWED):
@@ -97,13 +302,9 @@ def check_for_post_exemptions(tr_sub: TrackedSubreddit, recent_post: SubmittedPo
                f"previously exempted {CountedStatus(recent_post.counted_status_enum)}"
 
     posted_status = recent_post.posted_status
-    if posted_status == PostedStatus.UNKNOWN.value \
-            or (recent_post.last_checked
-                and recent_post.last_checked < datetime.now(pytz.utc).replace(tzinfo=None) - timedelta(hours=3)):
+    if posted_status_stale(recent_post):
         posted_status = wd.ri.get_posted_status(recent_post, get_removed_info=True)  # uses some reddit api
-        recent_post.posted_status = posted_status.value
-        recent_post.post_flair = recent_post.api_handle.link_flair_text
-        recent_post.author_flair = recent_post.api_handle.author_flair_text
+        recent_post.posted_status = posted_status.value  # flairs are set by get_posted_status
         # recent_post.author_css = recent_post.api_handle.author_css_text
         recent_post.last_checked = datetime.now(pytz.utc)
 
@@ -115,200 +316,21 @@ def check_for_post_exemptions(tr_sub: TrackedSubreddit, recent_post: SubmittedPo
     # logger.debug(">>>>exemption status: {}".format(banned_by))
 
     # These should already be identified - except for author/post flairs? May not know if they were recently updated
-    if posted_status == PostedStatus.SPAM_FLT:
-        return CountedStatus.SPAMMED_EXMPT, ""
-    elif tr_sub.ignore_AutoModerator_removed and posted_status == PostedStatus.AUTOMOD_RM:
-        return CountedStatus.AM_RM_EXEMPT, ""
-    elif tr_sub.ignore_moderator_removed and posted_status == PostedStatus.FH_RM:
-        return CountedStatus.FLAIR_HELPER, ""
-    elif tr_sub.ignore_moderator_removed and posted_status == PostedStatus.MOD_RM:
-        return CountedStatus.MOD_RM_EXEMPT, ""
-    elif tr_sub.exempt_oc and recent_post.is_oc:  # won't change
-        return CountedStatus.OC_EXEMPT, ""
-    elif tr_sub.exempt_self_posts and recent_post.is_self:  # wont change
-        return CountedStatus.SELF_EXEMPT, ""
-    elif tr_sub.exempt_link_posts and recent_post.is_self is not True:  # won't change
-        return CountedStatus.LINK_EXEMPT, ""
-    if tr_sub.exempt_moderator_posts and recent_post.author in tr_sub.subreddit_mods: # may change
-        return CountedStatus.MODPOST_EXEMPT, "moderator exempt"
-    # check if flair-exempt
-    try:
-        author_flair = wd.ri.get_submission_api_handle(recent_post).author_flair_text  # Reddit API
-        author_css = None
-        #author_css = wd.ri.get_submission_api_handle(recent_post).auth  # Reddit API
-    except prawcore.exceptions.Forbidden:
-        print("can't access flair")
-        author_flair = None
-    # add CSS class to author_flair
-    #if author_flair and wd.ri.get_submission_api_handle(recent_post).author_flair_css_class:  # Reddit API
-    #     author_flair = author_flair + wd.ri.get_submission_api_handle(recent_post).author_flair_css_class  # Reddit API
-
-    # Flair keyword exempt
-    if tr_sub.author_exempt_flair_keyword and isinstance(tr_sub.author_exempt_flair_keyword, str) \
-            and ((author_flair and tr_sub.author_exempt_flair_keyword in author_flair)
-            or (author_css and tr_sub.author_not_exempt_flair_keyword in author_css)):
-        logger.debug(">>>flair exempt")
-        return CountedStatus.FLAIR_EXEMPT, "flair exempt {}".format(author_flair)
-
-    # Not-flair-exempt keyword (Only restrict certain flairs)
-    if tr_sub.author_not_exempt_flair_keyword \
-            and ((author_flair and tr_sub.author_not_exempt_flair_keyword not in author_flair) or not author_flair):
-        return CountedStatus.FLAIR_NOT_EXEMPT, "flair not exempt {}".format(author_flair)
-
-    # check if title keyword exempt:
-    if tr_sub.title_exempt_keyword:
-        flex_title = recent_post.title.lower()
-        if (isinstance(tr_sub.title_exempt_keyword, str)
-            and tr_sub.title_exempt_keyword.lower() in flex_title) or \
-                (isinstance(tr_sub.title_exempt_keyword, list)
-                 and any(x in flex_title for x in [y.lower() for y in tr_sub.title_exempt_keyword])):
-            logger.debug(">>>title keyword exempted")
-            return CountedStatus.TITLE_KW_EXEMPT, f"title keyword exempt {tr_sub.title_exempt_keyword} -> exemption"
-
-    # title keywords only to restrict:
-    if tr_sub.title_not_exempt_keyword:
-        link_flair = wd.ri.get_submission_api_handle(recent_post).link_flair_text  # Reddit API
-        if link_flair:
-            flex_title = recent_post.title.lower() + link_flair
-        else:
-            flex_title = recent_post.title.lower()
-        print(flex_title)
-        # example: restriction "Selfies"
-        # if there is a restriction and required keyword is not in title -> does not meet restriction criteria, exempt
-        if (isinstance(tr_sub.title_not_exempt_keyword, str)
-            and tr_sub.title_not_exempt_keyword.lower() not in flex_title) or \
-                (isinstance(tr_sub.title_not_exempt_keyword, list)
-                 and all(x not in flex_title for x in [y.lower() for y in tr_sub.title_not_exempt_keyword])):
-            logger.debug(f">>>meets restriction criteria: {flex_title}, restriction: {tr_sub.title_not_exempt_keyword}")
-            return CountedStatus.TITLE_CRITERIA_NOT_MET, f"title does not have {tr_sub.title_not_exempt_keyword} -> exemption"
-    return CountedStatus.COUNTS, "no exemptions"
+    # flairs as of ingestion or the last posted status check, no api calls from here on
+    exemption_chains = wd.exemption_chains if wd and wd.exemption_chains else ExemptionChains()
+    counted_status, result = exemption_chains.chain(tr_sub).check(recent_post, posted_status)
+    if counted_status != CountedStatus.COUNTS:
+        logger.debug(f">>>exempt: {counted_status} {result}")
+    return counted_status, result
 
 
 
 def automated_reviews(wd):
-    logger.debug("AR: excluding mod posts...")
-    now_date = datetime.now(pytz.utc).replace(tzinfo=None).strftime("%Y-%m-%d %H:%M:%S")
-
-    # ignore moderators
-    """
-    rs = wd.s.update(SubmittedPost)\
-        .join(TrackedSubreddit, SubmittedPost.subreddit_name == TrackedSubreddit.subreddit_name)\
-        .where(SubmittedPost.counted_status < 1,
-                SubmittedPost.reviewed == 0,
-                TrackedSubreddit.mod_list.like(func.concat("%", SubmittedPost.author, "%")))\
-        .values({SubmittedPost.counted_status: CountedStatus.MODPOST_EXEMPT.value,
-                 SubmittedPost.last_reviewed: datetime.now(pytz.utc)})
-    """
-    rs = wd.s.execute('UPDATE RedditPost t '
-                   'INNER JOIN TrackedSubs s ON t.subreddit_name = s.subreddit_name '
-                   'SET counted_status = :counted_status, reviewed = 1 '
-                   'WHERE t.counted_status < 1 and t.reviewed = 0 and s.mod_list like CONCAT("%", t.author, "%") ',
-                   {"counted_status": CountedStatus.MODPOST_EXEMPT.value,
-                    "last_reviewed": now_date})
-    logger.debug(rs.rowcount)
-
-
-    logger.debug("AR: excluding self posts...")
-    # ignore self posts
-    rs = wd.s.execute("UPDATE RedditPost t "
-                   "INNER JOIN TrackedSubs s ON t.subreddit_name = s.subreddit_name "
-                   "SET counted_status = :counted_status, reviewed = 1, last_reviewed = :last_reviewed "
-                   "WHERE t.counted_status < 1 "
-                   "AND t.reviewed = 0 and t.is_self is TRUE and s.exempt_self_posts is TRUE",
-                   {"counted_status": CountedStatus.SELF_EXEMPT.value,
-                    "banned_by": "AutoModerator",
-                    "last_reviewed": now_date})
-    logger.debug(rs.rowcount)
-
-    """  No one has excluded link posts...
-    print("AR: excluding link posts...")
-    # ignore link posts
-    rs = wd.s.execute("UPDATE RedditPost t "
-                   "INNER JOIN TrackedSubs s ON t.subreddit_name = s.subreddit_name "
-                   "SET counted_status = :counted_status, reviewed = 1, last_reviewed = :last_reviewed "
-                   "WHERE t.counted_status < 1 "
-                   "AND t.reviewed = 0 and t.is_self is FALSE and s.exempt_link_posts is TRUE",
-                   {"counted_status": CountedStatus.LINK_EXEMPT.value})
-    print(rs.rowcount)
-    """
-
-    logger.debug("AR excluding OC posts")
-    # ignore OC
-    rs = wd.s.execute("UPDATE RedditPost t "
-                   "INNER JOIN TrackedSubs s ON t.subreddit_name = s.subreddit_name "
-                   "SET counted_status = :counted_status, reviewed = 1, last_reviewed = :last_reviewed "
-                   "WHERE t.counted_status < 1 "
-                   "AND  t.reviewed = 0 and t.is_oc is TRUE and s.exempt_oc is TRUE",
-                   {"counted_status": CountedStatus.OC_EXEMPT.value,
-                    "last_reviewed": now_date})
-
-    #ignore autoremoved
-    logger.debug("AR excluding autoremoved posts...")
-    rs = wd.s.execute("UPDATE RedditPost t "
-                   "INNER JOIN TrackedSubs s ON t.subreddit_name = s.subreddit_name "
-                   "SET counted_status = :counted_status, reviewed = 1, last_reviewed = :last_reviewed "
-                   "WHERE t.counted_status < 1 "
-                   "AND s.ignore_Automoderator_removed = 1 AND t.posted_status like :posted_status",
-                   {"counted_status": CountedStatus.AM_RM_EXEMPT.value,
-                    "posted_status": PostedStatus.AUTOMOD_RM.value,
-                    "last_reviewed": now_date})
-    logger.debug(rs.rowcount)
-    logger.debug("AR excluding moderator removed posts...DOES NOT INCLUDE Flair helper??")
-    # ignore link posts
-    rs = wd.s.execute("UPDATE RedditPost t "
-                   "INNER JOIN TrackedSubs s ON t.subreddit_name = s.subreddit_name "
-                   "SET counted_status = :counted_status, reviewed = 1, last_reviewed = :last_reviewed "
-                   "WHERE t.counted_status < 1 "
-                   "AND  s.ignore_moderator_removed = 1 AND t.posted_status like :posted_status",
-                   {"counted_status": CountedStatus.MOD_RM_EXEMPT.value,
-                    "posted_status": PostedStatus.MOD_RM.value,
-                    "last_reviewed": now_date})
-    logger.debug(rs.rowcount)
-
-    logger.debug("AR: excluding author flair")
-    rs = wd.s.execute('UPDATE RedditPost t '
-                   'INNER JOIN TrackedSubs s ON t.subreddit_name = s.subreddit_name '
-                   'SET counted_status = :counted_status, reviewed = 1, last_reviewed = :last_reviewed '
-                   'WHERE t.reviewed = 0 AND t.counted_status <1 '
-                   'AND s.author_exempt_flair_keyword is not NULL and t.author_flair is not NULL '
-                   'AND t.author_flair REGEXP s.author_exempt_flair_keyword ',
-                   {"counted_status": CountedStatus.FLAIR_EXEMPT.value,
-                    "last_reviewed": now_date})
-    logger.debug(rs.rowcount)
-    logger.debug("AR: author flair inclusion")
-    rs = wd.s.execute('UPDATE RedditPost t '
-                   'INNER JOIN TrackedSubs s ON t.subreddit_name = s.subreddit_name '
-                   'SET counted_status = :counted_status, reviewed = 1, last_reviewed = :last_reviewed  '
-                   'WHERE t.reviewed = 0 AND t.counted_status <1 '
-                   'AND s.author_not_exempt_flair_keyword is NOT NULL '
-                   'AND (t.author_flair is NULL '
-                   'OR NOT (t.author_flair REGEXP s.author_not_exempt_flair_keyword)'
-                   ')',
-                   {"counted_status": CountedStatus.FLAIR_EXEMPT.value,
-                    "last_reviewed": now_date})
-    logger.debug(rs.rowcount)
-    logger.debug("AR: excluding title/post_flair")
-    rs = wd.s.execute('UPDATE RedditPost t '
-                   'INNER JOIN TrackedSubs s ON t.subreddit_name = s.subreddit_name '
-                   'SET counted_status = :counted_status, reviewed = 1 , last_reviewed = :last_reviewed  '
-                   'WHERE t.reviewed = 0 AND t.counted_status <1 '
-                   'AND s.title_exempt_keyword is not NULL '
-                   'AND CONCAT(t.title, COALESCE(t.post_flair)) REGEXP s.author_exempt_flair_keyword ',
-                   {"counted_status": CountedStatus.TITLE_KW_EXEMPT.value,
-                    "last_reviewed": now_date})
-    logger.debug(rs.rowcount)
-    logger.debug("AR: inclusion title/post flair - reversed")
-    rs = wd.s.execute('UPDATE RedditPost t '
-                   'INNER JOIN TrackedSubs s ON t.subreddit_name = s.subreddit_name '
-                   'SET counted_status = :counted_status, reviewed = 1, last_reviewed = :last_reviewed  '
-                   'WHERE t.reviewed = 0 AND t.counted_status <1 '
-                   'AND s.title_not_exempt_keyword  is NOT NULL '
-                   'AND NOT (CONCAT(t.title, COALESCE(t.post_flair)) REGEXP s.title_not_exempt_keyword)',
-                   {"counted_status": CountedStatus.TITLE_KW_EXEMPT.value,
-                    "last_reviewed": now_date})
-    logger.debug(rs.rowcount)
-
-
+    # rule out the easy ones - moderator, self/oc, removed, flair and title keyword exempt posts
+    logger.debug("AR: exemption chains...")
+    exemption_chains = wd.exemption_chains or ExemptionChains()
+    exemption_chains.review(wd)
+    wd.s.commit()
 
     """
     logger.info(f"finding blacklist violations")
@@ -329,7 +351,8 @@ def automated_reviews(wd):
         SubAuthor.subreddit_name == SubmittedPost.subreddit_name)). \
         filter(SubmittedPost.reviewed.is_(False),
                SubmittedPost.time_utc < SubAuthor.next_eligible,
-               SubmittedPost.time_utc > tick.replace(tzinfo=None) - timedelta(hours=24)
+               SubmittedPost.time_utc > tick.replace(tzinfo=None) - timedelta(hours=24),
+               *in_subreddits(handled_subreddit_names(wd))
                ).all()
 
     for j, tuple1 in enumerate(tuples):
@@ -370,11 +393,7 @@ def do_reddit_actions(wd):
     to_update = wd.s.query(SubmittedPost)\
         .filter(SubmittedPost.counted_status_enum == CountedStatus.NEEDS_UPDATE)\
         .filter(SubmittedPost.time_utc > datetime.now(pytz.utc).replace(tzinfo=None) - timedelta(hours=48))
-    for op in to_update:
-        assert(isinstance(op, SubmittedPost))
-        op.posted_status = wd.ri.get_posted_status(op).value
-        op.last_checked = datetime.now(pytz.utc)
-        wd.s.add(op)
+    wd.ri.refresh_posted_statuses([op for op in to_update if wd.handles(op.subreddit_name)])
     wd.s.commit()
 
     print("do removals...")
@@ -384,13 +403,17 @@ def do_reddit_actions(wd):
         .filter(SubmittedPost.time_utc > datetime.now(pytz.utc).replace(tzinfo=None) - timedelta(hours=24))
     # print(f"blacklist removals {to_remove.rowcount}")
     for op in to_remove:
+        if not wd.handles(op.subreddit_name):
+            continue
         # logger.info(f'removing post {op.author} {op.title} {op.subreddit_name}')
         result: tuple[Optional[TrackedSubreddit], str] = get_subreddit_by_name(wd, op.subreddit_name, create_if_not_exist=False)
         tr_sub, req_status = result
         if not tr_sub:
             continue
         try:
-            wd.ri.get_submission_api_handle(op).mod.remove()
+            with api_priority(ApiPriority.HIGH):
+                wd.ri.get_submission_api_handle(op).mod.remove()
+            posted_statuses.invalidate(op.id)
             logger.info(f'remove successful!: {op.subreddit_name} {op.author} {op.title} {op.id}')
             new_counted_status = CountedStatus.REMOVED \
                 if op.counted_status_enum == CountedStatus.NEED_REMOVE else CountedStatus.BLKLIST
@@ -494,54 +517,56 @@ def look_for_rule_violations4(wd):
                 posts_checked[pp_id]=pp
 
 
-def look_for_rule_violations3(wd):
+def handled_subreddit_names(wd) -> Optional[List[str]]:
+    # the active subreddits in wd's shard partitions, None when not sharded (all of them)
+    if not wd.shard:
+        return None
+    return [subreddit_name for (subreddit_name,) in wd.s.query(TrackedSubreddit.subreddit_name)
+            .filter(TrackedSubreddit.active_status_enum.in_((SubStatus.ACTIVE, SubStatus.NO_BAN_ACCESS))).all()
+            if wd.handles(subreddit_name)]
 
-    # need to rule out easy ones - moderators, etc.
-    automated_reviews(wd)
 
-    # posts that are deleted/removed
-    # exempted posts:
-    #   permanent: moderator post, title keywords, self/oc
-    #   non permanent: author/post flair, moderator
-    # grace period
-    # hall pass
-    # sub not active
-    #
+def in_subreddits(sub_names: Optional[List[str]]) -> list:
+    # query filter for posts of handled_subreddit_names - none when not sharded
+    return [] if sub_names is None else [SubmittedPost.subreddit_name.in_(sub_names)]
 
 
-    # get "leftover" posts that were not checked
-    logger.debug(f"LRWT: querying recent post(s)")
-    posting_groups = []
-    most_recent_identified = None
-    look_back_hrs = 48
-
-    posts_to_verify = wd.s.query(SubmittedPost) \
+def leftover_posts(wd, sub_names: Optional[List[str]], look_back_hrs=48) -> List[SubmittedPost]:
+    # last posts of groups found before ("ma:" tagged) that were not reviewed yet, newest first
+    return wd.s.query(SubmittedPost) \
         .join(TrackedSubreddit, TrackedSubreddit.subreddit_name == SubmittedPost.subreddit_name, isouter=False) \
         .filter(SubmittedPost.reviewed == 0,
                 SubmittedPost.counted_status_enum.in_((CountedStatus.NEEDS_UPDATE, CountedStatus.NOT_CHKD)),
                 SubmittedPost.review_debug.like("ma:%"),
                 SubmittedPost.time_utc > datetime.now() - timedelta(hours=look_back_hrs),
-                TrackedSubreddit.active_status_enum.in_((SubStatus.ACTIVE,SubStatus.NO_BAN_ACCESS))
+                TrackedSubreddit.active_status_enum.in_((SubStatus.ACTIVE,SubStatus.NO_BAN_ACCESS)),
+                *in_subreddits(sub_names)
                 ).order_by(SubmittedPost.added_time.desc()).all()
 
-    for post in posts_to_verify:
-        if not most_recent_identified:
-            most_recent_identified = post
-        assert isinstance(post, SubmittedPost)
-        post_ids = post.review_debug.replace("ma:", "").split(',')
 
-        posts = []
-        for post_id in post_ids:
-            posts.append(wd.s.query(SubmittedPost).get(post_id))
-        posting_groups.append(
-            PostingGroup(post.id, author_name=post.author, subreddit_name=post.subreddit_name, posts=posts))
-    logger.debug(f"# of leftover posts from before: {len(posting_groups)}")
+def leftover_group_spec(post: SubmittedPost) -> tuple:
+    # -> (latest post id, author, subreddit, post ids) of the group tagged on post
+    return post.id, post.author, post.subreddit_name, post.review_debug.replace("ma:", "").split(',')
 
-    logger.debug(f"leftover posts from before: {len(posting_groups)}")
+
+def find_posting_groups(wd) -> List[PostingGroup]:
+    # get "leftover" posts that were not checked
+    logger.debug(f"LRWT: querying recent post(s)")
+    posting_groups = []
+    look_back_hrs = 48
+    sub_names = handled_subreddit_names(wd)
+
+    # (latest post id, author, subreddit, post ids) - the posts are loaded for all groups at once at the end
+    posts_to_verify = leftover_posts(wd, sub_names, look_back_hrs)
+    group_specs = [leftover_group_spec(post) for post in posts_to_verify]
+    most_recent_identified = posts_to_verify[0] if posts_to_verify else None
+    logger.debug(f"# of leftover posts from before: {len(group_specs)}")
+
+    logger.debug(f"leftover posts from before: {len(group_specs)}")
 
     if not most_recent_identified:
         most_recent_identified: SubmittedPost | None = wd.s.query(SubmittedPost) \
-            .filter(SubmittedPost.review_debug.like("ma:%")) \
+            .filter(SubmittedPost.review_debug.like("ma:%"), *in_subreddits(sub_names)) \
             .order_by(SubmittedPost.added_time).first()
 
     # AND (most_recent > MAX(t.last_checked) or max(t.last_checked) is NULL)
@@ -567,6 +592,7 @@ def look_for_rule_violations3(wd):
             s.active_status_enum in ('ACTIVE', 'NO_BAN_ACCESS') 
             and counted_status_enum  in ('NEEDS_UPDATE', 'NOT_CHKD', 'PREV_EXEMPT', 'COUNTS')
             AND t.time_utc > utc_timestamp() - INTERVAL s.min_post_interval_mins MINUTE  
+            [shard]
         GROUP BY 
             t.author, t.subreddit_name 
             HAVING COUNT(t.author) > s.max_count_per_interval 
@@ -577,6 +603,9 @@ def look_for_rule_violations3(wd):
     # more_accurate_statement.replace("[date]")
     search_back = 48
     more_accurate_statement = more_accurate_statement.replace('72', str(search_back))
+    more_accurate_statement = more_accurate_statement.replace(
+        '[shard]', 'AND t.subreddit_name IN :sub_names' if sub_names is not None else '')
+    params = {"sub_names": sub_names} if sub_names is not None else {}
 
     tick = datetime.now()
     last_date = most_recent_identified.added_time.isoformat() \
@@ -584,235 +613,360 @@ def look_for_rule_violations3(wd):
     last_date = max(most_recent_identified.added_time, datetime.now()-timedelta(days=5))
     logger.debug(f"doing more accurate {datetime.now()} last date:{last_date}")
     # last_date = "2022-06-30 00:00:00"  # REMOVE THIS!!!!!!!!!!!!!!!!!!!!!!!
-    rs = wd.s.execute(more_accurate_statement, {"look_back": last_date})
+    statement = text(more_accurate_statement)
+    if sub_names is not None:
+        statement = statement.bindparams(bindparam("sub_names", expanding=True))
+    rs = wd.s.execute(statement, {"look_back": last_date, **params})
     logger.debug(f"query took this long {datetime.now() - tick}")
 
+    leftover_count = len(group_specs)
     for row in rs:
         logger.debug(",".join((row[0], row[1], row[2], row[3], row[4], row[5])))
         post_ids = row[1].replace("ma:", "").split(',')
-        posts = []
-        for post_id in post_ids:
-            # print(f"\t{post_id}")
-            posts.append(wd.s.query(SubmittedPost).get(post_id))
-
-        last_post = posts[-1]
-        assert isinstance(last_post, SubmittedPost)
-        if not last_post.review_debug:
-            last_post.review_debug = f"ma:{row[1]}"
-            wd.s.add(last_post)
+        group_specs.append((post_ids[-1], row[3], row[4].lower(), post_ids))
+
+    posts_by_id = load_posts_by_id(wd, [post_id for _, _, _, post_ids in group_specs for post_id in post_ids])
+    for j, (latest_post_id, author_name, subreddit_name, post_ids) in enumerate(group_specs):
+        posts = [posts_by_id.get(post_id) for post_id in post_ids]
+        if j >= leftover_count:  # found by the query above - tag the last post so the group is picked up again
+            last_post = posts[-1]
+            assert isinstance(last_post, SubmittedPost)
+            if not last_post.review_debug:
+                last_post.review_debug = f"ma:{','.join(post_ids)}"
+                wd.s.add(last_post)
         posting_groups.append(
-                PostingGroup(last_post.id, author_name=row[3], subreddit_name=row[4].lower(), posts=posts))
+            PostingGroup(latest_post_id, author_name=author_name, subreddit_name=subreddit_name, posts=posts))
     wd.s.commit()
 
     logger.debug(f"Total groups found: {len(posting_groups)}")
-    tick = datetime.now(pytz.utc)
 
     # sort this list
     logger.debug(f"sorting list...")
     posting_groups.sort(key=lambda y: y.latest_post_id, reverse=True)
     logger.debug(f"done")
+    return posting_groups
+
+
+def find_candidate_groups(wd) -> List[PostingGroup]:
+    # find_posting_groups for the authors wd.post_windows flagged since the last pass, plus the groups left over
+    # from earlier passes ("ma:" tagged) - those aren't in the windows' candidates any more
+    group_specs = [leftover_group_spec(post) for post in leftover_posts(wd, handled_subreddit_names(wd))]
+    posts_by_id = load_posts_by_id(wd, [post_id for _, _, _, post_ids in group_specs for post_id in post_ids])
+    posting_groups = [PostingGroup(latest_post_id, author_name=author_name, subreddit_name=subreddit_name,
+                                   posts=[posts_by_id.get(post_id) for post_id in post_ids])
+                      for latest_post_id, author_name, subreddit_name, post_ids in group_specs]
+    leftover = {(subreddit_name.lower(), author_name) for _, author_name, subreddit_name, _ in group_specs}
+    logger.debug(f"leftover posts from before: {len(posting_groups)}")
+
+    for subreddit_name, author_name in wd.post_windows.take_candidates():
+        if not wd.handles(subreddit_name) or (subreddit_name.lower(), author_name) in leftover:
+            continue
+        tr_sub, _ = get_subreddit_by_name(wd, subreddit_name, create_if_not_exist=False)
+        if not tr_sub:
+            continue
+        pg = find_author_posting_group(wd, tr_sub, author_name)
+        if pg:
+            posting_groups.append(pg)
+    wd.s.commit()
+    logger.debug(f"Total groups found: {len(posting_groups)}")
+    posting_groups.sort(key=lambda y: y.latest_post_id, reverse=True)
+    return posting_groups
+
+
+def load_posts_by_id(wd, post_ids: List[str], batch_size=500) -> Dict[str, SubmittedPost]:
+    # The posts of a whole review pass with one IN query per batch_size ids, rather than a get() per id; the
+    # posting groups of the pass are built from the returned map
+    post_ids = list(dict.fromkeys(post_ids))
+    posts_by_id = {}
+    for j in range(0, len(post_ids), batch_size):
+        posts_by_id.update((post.id, post) for post in
+                           wd.s.query(SubmittedPost).filter(SubmittedPost.id.in_(post_ids[j:j + batch_size])).all())
+    return posts_by_id
+
+
+def load_checkpointed_groups(wd, checkpoint: ReviewCheckpoint) -> List[PostingGroup]:
+    group_specs = checkpoint.group_specs()
+    posts_by_id = load_posts_by_id(wd, [post_id for _, _, _, group_post_ids in group_specs
+                                        for post_id in group_post_ids])
+    return [PostingGroup(latest_post_id, author_name=author_name, subreddit_name=subreddit_name,
+                         posts=[posts_by_id.get(post_id) for post_id in group_post_ids])
+            for latest_post_id, author_name, subreddit_name, group_post_ids in group_specs]
+
+
+def find_author_posting_group(wd, tr_sub: TrackedSubreddit, author_name: str) -> Optional[PostingGroup]:
+    # find_posting_groups for one author: their counted posts within the subreddit's interval, if over the limit
+    posts = wd.s.query(SubmittedPost) \
+        .filter(SubmittedPost.author == author_name,
+                SubmittedPost.subreddit_name == tr_sub.subreddit_name,
+                SubmittedPost.counted_status_enum.in_((CountedStatus.NEEDS_UPDATE, CountedStatus.NOT_CHKD,
+                                                       CountedStatus.PREV_EXEMPT, CountedStatus.COUNTS)),
+                SubmittedPost.time_utc > datetime.utcnow() - timedelta(minutes=tr_sub.min_post_interval_mins)) \
+        .order_by(SubmittedPost.id).all()
+    if len(posts) <= tr_sub.max_count_per_interval:
+        return None
+    last_post = posts[-1]
+    if not last_post.review_debug:  # so look_for_rule_violations3 picks it up again if the review doesn't finish
+        last_post.review_debug = "ma:" + ",".join(post.id for post in posts)
+        wd.s.add(last_post)
+    return PostingGroup(last_post.id, author_name=author_name, subreddit_name=tr_sub.subreddit_name, posts=posts)
+
+
+def look_for_rule_violations3(wd):
+
+    # need to rule out easy ones - moderators, etc.
+    automated_reviews(wd)
+
+    # posts that are deleted/removed
+    # exempted posts:
+    #   permanent: moderator post, title keywords, self/oc
+    #   non permanent: author/post flair, moderator
+    # grace period
+    # hall pass
+    # sub not active
+    #
+
+
+    # pick up an interrupted pass where it stopped, otherwise work out the posting groups and checkpoint them
+    checkpoint_name = "look_for_rule_violations3" + (f"/{wd.shard.stable_key()}" if wd.shard else "")
+    checkpoint: ReviewCheckpoint | None = wd.s.query(ReviewCheckpoint).get(checkpoint_name)
+    if checkpoint and checkpoint.created_at > datetime.now() - timedelta(minutes=30):
+        posting_groups = load_checkpointed_groups(wd, checkpoint)
+        start_index = checkpoint.next_index
+        logger.debug(f"LRWT: resuming at group {start_index}/{len(posting_groups)}")
+    else:
+        if checkpoint:  # stale - the posts have moved on since
+            wd.s.delete(checkpoint)
+            wd.s.flush()
+        if wd.post_windows and not wd.post_windows.reconcile_due():
+            posting_groups = find_candidate_groups(wd)
+        else:
+            posting_groups = find_posting_groups(wd)
+        checkpoint = ReviewCheckpoint(checkpoint_name, posting_groups) if posting_groups else None
+        start_index = 0
+    if checkpoint:
+        wd.s.add(checkpoint)
+    wd.s.commit()
+    wd.report_load(len(posting_groups) - start_index)
+    tick = datetime.now(pytz.utc)
+
+    # posted statuses for the whole pass in a few info() requests, rather than a fetch per post
+    refresh_posted_statuses(wd, [post for pg in posting_groups[start_index:] if wd.handles(pg.subreddit_name)
+                                 for post in pg.posts])
 
     # Go through posting group
-    for i, pg in enumerate(posting_groups):
+    for i, pg in enumerate(posting_groups[start_index:], start=start_index):
+        checkpoint.next_index = i  # saved with the commits below
         logger.debug(
             f"========================{i + 1}/{len(posting_groups)}=================================")
 
-        # Break if taking too long
-        tock = datetime.now(pytz.utc) - tick
-        if tock > timedelta(minutes=10):
-            logger.warning("Aborting, taking more than 10 min")
+        # Break if out of time - the checkpoint keeps the rest for the next run
+        if wd.out_of_time():
+            logger.warning(f"Out of time after {datetime.now(pytz.utc) - tick}, {len(posting_groups) - i} groups left")
             wd.s.commit()
             break
 
-        # Load subreddit settings
-        # tr_sub = wd.sub_dict[pg.subreddit_name]
-        #tr_sub = get_subreddit_by_name(wd, pg.subreddit_name, update_if_due=False)
-        result: tuple[Optional[TrackedSubreddit], str] = get_subreddit_by_name(wd, pg.subreddit_name, update_if_due=False)
-        tr_sub, req_status = result
-        if not tr_sub:
-            logger.debug(f"{pg.subreddit_name}: {req_status}")
-            continue
-        max_count = tr_sub.max_count_per_interval
-        if tr_sub.active_status_enum not in (SubStatus.ACTIVE, SubStatus.NO_BAN_ACCESS):
-            logger.warning(f"Subreddit is not active {tr_sub.subreddit_name} {tr_sub.active_status_enum}")
-            continue
+        review_posting_group(wd, pg, i)
+    else:
+        if checkpoint:
+            wd.s.delete(checkpoint)  # went through all of them
 
-        # Check if they're on the soft blacklist
-        subreddit_author: SubAuthor = wd.s.query(SubAuthor).get((pg.subreddit_name, pg.author_name))
+    wd.s.commit()
 
-        # Remove any posts that are prior to eligibility
-        posts_to_verify = []
-        logger.debug(f"/r/{pg.subreddit_name}---max_count: {max_count}, interval: {tr_sub.min_post_interval_txt} "
-              f"grace_period: {tr_sub.grace_period}")
-        for j, post in enumerate(pg.posts):
-            try:
-                assert (isinstance(post, SubmittedPost))  #Assertion error
-            except(AssertionError) as e:
-                print(f"{e}")
-                print(f"{post}")
-                break
 
-            logger.debug(
-                f"{i}-{j}Checking: "
-                f"{pg.author_name} {post.time_utc} url:{post.get_url()} reviewed:{post.reviewed}  "
-                f"counted:{post.counted_status_enum} "
-                f"posted:{post.posted_status}  title:{post.title[0:30]}")
-
-            if post.counted_status_enum in (CountedStatus.NEED_REMOVE,
-                                            CountedStatus.REMOVED,
-                                            CountedStatus.BLKLIST_NEED_REMOVE,
-                                            ):  # May not need this later
-                logger.debug(
-                    f"{i}-{j}\t\tAlready handled")
-                continue
 
-            # Check for post exemptions
-            if not post.reviewed:
 
-                counted_status, result = check_for_post_exemptions(tr_sub, post, wd=wd)
-                post.counted_status_enum = counted_status
-                #post.update_status(counted_status=counted_status)
-                wd.s.add(post)
-                logger.debug(f"\t\tpost status: {counted_status} {result}")
-                if counted_status in ( CountedStatus.COUNTS , CountedStatus.NEED_REMOVE):
-                    posts_to_verify.append(post)
-                if i % 25 == 0:
-                    wd.s.commit()
 
-            else:
-                logger.debug(f"{i}-{j}\t\tpost status: "
-                            f"already reviewed {post.counted_status_enum} "
-                            f"{'---MHB removed' if post.flagged_duplicate else ''}")
-
-        """
-        # Skip if we don't need to go through each post
-        if len(left_over_posts) < max_count:
-            logger.info("Did not collect enough counted posts")
-            wd.s.commit()
-            continue
-        """
+def review_posting_group(wd, pg: PostingGroup, i: int = 0):
+    # Checks one posting group (author + subreddit) for posts over the subreddit's limit and acts on them
+    if not wd.handles(pg.subreddit_name):  # another shard's
+        return
 
-        wd.s.commit()
+    # Load subreddit settings
+    # tr_sub = wd.sub_dict[pg.subreddit_name]
+    #tr_sub = get_subreddit_by_name(wd, pg.subreddit_name, update_if_due=False)
+    result: tuple[Optional[TrackedSubreddit], str] = get_subreddit_by_name(wd, pg.subreddit_name, update_if_due=False)
+    tr_sub, req_status = result
+    if not tr_sub:
+        logger.debug(f"{pg.subreddit_name}: {req_status}")
+        return
+    max_count = tr_sub.max_count_per_interval
+    if tr_sub.active_status_enum not in (SubStatus.ACTIVE, SubStatus.NO_BAN_ACCESS):
+        logger.warning(f"Subreddit is not active {tr_sub.subreddit_name} {tr_sub.active_status_enum}")
+        return
 
+    refresh_posted_statuses(wd, pg.posts)  # nothing to do if the pass already did
 
+    # Check if they're on the soft blacklist
+    subreddit_author: SubAuthor = wd.s.query(SubAuthor).get((pg.subreddit_name, pg.author_name))
 
-        # Collect all relevant posts
-        logger.debug("finding back posts")
-        back_posts = wd.s.query(SubmittedPost) \
-            .filter(
-            # SubmittedPost.flagged_duplicate.is_(False), # redundant with new flag
-            SubmittedPost.subreddit_name.ilike(tr_sub.subreddit_name),
-            SubmittedPost.time_utc > pg.posts[0].time_utc - tr_sub.min_post_interval + tr_sub.grace_period,
-            SubmittedPost.time_utc < pg.posts[-1].time_utc,  # posts not after last post in question
-            SubmittedPost.author == pg.author_name,
-            SubmittedPost.counted_status_enum.in_((CountedStatus.NEEDS_UPDATE, CountedStatus.NOT_CHKD, CountedStatus.COUNTS))) \
-            .order_by(SubmittedPost.time_utc) \
-            .all()
-
-        possible_pre_posts = []
-        logger.debug(f"Found {len(back_posts)} backposts")
-        if len(back_posts) == 0:
-            # if pg.posts[-1].counted_status <2:   # This doesn't make sense?? what was this supposed to do
-            #     pg.posts[-1].counted_status==2   # not an assignment!
-            pg.posts[-1].reviewed = True
-            wd.s.add(pg.posts[-1])
-
-            logger.debug("Nothing to do, moving on.")
+    # Remove any posts that are prior to eligibility
+    posts_to_verify = []
+    logger.debug(f"/r/{pg.subreddit_name}---max_count: {max_count}, interval: {tr_sub.min_post_interval_txt} "
+          f"grace_period: {tr_sub.grace_period}")
+    for j, post in enumerate(pg.posts):
+        try:
+            assert (isinstance(post, SubmittedPost))  #Assertion error
+        except(AssertionError) as e:
+            print(f"{e}")
+            print(f"{post}")
+            break
+
+        logger.debug(
+            f"{i}-{j}Checking: "
+            f"{pg.author_name} {post.time_utc} url:{post.get_url()} reviewed:{post.reviewed}  "
+            f"counted:{post.counted_status_enum} "
+            f"posted:{post.posted_status}  title:{post.title[0:30]}")
+
+        if post.counted_status_enum in (CountedStatus.NEED_REMOVE,
+                                        CountedStatus.REMOVED,
+                                        CountedStatus.BLKLIST_NEED_REMOVE,
+                                        ):  # May not need this later
+            logger.debug(
+                f"{i}-{j}\t\tAlready handled")
             continue
 
-        # Check backposts
-        logger.debug("reviwing back posts")
-        for j, post in enumerate(back_posts):
-            logger.debug(f"{i}-{j} Backpost: {post.time_utc} url:{post.get_url()}  title:{post.title[0:30]}"
-                        f"\t counted_status: {post.counted_status_enum} posted_status: {post.posted_status} ")
-            if post.counted_status_enum == CountedStatus.NOT_CHKD \
-                    or post.counted_status_enum == CountedStatus.PREV_EXEMPT:
-                counted_status, result = check_for_post_exemptions(tr_sub, post, wd=wd)
-                post.counted_status_enum = counted_status
-                #post.update_status(counted_status=counted_status)
-                wd.s.add(post)
-                logger.debug(
-                    f"\tpost_counted_status updated: {post.counted_status_enum} {CountedStatus(post.counted_status_enum)}")
-            if post.counted_status_enum == CountedStatus.COUNTS:
-                logger.debug(f"\t....Including")
-                possible_pre_posts.append(post)
-            else:
-                logger.debug(f"\t..exempting ")
-
-        # Go through left over posts
-        grace_count = 0
-        for j, post in enumerate(posts_to_verify):
-            logger.debug(f"{i}-{j} Reviewing: r/{pg.subreddit_name}  {pg.author_name}  {post.time_utc}  "
-                        f"url:{post.get_url()}  title:{post.title[0:30]}"
-                        f"\t counted_status: {post.counted_status_enum} posted_status: {post.posted_status}")
-
-            # Go through possible preposts for left over post
-            associated_reposts = []
-            for x in possible_pre_posts:
-                logger.debug(f"\tpost time:{post.time_utc} prev:{x.time_utc} "
-                      f"furthestback: {post.time_utc - tr_sub.min_post_interval + tr_sub.grace_period}")
-                if x.time_utc < post.time_utc - tr_sub.min_post_interval + tr_sub.grace_period:
-                    if post.time_utc - x.time_utc > tr_sub.min_post_interval:
-                        logger.debug("\t\t Post too far back")
-                    else:
-                        logger.debug("\t\t Post too far back - only grace peroid")
-                        # post.update(counted_status=CountedStatus.GRACE_PERIOD_EXEMPT)
-                        # s.add(post)
-                    continue
-                if x.id == post.id or x.time_utc > post.time_utc:
-                    logger.debug("\t\t Same or future post - breaking loop")
-                    break
-                status = wd.ri.get_posted_status(x, get_removed_info=True)
-                logger.debug(f"\t\tpost status: {status} gp:{tr_sub.grace_period} diff: {post.time_utc - x.time_utc}")
-                if status == PostedStatus.SELF_DEL and post.time_utc - x.time_utc < tr_sub.grace_period:
-                    logger.debug("\t\t Grace period exempt")
-                    grace_count += 1
-                    if grace_count < 3:
-                        logger.debug("\t\t Grace period exempt")
-
-                        post.counted_status_enum = CountedStatus.GRACE_PERIOD_EXEMPT
-                        wd.s.add(post)
-                        continue
-                    else:
-                        logger.debug("\t\t Too many grace exemptions")
-                associated_reposts.append(x)
-
-            # not enough posts
-            if len(associated_reposts) < tr_sub.max_count_per_interval:
-                logger.debug(f"\tNot enough previous posts: {len(associated_reposts)}/{max_count}: "
-                            f"{','.join([x.id for x in associated_reposts])}")
-                post.reviewed=True
-
-            # Hall pass eligible
-            elif subreddit_author and subreddit_author.hall_pass > 0:
-                subreddit_author.hall_pass -= 1
-                notification_text = f"Hall pass was used by {subreddit_author.author_name}: http://redd.it/{post.id}"
-                # REDDIT_CLIENT.redditor(BOT_OWNER).message(pg.subreddit_name, notification_text)
-
-                wd.ri.send_modmail(subreddit=tr_sub, subject="[Notification]  Hall pass was used",
-                                   body=notification_text)
-                # tr_sub.send_modmail(subject="[Notification]  Hall pass was used", body=notification_text)
-                post.counted_status_enum = CountedStatus.HALLPASS
-                wd.s.add(subreddit_author)
-            # Must take action on post
-            else:
-                logger.info("post needs action - identifyinig action")
-                do_requested_action_for_valid_reposts(tr_sub, post, associated_reposts, wd=wd)
-                # post.update_status(reviewed=True, flagged_duplicate=True)
-                wd.s.add(post)
-                # Keep preduplicate posts to keep track of later
-                for predupe_post in associated_reposts:
-                    predupe_post.pre_duplicate = True
-                    wd.s.add(predupe_post)
-                wd.s.commit()  # just did a lot of work, need to save
-                check_for_actionable_violations(tr_sub, post, associated_reposts, wd=wd)
+        # Check for post exemptions
+        if not post.reviewed:
+
+            counted_status, result = check_for_post_exemptions(tr_sub, post, wd=wd)
+            post.counted_status_enum = counted_status
+            #post.update_status(counted_status=counted_status)
             wd.s.add(post)
+            logger.debug(f"\t\tpost status: {counted_status} {result}")
+            if counted_status in ( CountedStatus.COUNTS , CountedStatus.NEED_REMOVE):
+                posts_to_verify.append(post)
+            if i % 25 == 0:
+                wd.s.commit()
+
+        else:
+            logger.debug(f"{i}-{j}\t\tpost status: "
+                        f"already reviewed {post.counted_status_enum} "
+                        f"{'---MHB removed' if post.flagged_duplicate else ''}")
+
+    """
+    # Skip if we don't need to go through each post
+    if len(left_over_posts) < max_count:
+        logger.info("Did not collect enough counted posts")
         wd.s.commit()
+        continue
+    """
 
     wd.s.commit()
 
 
 
+    # Collect all relevant posts
+    logger.debug("finding back posts")
+    back_posts = wd.s.query(SubmittedPost) \
+        .filter(
+        # SubmittedPost.flagged_duplicate.is_(False), # redundant with new flag
+        SubmittedPost.subreddit_name.ilike(tr_sub.subreddit_name),
+        SubmittedPost.time_utc > pg.posts[0].time_utc - tr_sub.min_post_interval + tr_sub.grace_period,
+        SubmittedPost.time_utc < pg.posts[-1].time_utc,  # posts not after last post in question
+        SubmittedPost.author == pg.author_name,
+        SubmittedPost.counted_status_enum.in_((CountedStatus.NEEDS_UPDATE, CountedStatus.NOT_CHKD, CountedStatus.COUNTS))) \
+        .order_by(SubmittedPost.time_utc) \
+        .all()
+
+    possible_pre_posts = []
+    logger.debug(f"Found {len(back_posts)} backposts")
+    if len(back_posts) == 0:
+        # if pg.posts[-1].counted_status <2:   # This doesn't make sense?? what was this supposed to do
+        #     pg.posts[-1].counted_status==2   # not an assignment!
+        pg.posts[-1].reviewed = True
+        wd.s.add(pg.posts[-1])
+
+        logger.debug("Nothing to do, moving on.")
+        return
+
+    # Check backposts
+    logger.debug("reviwing back posts")
+    for j, post in enumerate(back_posts):
+        logger.debug(f"{i}-{j} Backpost: {post.time_utc} url:{post.get_url()}  title:{post.title[0:30]}"
+                    f"\t counted_status: {post.counted_status_enum} posted_status: {post.posted_status} ")
+        if post.counted_status_enum == CountedStatus.NOT_CHKD \
+                or post.counted_status_enum == CountedStatus.PREV_EXEMPT:
+            counted_status, result = check_for_post_exemptions(tr_sub, post, wd=wd)
+            post.counted_status_enum = counted_status
+            #post.update_status(counted_status=counted_status)
+            wd.s.add(post)
+            logger.debug(
+                f"\tpost_counted_status updated: {post.counted_status_enum} {CountedStatus(post.counted_status_enum)}")
+        if post.counted_status_enum == CountedStatus.COUNTS:
+            logger.debug(f"\t....Including")
+            possible_pre_posts.append(post)
+        else:
+            logger.debug(f"\t..exempting ")
+
+    # Go through left over posts
+    grace_count = 0
+    for j, post in enumerate(posts_to_verify):
+        logger.debug(f"{i}-{j} Reviewing: r/{pg.subreddit_name}  {pg.author_name}  {post.time_utc}  "
+                    f"url:{post.get_url()}  title:{post.title[0:30]}"
+                    f"\t counted_status: {post.counted_status_enum} posted_status: {post.posted_status}")
+
+        # Go through possible preposts for left over post
+        associated_reposts = []
+        for x in possible_pre_posts:
+            logger.debug(f"\tpost time:{post.time_utc} prev:{x.time_utc} "
+                  f"furthestback: {post.time_utc - tr_sub.min_post_interval + tr_sub.grace_period}")
+            if x.time_utc < post.time_utc - tr_sub.min_post_interval + tr_sub.grace_period:
+                if post.time_utc - x.time_utc > tr_sub.min_post_interval:
+                    logger.debug("\t\t Post too far back")
+                else:
+                    logger.debug("\t\t Post too far back - only grace peroid")
+                    # post.update(counted_status=CountedStatus.GRACE_PERIOD_EXEMPT)
+                    # s.add(post)
+                continue
+            if x.id == post.id or x.time_utc > post.time_utc:
+                logger.debug("\t\t Same or future post - breaking loop")
+                break
+            status = wd.ri.get_posted_status(x, get_removed_info=True)
+            logger.debug(f"\t\tpost status: {status} gp:{tr_sub.grace_period} diff: {post.time_utc - x.time_utc}")
+            if status == PostedStatus.SELF_DEL and post.time_utc - x.time_utc < tr_sub.grace_period:
+                logger.debug("\t\t Grace period exempt")
+                grace_count += 1
+                if grace_count < 3:
+                    logger.debug("\t\t Grace period exempt")
+
+                    post.counted_status_enum = CountedStatus.GRACE_PERIOD_EXEMPT
+                    wd.s.add(post)
+                    continue
+                else:
+                    logger.debug("\t\t Too many grace exemptions")
+            associated_reposts.append(x)
+
+        # not enough posts
+        if len(associated_reposts) < tr_sub.max_count_per_interval:
+            logger.debug(f"\tNot enough previous posts: {len(associated_reposts)}/{max_count}: "
+                        f"{','.join([x.id for x in associated_reposts])}")
+            post.reviewed=True
+
+        # Hall pass eligible
+        elif subreddit_author and subreddit_author.hall_pass > 0:
+            subreddit_author.hall_pass -= 1
+            notification_text = f"Hall pass was used by {subreddit_author.author_name}: http://redd.it/{post.id}"
+            # REDDIT_CLIENT.redditor(BOT_OWNER).message(pg.subreddit_name, notification_text)
+
+            wd.ri.send_modmail(subreddit=tr_sub, subject="[Notification]  Hall pass was used",
+                               body=notification_text)
+            # tr_sub.send_modmail(subject="[Notification]  Hall pass was used", body=notification_text)
+            post.counted_status_enum = CountedStatus.HALLPASS
+            wd.s.add(subreddit_author)
+        # Must take action on post
+        else:
+            logger.info("post needs action - identifyinig action")
+            do_requested_action_for_valid_reposts(tr_sub, post, associated_reposts, wd=wd)
+            # post.update_status(reviewed=True, flagged_duplicate=True)
+            wd.s.add(post)
+            # Keep preduplicate posts to keep track of later
+            for predupe_post in associated_reposts:
+                predupe_post.pre_duplicate = True
+                wd.s.add(predupe_post)
+            wd.s.commit()  # just did a lot of work, need to save
+            check_for_actionable_violations(tr_sub, post, associated_reposts, wd=wd)
+        wd.s.add(post)
+    wd.s.commit()
 
 
 def do_requested_action_for_valid_reposts(tr_sub: TrackedSubreddit, recent_post: SubmittedPost,
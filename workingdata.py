@@ -1,3 +1,6 @@
+from contextlib import nullcontext
+
+
 class WorkingData:
     sub_list = []
     s = None
@@ -5,7 +8,91 @@ class WorkingData:
     ri = None
     sub_dict = {}
     nsfw_monitoring_subs = {}
+    scheduler = None
+    claims = None  # scheduler.ResourceClaims when tasks run side by side
+    lane_latency = None  # metrics.LaneLatency of the lane this runs in
+    task_load = None  # work found by the running task, see report_load
+    budget = None  # scheduler.TaskBudget of the running task
+    shard = None  # sharding.ShardLeases when several bot processes split the subreddits
+    task_locks = None  # clusterlocks.TaskLocks when several bot processes share the database
+    known_posts = None  # knownposts.KnownPostIds, shared by all threads
+    chunk_planner = None  # chunkplanner.ChunkPlanner, shared by all threads
+    listing_fetcher = None  # listingfetcher.ListingFetcher when listing chunks are pulled in parallel
+    spam_queue = None  # spamqueue.SpamQueueCursors, shared by all threads
+    mod_log = None  # modlog.ModLogTracker when posted statuses are kept up to date from the mod log
+    post_windows = None  # postwindows.PostWindows when ingestion flags repeat posters itself
+    exemption_chains = None  # exemptions.ExemptionChains, shared by all threads
 
     def __init__(self):
 
         pass
+
+    def holding(self, resources):
+        # claim resources (see scheduler.TASK_RESOURCES) for part of a task
+        if self.claims:
+            return self.claims.holding(resources)
+        return nullcontext()
+
+    def cluster_lock(self, name):
+        # TaskLocks.holding when several bot processes share the database, else always ours - yields whether we got it
+        if self.task_locks:
+            return self.task_locks.holding(name)
+        return nullcontext(True)
+
+    def handles(self, subreddit_name) -> bool:
+        # is this subreddit in one of our shard partitions (always, when not sharded)
+        return not self.shard or self.shard.handles(subreddit_name)
+
+    def handles_global(self) -> bool:
+        return not self.shard or self.shard.handles_global()
+
+    def out_of_time(self) -> bool:
+        # the running task's time budget is used up -> stop, leaving the rest for the next run
+        if not self.budget or not self.budget.expired():
+            return False
+        self.budget.cut_short = True
+        return True
+
+    def report_load(self, amount):
+        # new posts, posting groups, unread messages... found by the running task - drives adaptive task frequency
+        self.task_load = (self.task_load or 0) + amount
+
+    def spawn_worker(self, s, ri):
+        # Working data for a worker thread: own db session and reddit instance, and its own copies of the
+        # TrackedSubreddit objects (those are attached to the session that loaded them)
+        worker = WorkingData()
+        worker.s = s
+        worker.ri = ri
+        worker.bot_name = self.bot_name
+        worker.most_recent_review = None
+        worker.scheduler = self.scheduler
+        worker.lane_latency = self.lane_latency
+        worker.shard = self.shard
+        worker.task_locks = self.task_locks
+        worker.known_posts = self.known_posts
+        worker.chunk_planner = self.chunk_planner
+        worker.listing_fetcher = self.listing_fetcher
+        worker.spam_queue = self.spam_queue
+        worker.mod_log = self.mod_log
+        worker.post_windows = self.post_windows
+        worker.exemption_chains = self.exemption_chains
+        worker.sub_dict = {}
+        worker.nsfw_monitoring_subs = {}
+        return worker
+
+    def sync_subs(self, sub_names, nsfw_sub_names):
+        from models.reddit_models import TrackedSubreddit
+
+        for subreddit_name in set(self.sub_dict) - set(sub_names):  # dropped by update_sub_list (shard moved)
+            del self.sub_dict[subreddit_name]
+        for subreddit_name in sub_names:
+            if subreddit_name in self.sub_dict:
+                continue
+            tr = self.s.query(TrackedSubreddit).get(subreddit_name)
+            if not tr:
+                continue
+            worked, _ = tr.reload_yaml_settings()
+            if worked:
+                self.sub_dict[subreddit_name] = tr
+        self.nsfw_monitoring_subs = {subreddit_name: self.sub_dict[subreddit_name] for subreddit_name in nsfw_sub_names
+                                     if subreddit_name in self.sub_dict}